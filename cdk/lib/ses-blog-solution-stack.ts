@@ -1,4 +1,4 @@
-import { Stack, StackProps, Duration } from 'aws-cdk-lib';
+import { Stack, StackProps, Duration, AssetHashType } from 'aws-cdk-lib';
 import { aws_s3 as s3 } from 'aws-cdk-lib';
 import { aws_iam as iam } from 'aws-cdk-lib';
 import { aws_ses as ses } from 'aws-cdk-lib';
@@ -8,6 +8,7 @@ import { Function, Runtime, Code } from 'aws-cdk-lib/aws-lambda';
 import { NagSuppressions } from 'cdk-nag';
 import { CfnDataset} from 'aws-cdk-lib/aws-databrew';
 import { CfnCrawler, CfnDatabase } from 'aws-cdk-lib/aws-glue';
+import { CfnDeliveryStream } from 'aws-cdk-lib/aws-kinesisfirehose';
 import { DeliveryStream, StreamEncryption, LambdaFunctionProcessor } from '@aws-cdk/aws-kinesisfirehose-alpha';
 import { S3Bucket, Compression } from '@aws-cdk/aws-kinesisfirehose-destinations-alpha';
 import { aws_athena as athena } from 'aws-cdk-lib';
@@ -19,6 +20,12 @@ export class SesBlogSolutionStack extends Stack {
   constructor(scope: Construct, id: string, props?: StackProps) {
     super(scope, id, props);
 
+    // When dynamic partitioning is enabled (cdk deploy -c dynamicPartitioning=true), the
+    // transformation Lambda function flattens the events and returns their partition keys,
+    // and Kinesis Firehose writes them directly under the /partitioned prefix read by the crawler
+    const dynamicPartitioning = String(this.node.tryGetContext('dynamicPartitioning')) === 'true';
+    const partitionByConfigurationSet = String(this.node.tryGetContext('partitionByConfigurationSet')) === 'true';
+
     // Create the S3 bucket that will receive the event destination data from Kinesis Firehose
     const destinationBucket = new s3.Bucket(this, 'ses-events-destination', {
       bucketName: `${this.account}-${this.region}-ses-events-destination`,
@@ -52,11 +59,14 @@ export class SesBlogSolutionStack extends Stack {
       }
     });
 
-    // Add S3 event source to the Lambda function
-    lambdaCopyFunction.addEventSource(new S3EventSource(destinationBucket, {
-      events: [ s3.EventType.OBJECT_CREATED ],
-      filters: [ { prefix: 'partitioned/' } ]
-    }));
+    // Add S3 event source to the Lambda function. Not needed with dynamic partitioning,
+    // the crawler reads the objects written by Kinesis Firehose where they are
+    if (!dynamicPartitioning) {
+      lambdaCopyFunction.addEventSource(new S3EventSource(destinationBucket, {
+        events: [ s3.EventType.OBJECT_CREATED ],
+        filters: [ { prefix: 'partitioned/' } ]
+      }));
+    }
 
     destinationBucket.grantRead(lambdaCopyFunction);
     aggregatedBucket.grantWrite(lambdaCopyFunction);
@@ -72,13 +82,21 @@ export class SesBlogSolutionStack extends Stack {
       functionName: 'SESEventsTransformationFunction',
       code: Code.fromAsset(path.join(__dirname, '../src/transformation_lambda')),
       timeout: Duration.minutes(1),
+      environment: {
+        OUTPUT_FORMAT: dynamicPartitioning ? 'flat' : 'nested',
+        DYNAMIC_PARTITIONING: String(dynamicPartitioning),
+        PARTITION_BY_CONFIGURATION_SET: String(partitionByConfigurationSet),
+      },
     });
 
     const lambdaProcessor = new LambdaFunctionProcessor(lambdaTransformFunction, {
     });
 
     const s3Destination = new S3Bucket(destinationBucket, {
-      dataOutputPrefix: 'raw/',
+      dataOutputPrefix: dynamicPartitioning
+        ? 'partitioned/year=!{partitionKeyFromLambda:year}/month=!{partitionKeyFromLambda:month}/day=!{partitionKeyFromLambda:day}/hour=!{partitionKeyFromLambda:hour}/'
+        : 'raw/',
+      errorOutputPrefix: dynamicPartitioning ? 'errors/!{firehose:error-output-type}/' : undefined,
       compression: Compression.GZIP,
       bufferingInterval: Duration.seconds(60),
       processor: lambdaProcessor,
@@ -89,6 +107,17 @@ export class SesBlogSolutionStack extends Stack {
       encryption: StreamEncryption.AWS_OWNED,
     });
 
+    if (dynamicPartitioning) {
+      // The alpha DeliveryStream construct doesn't expose dynamic partitioning yet,
+      // which also requires a buffer size of at least 64 MB
+      const cfnDeliveryStream = kinesisfirehoseDeliveryStream.node.defaultChild as CfnDeliveryStream;
+      cfnDeliveryStream.addPropertyOverride('ExtendedS3DestinationConfiguration.DynamicPartitioningConfiguration', {
+        Enabled: true,
+        RetryOptions: { DurationInSeconds: 300 },
+      });
+      cfnDeliveryStream.addPropertyOverride('ExtendedS3DestinationConfiguration.BufferingHints.SizeInMBs', 64);
+    }
+
     NagSuppressions.addResourceSuppressionsByPath(this,
       '/SesBlogSolutionStack/KinesisFirehoseStream/S3 Destination Role/DefaultPolicy/Resource', [
       {id: 'AwsSolutions-IAM5', reason: 'IAM entity contains wildcard permissions'},
@@ -212,28 +241,86 @@ export class SesBlogSolutionStack extends Stack {
 
     // Allow role to get access to the s3 bucket where logs are stored
     aggregatedBucket.grantReadWrite(crawlerServiceRole);
+    if (dynamicPartitioning) {
+      destinationBucket.grantRead(crawlerServiceRole, 'partitioned/*');
+      destinationBucket.grantRead(crawlerServiceRole, 'hourly_rollups/*');
+    }
 
+    const crawledBucket = dynamicPartitioning ? destinationBucket : aggregatedBucket;
     new CfnCrawler(this, 'SESEventDataCrawler', {
       role: crawlerServiceRole.roleArn,
       targets: {
         s3Targets: [{
-          path: `s3://${aggregatedBucket.bucketName}/partitioned/`
+          path: `s3://${crawledBucket.bucketName}/partitioned/`
+        }, {
+          // hourly counters written by ses_blog_rollup.py
+          path: `s3://${crawledBucket.bucketName}/hourly_rollups/`
         }],
       },
       databaseName: (<CfnDatabase.DatabaseInputProperty>glueDatabase.databaseInput).name,
       name: 'SESEventDataCrawler',
+      // run on demand, to create the tables and pick up new columns: the partitions of new
+      // hours are registered by the SESPartitionRegistrationFunction
       recrawlPolicy: {
         recrawlBehavior: 'CRAWL_EVERYTHING',
       },
-      schedule: {
-        scheduleExpression: 'cron(30 0/1 * * ? *)'
-      },
       schemaChangePolicy: {
         updateBehavior: 'UPDATE_IN_DATABASE',
       },
 
     });
 
+    // Register the hour partitions of the partitioned and hourly_rollups tables as the objects
+    // are written, so the crawler doesn't need to run for each new hour. The code is packaged
+    // from the modules shared with the local tools, like ses-blog-setup.py does for option B.
+    const glueDatabaseName = (<CfnDatabase.DatabaseInputProperty>glueDatabase.databaseInput).name;
+    const resourcesDir = path.join(__dirname, '../../resources');
+    const partitionCodeFiles = ['ses-blog-resources/ses_blog_partitions.py', 'ses-blog-resources/ses_blog_storage.py',
+                                'TransformationLambdaCode/partitioning.py'];
+    const lambdaPartitionFunction = new Function(this, 'SESPartitionRegistrationFunction', {
+      runtime: Runtime.PYTHON_3_9,
+      handler: 'ses_blog_partitions.lambda_handler',
+      functionName: 'SESPartitionRegistrationFunction',
+      code: Code.fromAsset(resourcesDir, {
+        assetHashType: AssetHashType.OUTPUT,
+        bundling: {
+          image: Runtime.PYTHON_3_9.bundlingImage,
+          command: ['bash', '-c', `cp ${partitionCodeFiles.join(' ')} /asset-output/`],
+          local: {
+            tryBundle(outputDir: string) {
+              for (const file of partitionCodeFiles) {
+                fs.copyFileSync(path.join(resourcesDir, file), path.join(outputDir, path.basename(file)));
+              }
+              return true;
+            },
+          },
+        },
+      }),
+      timeout: Duration.minutes(1),
+      environment: {
+        GLUE_DATABASE: String(glueDatabaseName),
+        GLUE_TABLE: 'partitioned',
+        GLUE_ROLLUP_TABLE: 'hourly_rollups',
+      },
+    });
+
+    lambdaPartitionFunction.addToRolePolicy(new iam.PolicyStatement({
+      actions: ['glue:BatchCreatePartition', 'glue:GetPartitions', 'glue:GetTable'],
+      resources: [
+        `arn:${this.partition}:glue:${this.region}:${this.account}:catalog`,
+        `arn:${this.partition}:glue:${this.region}:${this.account}:database/${glueDatabaseName}`,
+        `arn:${this.partition}:glue:${this.region}:${this.account}:table/${glueDatabaseName}/partitioned`,
+        `arn:${this.partition}:glue:${this.region}:${this.account}:table/${glueDatabaseName}/hourly_rollups`,
+      ],
+    }));
+
+    for (const prefix of ['partitioned/', 'hourly_rollups/']) {
+      lambdaPartitionFunction.addEventSource(new S3EventSource(crawledBucket, {
+        events: [ s3.EventType.OBJECT_CREATED ],
+        filters: [ { prefix } ]
+      }));
+    }
+
     // S3 bucket for Athena Workgroup
     const athenaResultsBucket = new s3.Bucket(this, 'AthenaResultsBucket', {
       bucketName: `${this.account}-${this.region}-athena-results-location`,
@@ -298,6 +385,13 @@ export class SesBlogSolutionStack extends Stack {
       ]
     );
 
+    NagSuppressions.addResourceSuppressionsByPath(this, 
+      '/SesBlogSolutionStack/SESPartitionRegistrationFunction/ServiceRole/Resource',
+      [ 
+        {id: 'AwsSolutions-IAM4', reason: 'Service role is used by the lambda and uses basic lambda execution role cloudwatch log'}
+      ]
+    );
+
     NagSuppressions.addResourceSuppressionsByPath(this, 
       '/SesBlogSolutionStack/SESEventsTransformationFunction/ServiceRole/Resource',
       [ 
@@ -0,0 +1,168 @@
+import mmap
+import os
+import socket
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+
+# Fields added to the projected events, per address: the ipAddress of Open and
+# Click events, and the first ses:source-ip of every event (the address that
+# called SES). The outgoing IPs are the sending IPs of SES, all in Amazon's
+# network, and are not looked up.
+IP_FIELDS = ('ipCountry', 'ipAsn', 'ipAsnOrg')
+SOURCE_IP_FIELDS = ('sesSourceIpCountry', 'sesSourceIpAsn', 'sesSourceIpAsnOrg')
+
+# Index file layout, little endian, every section aligned on 8 bytes:
+#   header: magic, version, number of IPv4 ranges, of IPv6 ranges, of entries,
+#           of strings, size of the string data
+#   IPv4 ranges: first addresses (u32, sorted), last addresses (u32), entries (u32)
+#   IPv6 ranges: same, with the first 64 bits of the addresses (u64)
+#   entries: ASN (u32, 0 when unknown), country and AS organization (u32 string
+#            indices, 0 is the empty string)
+#   strings: offsets (u32, one more than the strings), then the UTF-8 data
+# Ranges don't overlap. IPv6 ranges are indexed on their /64 prefix, the
+# smallest block allocated to a network.
+MAGIC = b'SESGEOIP'
+VERSION = 1
+HEADER = struct.Struct('<8sIIIIII')
+
+
+def _align(size):
+    return (size + 7) & ~7
+
+
+def _sections(n4, n6, entries, strings, string_bytes):
+    sizes = ((n4, 'I'), (n4, 'I'), (n4, 'I'), (n6, 'Q'), (n6, 'Q'), (n6, 'I'),
+             (entries, 'I'), (entries, 'I'), (entries, 'I'), (strings + 1, 'I'), (string_bytes, 'B'))
+    offset = _align(HEADER.size)
+    sections = []
+    for count, fmt in sizes:
+        sections.append((offset, count, fmt))
+        offset = _align(offset + count * struct.calcsize(fmt))
+    return sections, offset
+
+
+# Serializes an index. 'v4' and 'v6' are sorted lists of (first, last, entry),
+# 'entries' a list of (asn, country index, organization index) and 'strings'
+# the list of the strings, starting with ''. Used by ses_blog_geoip.py.
+def pack_index(v4, v6, entries, strings):
+    data = [s.encode('utf-8') for s in strings]
+    offsets = [0]
+    for s in data:
+        offsets.append(offsets[-1] + len(s))
+    sections, size = _sections(len(v4), len(v6), len(entries), len(strings), offsets[-1])
+    columns = ([r[0] for r in v4], [r[1] for r in v4], [r[2] for r in v4],
+               [r[0] for r in v6], [r[1] for r in v6], [r[2] for r in v6],
+               [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries],
+               offsets)
+    buffer = bytearray(size)
+    HEADER.pack_into(buffer, 0, MAGIC, VERSION, len(v4), len(v6), len(entries), len(strings), offsets[-1])
+    for (offset, count, fmt), values in zip(sections, columns):
+        column = array(fmt, values)
+        if sys.byteorder != 'little':
+            column.byteswap()
+        buffer[offset:offset + len(column) * column.itemsize] = column.tobytes()
+    offset = sections[-1][0]
+    buffer[offset:offset + offsets[-1]] = b''.join(data)
+    return bytes(buffer)
+
+
+# Read-only view of an index file. The file is memory mapped and its sections
+# cast to typed memoryviews, so opening it only reads the header, and a lookup
+# is a binary search over the pages it touches. The (country, ASN,
+# organization) tuple of an entry is built on its first lookup and shared
+# afterwards.
+class GeoIpIndex:
+
+    def __init__(self, buffer):
+        magic, version, n4, n6, entries, strings, string_bytes = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a geo IP index, or built by another version of ses_blog_geoip.py")
+        if sys.byteorder != 'little':
+            raise ValueError("Geo IP indexes are little endian")
+        sections, size = _sections(n4, n6, entries, strings, string_bytes)
+        if len(buffer) < size:
+            raise ValueError("Truncated geo IP index")
+        self.buffer = buffer
+        view = memoryview(buffer)
+        (self.v4_first, self.v4_last, self.v4_entries, self.v6_first, self.v6_last, self.v6_entries,
+         self.asns, self.countries, self.organizations, self.offsets, self.strings) = [
+            view[offset:offset + count * struct.calcsize(fmt)].cast(fmt) for offset, count, fmt in sections]
+        self.values = [None] * entries
+
+    @classmethod
+    def open(cls, path):
+        with open(path, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.v4_first) + len(self.v6_first)
+
+    def string(self, i):
+        return bytes(self.strings[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8') or None
+
+    def entry(self, i):
+        value = self.values[i]
+        if value is None:
+            value = self.values[i] = (self.string(self.countries[i]), self.asns[i] or None,
+                                      self.string(self.organizations[i]))
+        return value
+
+    # address -> (country, ASN, organization), None when the address is not
+    # valid or not in a range
+    def lookup(self, address):
+        try:
+            if ':' in address:
+                packed = socket.inet_pton(socket.AF_INET6, address)
+                if packed[:12] == b'\0' * 10 + b'\xff\xff':
+                    return self._find(self.v4_first, self.v4_last, self.v4_entries, int.from_bytes(packed[12:], 'big'))
+                return self._find(self.v6_first, self.v6_last, self.v6_entries, int.from_bytes(packed[:8], 'big'))
+            return self._find(self.v4_first, self.v4_last, self.v4_entries,
+                              int.from_bytes(socket.inet_pton(socket.AF_INET, address), 'big'))
+        except OSError:
+            return None
+
+    def _find(self, first, last, entries, ip):
+        i = bisect_right(first, ip) - 1
+        if i < 0 or ip > last[i]:
+            return None
+        return self.entry(entries[i])
+
+
+# Adds the country, ASN and AS organization of the ipAddress and of the first
+# ses:source-ip of the projected events, when the address is in the index.
+# enrich returns the (lookups, misses) of the event, which travel back with
+# the record so that the handler counts them in every processing mode: a
+# growing share of misses means the index is out of date.
+class GeoIpEnricher:
+
+    def __init__(self, index):
+        self.index = index
+
+    @classmethod
+    def from_environment(cls, environ):
+        path = environ.get('GEOIP_INDEX_PATH', 'geoip.idx')
+        if not os.path.isabs(path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+        return cls(GeoIpIndex.open(path))
+
+    def enrich(self, projected):
+        lookups = misses = 0
+        address = projected.get('ipAddress')
+        if address and type(address) is str:
+            lookups += 1
+            misses += self._add(projected, IP_FIELDS, address)
+        source_ips = projected.get('ses:source-ip')
+        if source_ips and type(source_ips) is list and type(source_ips[0]) is str:
+            lookups += 1
+            misses += self._add(projected, SOURCE_IP_FIELDS, source_ips[0])
+        return lookups, misses
+
+    # 1 when the address is not in the index, 0 when its fields were added
+    def _add(self, projected, fields, address):
+        value = self.index.lookup(address)
+        if value is None:
+            return 1
+        projected[fields[0]], projected[fields[1]], projected[fields[2]] = value
+        return 0
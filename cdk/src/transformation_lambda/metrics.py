@@ -0,0 +1,110 @@
+import json
+import logging
+import os
+import time
+
+DEFAULT_NAMESPACE = 'SESEventsTransformation'
+NS_PER_MS = 1000000
+
+# SES event types counted with their own Events<EventType> metric. Any other
+# eventType value, missing, malformed or new, is counted as EventsOther, so the
+# events can't add metrics: EMF allows at most 100 metrics per directive.
+EVENT_TYPES = frozenset(('Send', 'Delivery', 'Bounce', 'Complaint', 'Open', 'Click', 'DeliveryDelay',
+                         'Rendering Failure', 'Reject', 'Subscription'))
+OTHER_EVENT_TYPE = 'Other'
+
+logger = logging.getLogger()
+
+
+# Per-invocation metrics of the transformation function, written as a single
+# CloudWatch Embedded Metric Format (EMF) log line: CloudWatch Logs extracts
+# the metrics from it, with no call to the CloudWatch API.
+#   Records<Result>          records by Firehose result (Ok, Dropped, ...)
+#   Events<EventType>        records by SES event type, EventsOther for the others
+#   BytesIn, BytesOut        base64 data received from and returned to Firehose
+#   DecodeTime, TransformTime, EncodeTime, Duration   in milliseconds
+class BatchMetrics:
+
+    def __init__(self, namespace=DEFAULT_NAMESPACE, function_name=None, properties=None):
+        self.namespace = namespace
+        self.function_name = function_name or os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'local')
+        self.properties = properties or {}
+        self.results = {}
+        self.event_types = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decode_ns = 0
+        self.transform_ns = 0
+        self.encode_ns = 0
+        self.counters = {}
+        self._start = time.perf_counter_ns()
+
+    # sample: (eventType, bytes in, bytes out, decode ns, transform ns, encode ns)
+    # as returned with each processed record
+    def add_sample(self, result, sample):
+        event_type, bytes_in, bytes_out, decode_ns, transform_ns, encode_ns = sample
+        self.count_result(result)
+        if event_type is not None:
+            if type(event_type) is not str or event_type not in EVENT_TYPES:
+                event_type = OTHER_EVENT_TYPE
+            self.event_types[event_type] = self.event_types.get(event_type, 0) + 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.decode_ns += decode_ns
+        self.transform_ns += transform_ns
+        self.encode_ns += encode_ns
+
+    # times measured for a whole batch rather than per record
+    def add_times(self, decode_ns, transform_ns, encode_ns):
+        self.decode_ns += decode_ns
+        self.transform_ns += transform_ns
+        self.encode_ns += encode_ns
+
+    def count_result(self, result, n=1):
+        self.results[result] = self.results.get(result, 0) + n
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def document(self):
+        values = {}
+        units = {}
+        for result, n in self.results.items():
+            values[f'Records{result}'] = n
+        for event_type, n in self.event_types.items():
+            values['Events' + event_type.replace(' ', '')] = n
+        values.update(self.counters)
+        for name in values:
+            units[name] = 'Count'
+
+        values['BytesIn'] = self.bytes_in
+        values['BytesOut'] = self.bytes_out
+        units['BytesIn'] = units['BytesOut'] = 'Bytes'
+        values['DecodeTime'] = self.decode_ns / NS_PER_MS
+        values['TransformTime'] = self.transform_ns / NS_PER_MS
+        values['EncodeTime'] = self.encode_ns / NS_PER_MS
+        values['Duration'] = (time.perf_counter_ns() - self._start) / NS_PER_MS
+        for name in ('DecodeTime', 'TransformTime', 'EncodeTime', 'Duration'):
+            units[name] = 'Milliseconds'
+
+        return {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['FunctionName']],
+                    'Metrics': [{'Name': name, 'Unit': units[name]} for name in values],
+                }],
+            },
+            'FunctionName': self.function_name,
+            **self.properties,
+            **values,
+        }
+
+    # never raises: the records are processed by then, and losing the metrics
+    # of an invocation is better than failing it
+    def emit(self):
+        try:
+            print(json.dumps(self.document(), separators=(',', ':')), flush=True)
+        except Exception as e:
+            logger.warning(json.dumps({'message': 'Metrics not emitted', 'error': str(e)[:500]}))
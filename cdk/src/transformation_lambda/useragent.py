@@ -0,0 +1,122 @@
+import re
+import threading
+from collections import OrderedDict
+
+# Events whose userAgent is parsed
+EVENT_TYPES = frozenset(('Open', 'Click'))
+
+# Fields added to the projected events
+CLIENT = 'userAgentClient'
+OS = 'userAgentOs'
+DEVICE = 'userAgentDevice'
+PROXY = 'userAgentProxy'
+
+UNKNOWN = 'Other'
+
+# Requests that are not made by the recipient: image proxies of mail
+# providers, which fetch the images of a message (and so report an open)
+# for the recipient or ahead of them, and link scanners of security gateways,
+# which follow the links of a message before it is delivered. The first
+# match gives the client.
+PROXY_RULES = (
+    (re.compile(r'GoogleImageProxy'), 'Gmail'),
+    (re.compile(r'YahooMailProxy'), 'Yahoo Mail'),
+    # Apple Mail Privacy Protection fetches the content with this exact user agent
+    (re.compile(r'^Mozilla/5\.0$'), 'Apple Mail'),
+    (re.compile(r'Barracuda|Mimecast|Proofpoint|Symantec|TrendMicro|Forcepoint|SafeLinks', re.I), 'Security scanner'),
+    (re.compile(r'bot\b|crawl|spider|slurp|curl/|wget/|python-|go-http-client|java/|okhttp|headless', re.I), 'Bot'),
+)
+
+# (pattern, value), the first match wins: the order matters, as most user
+# agents mention several browsers and systems
+CLIENT_RULES = (
+    (re.compile(r'Microsoft Outlook|MSOffice|ms-office|Outlook-(?:iOS|Android)'), 'Outlook'),
+    (re.compile(r'Thunderbird/'), 'Thunderbird'),
+    (re.compile(r'Edg(?:e|A|iOS)?/'), 'Edge'),
+    (re.compile(r'SamsungBrowser/'), 'Samsung Internet'),
+    (re.compile(r'OPR/|Opera'), 'Opera'),
+    (re.compile(r'Firefox/|FxiOS/'), 'Firefox'),
+    (re.compile(r'GSA/'), 'Google app'),
+    (re.compile(r'Chrome/|CriOS/'), 'Chrome'),
+    (re.compile(r'Version/[\d.]+.*Safari/'), 'Safari'),
+    # the Mail app renders with WebKit, without the Safari token
+    (re.compile(r'AppleWebKit/.*\((?:KHTML, like Gecko)\)(?:\s+Mobile/\w+)?$'), 'Apple Mail'),
+    (re.compile(r'MSIE |Trident/'), 'Internet Explorer'),
+)
+
+OS_RULES = (
+    (re.compile(r'Windows Phone'), 'Windows Phone'),
+    (re.compile(r'Windows'), 'Windows'),
+    (re.compile(r'iPhone|iPad|iPod|iOS'), 'iOS'),
+    (re.compile(r'Android'), 'Android'),
+    (re.compile(r'CrOS'), 'Chrome OS'),
+    (re.compile(r'Mac OS X|Macintosh'), 'macOS'),
+    (re.compile(r'Linux|X11'), 'Linux'),
+)
+
+DEVICE_RULES = (
+    (re.compile(r'iPad|Tablet|Android(?!.*Mobile)'), 'tablet'),
+    (re.compile(r'Mobi|iPhone|iPod|Android|Windows Phone|Outlook-(?:iOS|Android)'), 'mobile'),
+    (re.compile(r'Windows|Macintosh|X11|CrOS|Linux'), 'desktop'),
+)
+
+
+def _first(rules, user_agent, default=UNKNOWN):
+    for pattern, value in rules:
+        if pattern.search(user_agent):
+            return value
+    return default
+
+
+# userAgent -> (client, operating system, device type, proxy or bot). The
+# client, system and device of a proxy are those of the proxy, not of the
+# recipient, so only the client is reported for them.
+def parse_user_agent(user_agent):
+    for pattern, client in PROXY_RULES:
+        if pattern.search(user_agent):
+            return client, UNKNOWN, 'unknown', True
+    return (_first(CLIENT_RULES, user_agent), _first(OS_RULES, user_agent),
+            _first(DEVICE_RULES, user_agent, 'unknown'), False)
+
+
+# Adds the client, operating system, device type and proxy flag parsed from
+# the userAgent of Open and Click events to the projected events. Mail
+# clients and proxies send a handful of distinct user agents, so the parsed
+# values are kept in a bounded LRU cache, shared by the threads of
+# PROCESSING_MODE=thread. enrich returns the (hits, misses) of the cache for
+# the event, which travel back with the record so that the handler counts
+# them in every processing mode.
+class UserAgentEnricher:
+
+    def __init__(self, cache_size=1024):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, environ):
+        return cls(cache_size=int(environ.get('USER_AGENT_CACHE_SIZE', '1024')))
+
+    def enrich(self, projected):
+        if projected.get('eventType') not in EVENT_TYPES:
+            return 0, 0
+        user_agent = projected.get('userAgent')
+        if not user_agent or type(user_agent) is not str:
+            return 0, 0
+        value, hit = self.parse(user_agent)
+        projected[CLIENT], projected[OS], projected[DEVICE], projected[PROXY] = value
+        return (1, 0) if hit else (0, 1)
+
+    # userAgent -> (parsed values, whether they were cached)
+    def parse(self, user_agent):
+        with self.lock:
+            value = self.cache.get(user_agent)
+            if value is not None:
+                self.cache.move_to_end(user_agent)
+                return value, True
+        value = parse_user_agent(user_agent)
+        with self.lock:
+            self.cache[user_agent] = value
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return value, False
@@ -0,0 +1,94 @@
+import binascii
+import json
+import os
+
+try:
+    import orjson
+except ImportError:  # optional, add it to the deployment package to use it
+    orjson = None
+
+# Codecs turning the base64 data of a Firehose record into an event and back.
+# Payloads stay bytes end to end: base64 is decoded straight to the UTF-8 JSON
+# bytes the JSON backend parses, and the backend writes UTF-8 bytes that are
+# base64 encoded as they are.
+#
+# Every backend writes the same bytes: compact JSON (no whitespace after ',' and
+# ':'), non-ASCII characters written as UTF-8 rather than \uXXXX escapes, keys
+# in insertion order, followed by a newline. The records differ only in
+# whitespace and escaping from the ones json.dumps wrote before, so they parse
+# to the same values and the Glue/Athena schemas are unaffected. The backends
+# only behave differently on input SES never produces:
+#   - NaN/Infinity tokens and lone UTF-16 surrogates are rejected by orjson
+#     when decoding, and by the stdlib codec when encoding;
+#   - integers outside the 64-bit range are parsed as floats by orjson, losing
+#     precision, and rejected by it when encoding;
+#   - floats written with an exponent are formatted as 1e+16 and 1.5e-07 by the
+#     stdlib codec, 1e16 and 1.5e-7 by orjson.
+
+# Lambda rejects invocation and response payloads larger than 6 MiB, which
+# bounds both the batches Firehose sends and the responses of the function.
+# ses_blog_events.py packs its test batches to the same limit.
+PAYLOAD_SIZE_LIMIT = 6 * 1024 * 1024
+
+
+class StdlibJsonCodec:
+    name = 'stdlib'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode('utf-8')
+
+
+class OrjsonCodec:
+    name = 'orjson'
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+
+# available backends, fastest first
+BACKENDS = {'stdlib': StdlibJsonCodec}
+if orjson is not None:
+    BACKENDS = {'orjson': OrjsonCodec, **BACKENDS}
+
+
+class FirehoseRecordCodec:
+
+    def __init__(self, json_codec):
+        self.json = json_codec
+        self.name = json_codec.name
+
+    # base64 data of an incoming Firehose record -> event
+    def decode(self, data):
+        return self.json.loads(binascii.a2b_base64(data))
+
+    # event -> base64 data of an outgoing Firehose record, one JSON document per line
+    def encode(self, obj):
+        return binascii.b2a_base64(self.json.dumps(obj) + b'\n', newline=False).decode('ascii')
+
+    # several rows -> base64 data of a single outgoing Firehose record
+    def encode_lines(self, objs):
+        dumps = self.json.dumps
+        return binascii.b2a_base64(b''.join([dumps(obj) + b'\n' for obj in objs]), newline=False).decode('ascii')
+
+
+# 'auto' picks the fastest backend installed; naming a backend explicitly is
+# the switch used to benchmark one against the other
+def get_codec(backend='auto'):
+    if backend == 'auto':
+        backend = next(iter(BACKENDS))
+    if backend not in BACKENDS:
+        raise ValueError(f"JSON backend '{backend}' is not available, expected one of {', '.join(BACKENDS)}")
+    return FirehoseRecordCodec(BACKENDS[backend]())
+
+
+def codec_from_environment(environ=os.environ):
+    return get_codec(environ.get('JSON_BACKEND', 'auto').lower())
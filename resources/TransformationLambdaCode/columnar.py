@@ -0,0 +1,117 @@
+import binascii
+import json
+
+from flatten import DOMAIN_PATTERN
+
+
+# A Firehose batch in a struct-of-arrays layout. The documents of the batch
+# are parsed, then the fields of schema.json found in each event are
+# gathered, without copying the template defaults into every record. One list
+# per field, with its value for every record, is built on first use, and the
+# values derived from a column (event type buckets, partition hours, recipient
+# domains) are computed once per distinct value of the column: the events of
+# a batch share a handful of event types and hours, and their recipients a
+# few domains.
+# A record that cannot be decoded or projected is listed in 'failed' with its
+# error, and has no fields.
+class ColumnarBatch:
+
+    def __init__(self, projection, payloads, failed=None):
+        self.template = projection.template
+        self.payloads = payloads
+        self.failed = dict(failed or {})
+        self.found = []
+        for i, payload in enumerate(payloads):
+            if i in self.failed:
+                self.found.append(None)
+                continue
+            try:
+                self.found.append(projection.collect(payload))
+            except Exception as e:
+                self.failed[i] = e
+                self.found.append(None)
+        self._columns = {}
+
+    # base64 data of the records -> batch. Each record is parsed on its own:
+    # parsing the documents of a batch joined into one JSON array is no
+    # faster, and a record that is not exactly one document could shift the
+    # documents of the records after it.
+    @classmethod
+    def decode(cls, projection, codec, data):
+        loads = codec.json.loads
+        payloads = []
+        failed = {}
+        for i, d in enumerate(data):
+            try:
+                payloads.append(loads(binascii.a2b_base64(d)))
+            except Exception as e:
+                payloads.append(None)
+                failed[i] = e
+        return cls(projection, payloads, failed)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    # values of a field for every record, the default for the records that
+    # don't have it and None for the failed ones
+    def column(self, name):
+        column = self._columns.get(name)
+        if column is None:
+            default = self.template[name]
+            column = self._columns[name] = [None if f is None else f.get(name, default) for f in self.found]
+        return column
+
+    # projected events, as SchemaProjection returns them, None for the failed
+    # records. The default lists and objects are shared between the events,
+    # which are only read.
+    def rows(self):
+        template = self.template
+        return [None if f is None else {**template, **f} for f in self.found]
+
+    # indices of the records by value of a column, eventType by default
+    def buckets(self, name='eventType'):
+        buckets = {}
+        for i, value in enumerate(self.column(name)):
+            if i not in self.failed:
+                buckets.setdefault(value, []).append(i)
+        return buckets
+
+    # recipient domain of every distinct address of a column, destination by
+    # default, for the mailRecipientDomain of the flat rows
+    def recipient_domains(self, name='destination'):
+        domains = {}
+        search = DOMAIN_PATTERN.search
+        for values in self.column(name):
+            if type(values) is not list:
+                values = (values,)
+            for address in values:
+                if type(address) is str and address not in domains:
+                    match = search(address)
+                    domains[address] = match.group(0) if match else None
+        return domains
+
+    # the projected events of the records that did not fail as an Arrow
+    # table with one column per field of schema.json. A column whose values
+    # have no common Arrow type is written as strings, lists and objects as
+    # JSON. pyarrow is not part of the deployment package: it is imported
+    # here, for the local tools.
+    def to_arrow(self):
+        import pyarrow as pa
+        ok = [i for i in range(len(self)) if i not in self.failed]
+        arrays = {}
+        for name in self.template:
+            column = self.column(name)
+            values = [column[i] for i in ok]
+            try:
+                arrays[name] = pa.array(values)
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                arrays[name] = pa.array([v if v is None or isinstance(v, str) else json.dumps(v) for v in values],
+                                        type=pa.string())
+        return pa.table(arrays)
+
+    def to_parquet(self, compression='gzip'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        sink = pa.BufferOutputStream()
+        pq.write_table(self.to_arrow(), sink, compression=compression)
+        return sink.getvalue().to_pybytes()
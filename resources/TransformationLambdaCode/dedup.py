@@ -0,0 +1,142 @@
+import hashlib
+import math
+
+KEY_SEPARATOR = '\x1f'
+
+
+# Key of an SES event for duplicate suppression: messageId, eventType,
+# timestamp of the event and its recipients, taken from the projected event.
+# Copies of an event published twice by SES, or put twice into Firehose, have
+# the same key.
+def event_key(projected):
+    return KEY_SEPARATOR.join((
+        str(projected.get('messageId') or ''),
+        str(projected.get('eventType') or ''),
+        str(projected.get('timestamp') or ''),
+        ','.join(event_recipients(projected)),
+    )).encode('utf-8')
+
+
+# Recipients of the event itself rather than of the message: SES publishes a
+# Bounce, Complaint, Delivery or DeliveryDelay event per recipient, or group
+# of recipients, of a message, and they are distinct events. The message
+# recipients ('destination') are used for the other events.
+def event_recipients(projected):
+    recipients = projected.get('recipients')
+    if type(recipients) is list and any(recipients):
+        return [str(r) for r in recipients if r]
+    for field in ('bouncedRecipients', 'complainedRecipients', 'delayedRecipients'):
+        entries = projected.get(field)
+        if type(entries) is list:
+            addresses = [str(e.get('emailAddress')) for e in entries
+                         if type(e) is dict and e.get('emailAddress')]
+            if addresses:
+                return addresses
+    return [str(d) for d in projected.get('destination') or ()]
+
+
+# Bloom filter of 'capacity' keys with the given false positive rate, in a
+# fixed size bit array. The probes are derived from one blake2b digest of the
+# key (double hashing).
+class BloomFilter:
+
+    def __init__(self, capacity, false_positive_rate):
+        if capacity < 1:
+            raise ValueError("The capacity of the filter must be at least 1")
+        if not 0 < false_positive_rate < 1:
+            raise ValueError("The false positive rate must be between 0 and 1")
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.size = max(8, math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i * h2) % size for i in range(self.hashes)]
+
+    def contains_positions(self, positions):
+        bits = self.bits
+        for p in positions:
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def add_positions(self, positions):
+        bits = self.bits
+        for p in positions:
+            bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return self.contains_positions(self.positions(key))
+
+    def add(self, key):
+        self.add_positions(self.positions(key))
+
+
+# Two generations of Bloom filters: keys are added to the current one and
+# looked up in both; when the current one is full, it becomes the previous
+# one and the oldest generation is discarded. Memory stays fixed, and a key
+# is remembered for at least 'capacity' keys added after it. As a key is
+# looked up in two filters, each one is sized for half the false positive rate.
+class RotatingBloomFilter:
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.current = BloomFilter(capacity, false_positive_rate / 2)
+        self.previous = None
+        self.rotations = 0
+        self.pending = None
+        self.pending_records = frozenset()
+
+    @classmethod
+    def from_environment(cls, environ):
+        return cls(capacity=int(environ.get('DEDUP_CAPACITY', '1000000')),
+                   false_positive_rate=float(environ.get('DEDUP_FALSE_POSITIVE_RATE', '0.000001')))
+
+    @property
+    def memory_bytes(self):
+        return 2 * len(self.current.bits)
+
+    def __contains__(self, key):
+        positions = self.current.positions(key)
+        if self.current.contains_positions(positions):
+            return True
+        return self.previous is not None and self.previous.contains_positions(positions)
+
+    def add(self, key):
+        if self.current.count >= self.capacity:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.false_positive_rate / 2)
+            self.rotations += 1
+        self.current.add(key)
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    # The keys of a response are staged rather than added: Firehose sends the
+    # records of a batch again when it didn't accept the response of the
+    # function, and they must not be taken for duplicates then. commit() is
+    # called at the start of the next invocation, and adds the staged keys
+    # unless that invocation retries records of the staged batch, identified
+    # by their recordId. Keys staged by an invocation that failed or timed out
+    # are never added.
+    def stage(self, keys, record_ids):
+        self.pending = keys
+        self.pending_records = frozenset(record_ids)
+
+    # returns whether the staged keys were added
+    def commit(self, record_ids):
+        pending, self.pending = self.pending, None
+        pending_records, self.pending_records = self.pending_records, frozenset()
+        if pending is None or not pending_records.isdisjoint(record_ids):
+            return False
+        self.update(pending)
+        return True
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait
+
+SERIAL = 'serial'
+THREAD = 'thread'
+PROCESS = 'process'
+MODES = (SERIAL, THREAD, PROCESS)
+
+# Batches smaller than this are always processed serially: below it the cost
+# of handing records to a pool is higher than what the extra cores give back
+DEFAULT_MIN_BATCH_SIZE = 100
+# Number of chunks handed to each worker process per batch, small enough to
+# amortise the pickling of each chunk, large enough to balance the load
+CHUNKS_PER_WORKER = 4
+
+
+# Maps a function over the records of a batch, either serially, in a thread
+# pool or in a pool of worker processes. The result always has the same order
+# as the input. Pools are created on first use and kept for the lifetime of
+# the execution environment, so warm invocations don't pay their startup.
+class BatchExecutor:
+
+    def __init__(self, mode=SERIAL, workers=None, min_batch_size=DEFAULT_MIN_BATCH_SIZE, chunk_size=None):
+        if mode not in MODES:
+            raise ValueError(f"Unknown processing mode '{mode}', expected one of {', '.join(MODES)}")
+        self.mode = mode
+        self.workers = workers or os.cpu_count() or 1
+        self.min_batch_size = min_batch_size
+        self.chunk_size = chunk_size
+        self._threads = None
+        self._processes = None
+
+    @classmethod
+    def from_environment(cls, environ=os.environ):
+        workers = environ.get('PROCESSING_WORKERS')
+        chunk_size = environ.get('PROCESSING_CHUNK_SIZE')
+        return cls(
+            mode=environ.get('PROCESSING_MODE', SERIAL).lower(),
+            workers=int(workers) if workers else None,
+            min_batch_size=int(environ.get('PROCESSING_MIN_BATCH_SIZE', DEFAULT_MIN_BATCH_SIZE)),
+            chunk_size=int(chunk_size) if chunk_size else None)
+
+    def effective_mode(self, batch_size):
+        if self.mode == SERIAL or self.workers < 2 or batch_size < self.min_batch_size:
+            return SERIAL
+        return self.mode
+
+    def map(self, func, items):
+        items = list(items)
+        mode = self.effective_mode(len(items))
+        if mode == THREAD:
+            return list(self._thread_pool().map(func, items))
+        if mode == PROCESS:
+            return self._process_pool().map(func, self._chunks(items))
+        return [func(item) for item in items]
+
+    def _chunks(self, items):
+        size = self.chunk_size or max(1, -(-len(items) // (self.workers * CHUNKS_PER_WORKER)))
+        return [items[i:i + size] for i in range(0, len(items), size)]
+
+    def _thread_pool(self):
+        if self._threads is None:
+            self._threads = ThreadPoolExecutor(max_workers=self.workers)
+        return self._threads
+
+    # a pool that shut down after one of its workers died is replaced: the
+    # batch it was processing fails, and Firehose retries it on a new pool
+    def _process_pool(self):
+        if self._processes is None or self._processes.closed:
+            self._processes = PipeProcessPool(self.workers)
+        return self._processes
+
+    def shutdown(self):
+        if self._threads is not None:
+            self._threads.shutdown()
+            self._threads = None
+        if self._processes is not None:
+            self._processes.shutdown()
+            self._processes = None
+
+
+# Pool of forked worker processes talking to the parent over pipes.
+# multiprocessing.Pool and ProcessPoolExecutor rely on semaphores backed by
+# /dev/shm, which the Lambda execution environment does not provide, while
+# Pipe and Process work there.
+class PipeProcessPool:
+
+    def __init__(self, workers):
+        context = multiprocessing.get_context('fork')
+        self._workers = []
+        for _ in range(workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_worker_loop, args=(child_conn,), daemon=True)
+            process.start()
+            child_conn.close()
+            self._workers.append((process, parent_conn))
+
+    @property
+    def closed(self):
+        return not self._workers
+
+    # func is applied to every item of every chunk; results are returned
+    # flattened, in chunk order
+    def map(self, func, chunks):
+        if self.closed:
+            raise RuntimeError("The batch worker pool is shut down")
+        results = [None] * len(chunks)
+        pending = iter(enumerate(chunks))
+        busy = {}
+        # the first exception raised by func, raised once the answers still
+        # in flight are read, so the pipes stay in sync
+        error = None
+
+        try:
+            for _, conn in self._workers:
+                if not self._dispatch(conn, func, pending, busy):
+                    break
+            while busy:
+                for conn in wait(list(busy)):
+                    index = busy.pop(conn)
+                    ok, value = conn.recv()
+                    if not ok:
+                        error = error or value
+                    elif error is None:
+                        results[index] = value
+                        self._dispatch(conn, func, pending, busy)
+        except (EOFError, OSError):
+            # a worker died: its pipe is closed or broken
+            self.shutdown()
+            raise RuntimeError("A batch worker process exited unexpectedly")
+        if error is not None:
+            raise error
+
+        return [item for chunk in results for item in chunk]
+
+    def _dispatch(self, conn, func, pending, busy):
+        task = next(pending, None)
+        if task is None:
+            return False
+        index, chunk = task
+        conn.send((func, chunk))
+        busy[conn] = index
+        return True
+
+    def shutdown(self):
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+            process.join(timeout=1)
+            if process.is_alive():
+                process.kill()
+        self._workers = []
+
+
+def _worker_loop(conn):
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        func, chunk = task
+        try:
+            conn.send((True, [func(item) for item in chunk]))
+        except Exception as e:
+            try:
+                conn.send((False, e))
+            except Exception:
+                # the exception itself could not be pickled
+                conn.send((False, RuntimeError(repr(e))))
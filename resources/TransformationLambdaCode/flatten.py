@@ -0,0 +1,79 @@
+import re
+from functools import lru_cache
+from itertools import product
+
+NESTED = 'nested'
+FLAT = 'flat'
+OUTPUT_FORMATS = (NESTED, FLAT)
+
+# Same pattern as the EXTRACT_PATTERN step of the DataBrew recipe
+DOMAIN_PATTERN = re.compile(r'(?<=@)[^.]+(?=.).*')
+
+# Fields of the projected event that the recipe unnests into one row per element
+RECIPIENT_FIELDS = ('bouncedRecipients', 'complainedRecipients', 'delayedRecipients', 'recipients')
+UNNESTED_FIELDS = RECIPIENT_FIELDS + ('destination', 'ses:source-ip', 'ses:outgoing-ip')
+# Fields dropped or renamed by the recipe
+DROPPED_FIELDS = frozenset(UNNESTED_FIELDS + ('contactList', 'source'))
+# Fields stored as integers, empty values become null
+INTEGER_FIELDS = frozenset(('processingTimeMillis',))
+
+
+@lru_cache(maxsize=4096)
+def mail_recipient_domain(address):
+    match = DOMAIN_PATTERN.search(address)
+    return match.group(0) if match else None
+
+
+def _elements(values):
+    if values is None or values == []:
+        return (None,)
+    if not isinstance(values, list):
+        return (values,)
+    return values
+
+
+def _email(recipient):
+    if isinstance(recipient, dict):
+        return recipient.get('emailAddress')
+    return recipient
+
+
+# Does inline what the DataBrew recipe does to a projected event: one row per
+# combination of the elements of the unnested arrays (an empty array counts as
+# one null element), with the recipe's recipientEvent, recipientMail,
+# mailRecipientDomain, sender, sesSourceIp and sesOutgoingIp columns. The
+# domains of the destination addresses are taken from 'domains' when given,
+# as computed over a whole column by ColumnarBatch.recipient_domains.
+def flatten_record(projected, domains=None):
+    base = {}
+    for k, v in projected.items():
+        if k in DROPPED_FIELDS:
+            continue
+        if k in INTEGER_FIELDS and v == '':
+            v = None
+        base[k] = v
+
+    rows = []
+    for bounced, complained, destination, source_ip, outgoing_ip, delayed, recipient in product(
+            _elements(projected.get('bouncedRecipients')),
+            _elements(projected.get('complainedRecipients')),
+            _elements(projected.get('destination')),
+            _elements(projected.get('ses:source-ip')),
+            _elements(projected.get('ses:outgoing-ip')),
+            _elements(projected.get('delayedRecipients')),
+            _elements(projected.get('recipients'))):
+        row = dict(base)
+        merged = [e for e in (_email(bounced), _email(complained), _email(delayed), recipient) if e is not None]
+        row['recipientEvent'] = ''.join(merged) if merged else None
+        row['recipientMail'] = destination
+        if not isinstance(destination, str):
+            row['mailRecipientDomain'] = None
+        elif domains is not None:
+            row['mailRecipientDomain'] = domains[destination]
+        else:
+            row['mailRecipientDomain'] = mail_recipient_domain(destination)
+        row['sender'] = projected.get('source')
+        row['sesOutgoingIp'] = outgoing_ip
+        row['sesSourceIp'] = source_ip
+        rows.append(row)
+    return rows
@@ -1,49 +1,447 @@
-import base64
+import gc
 import json
+import logging
+import os
+import random
+import time
+from time import perf_counter_ns
+
+from codec import PAYLOAD_SIZE_LIMIT, codec_from_environment
+from columnar import ColumnarBatch
+from dedup import RotatingBloomFilter, event_key
+from executor import BatchExecutor
+from flatten import FLAT, OUTPUT_FORMATS, flatten_record
+from geoip import GeoIpEnricher
+from metrics import DEFAULT_NAMESPACE, BatchMetrics
+from partitioning import PartitionKeyBuilder
+from reputation import SIGNAL_EVENT_TYPES, ReputationMonitor, ReputationState, reputation_signal
+from useragent import EVENT_TYPES as USER_AGENT_EVENT_TYPES
+from useragent import UserAgentEnricher
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.json')
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+
+# fraction of the invocations whose whole event is logged, at DEBUG level
+EVENT_LOG_SAMPLE_RATE = float(os.environ.get('EVENT_LOG_SAMPLE_RATE', '0'))
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', DEFAULT_NAMESPACE)
 
 
 def lambda_handler(event, context):
-    output = []
-    print("Event:\n",event)
+    metrics = BatchMetrics(
+        namespace=METRICS_NAMESPACE,
+        function_name=getattr(context, 'function_name', None),
+        properties={'invocationId': event.get('invocationId')})
+    if EVENT_LOG_SAMPLE_RATE and logger.isEnabledFor(logging.DEBUG) and random.random() < EVENT_LOG_SAMPLE_RATE:
+        logger.debug(json.dumps({'message': 'Sampled event', 'event': event}))
+
+    if DEDUP is not None and DEDUP.pending is not None and not DEDUP.commit(r['recordId'] for r in event['records']):
+        metrics.count('DuplicateKeysDiscarded')
 
     # remove firehose test events
     valid_records = [x for x in event['records'] if x['data'] != ""]
     invalid_records = [x for x in event['records'] if x['data'] == ""]
     for record in invalid_records:
         record['result'] = 'Dropped'
+    metrics.count_result('Dropped', len(invalid_records))
 
-    output_valid = map(parallel_process_record, valid_records)
-    output_valid_list = list(output_valid)
+    # the records that do not fit in the response are returned as failed, with
+    # no data: Firehose then delivers the original records to the error prefix.
+    # Room for every record in that form is reserved up front.
+    response_bytes = RESPONSE_OVERHEAD + sum(record_response_size(r) for r in invalid_records)
+    response_bytes += sum(RECORD_OVERHEAD + len(r['recordId']) for r in valid_records)
+    output_valid_list = []
+    # keys of the events of this batch, staged in DEDUP once the response is
+    # built and added at the next invocation
+    batch_keys = set()
+    now = time.time()
+    # user agent cache hits and misses, geo IP lookups and misses
+    enrichment = [0, 0, 0, 0]
+    if COLUMNAR:
+        processed = columnar_process_records(valid_records, metrics)
+    else:
+        processed = EXECUTOR.map(instrumented_process_record, valid_records)
+    for output_record, sample, key, signal, counts in processed:
+        if counts is not None:
+            for i, n in enumerate(counts):
+                enrichment[i] += n
+        if output_record['result'] == 'ProcessingFailed':
+            metrics.count('ProcessingErrors')
+        elif key is not None and (key in batch_keys or key in DEDUP):
+            output_record = duplicate_record(output_record)
+            sample = sample[:2] + (0,) + sample[3:]
+            metrics.count('DuplicatesDropped')
+        elif signal is not None:
+            REPUTATION.add(signal, now)
+        extra = record_response_size(output_record) - RECORD_OVERHEAD - len(output_record['recordId'])
+        if response_bytes + extra > MAX_RESPONSE_BYTES:
+            output_record = overflow_record(output_record)
+            sample = sample[:2] + (0,) + sample[3:]
+            metrics.count('ResponseOverflow')
+        else:
+            response_bytes += extra
+            if key is not None and output_record['result'] == 'Ok':
+                batch_keys.add(key)
+        output_valid_list.append(output_record)
+        metrics.add_sample(output_record['result'], sample)
     output_list = output_valid_list + invalid_records
-    print(f"Successfully processed {len(output_list)} records")
+    if DEDUP is not None:
+        DEDUP.stage(batch_keys, (r['recordId'] for r in valid_records))
+    if enrichment[0] or enrichment[1]:
+        metrics.count('UserAgentCacheHits', enrichment[0])
+        metrics.count('UserAgentCacheMisses', enrichment[1])
+    if enrichment[2]:
+        metrics.count('GeoIpLookups', enrichment[2])
+        metrics.count('GeoIpMisses', enrichment[3])
+    if REPUTATION is not None:
+        breaches = REPUTATION.breaches(now)
+        for breach in breaches:
+            logger.warning(json.dumps({'message': 'Reputation threshold breached', **breach}))
+        if breaches:
+            metrics.count('ReputationBreaches', len(breaches))
+        if REPUTATION_STATE is not None:
+            REPUTATION_STATE.maybe_save(REPUTATION, now)
+    if metrics.counters.get('ResponseOverflow'):
+        logger.warning(json.dumps({
+            'message': 'Response size limit reached',
+            'invocationId': event.get('invocationId'),
+            'overflowRecords': metrics.counters['ResponseOverflow'],
+            'maxResponseBytes': MAX_RESPONSE_BYTES}))
+
+    if METRICS_ENABLED:
+        metrics.emit()
     return {'records': output_list}
 
+# Size of a record in the JSON response: its data, recordId and partition
+# keys, plus the keys and punctuation around them
+def record_response_size(output_record):
+    size = RECORD_OVERHEAD + len(output_record['recordId']) + len(output_record.get('data', ''))
+    metadata = output_record.get('metadata')
+    if metadata:
+        size += PARTITION_KEYS_OVERHEAD
+        for k, v in metadata['partitionKeys'].items():
+            size += PARTITION_KEY_OVERHEAD + len(k) + len(v)
+    return size
+
+# A duplicate of an event already returned by this execution environment
+def duplicate_record(output_record):
+    return {
+        'recordId': output_record['recordId'],
+        'result': 'Dropped',
+        'data': ''
+    }
+
+# A processed record that does not fit in the response
+def overflow_record(output_record):
+    return {
+        'recordId': output_record['recordId'],
+        'result': 'ProcessingFailed',
+        'data': ''
+    }
+
 # Process records in event in parallel
 def parallel_process_record(record):
-    decoded_payload = base64.b64decode(record['data']).decode('utf-8')
-    payload = json.loads(decoded_payload)
+    return instrumented_process_record(record)[0]
+
+# Process a record and return it with the measures of its processing:
+# (eventType, bytes in, bytes out, decode ns, transform ns, encode ns), its
+# duplicate suppression key when DEDUP is enabled, its reputation signal when
+# REPUTATION is enabled and the counts of its enrichment, (user agent cache
+# hits, misses, geo IP lookups, misses), when USER_AGENT_ENABLED or
+# GEOIP_ENABLED is set. They travel back with the record so that they are
+# collected in every PROCESSING_MODE, worker processes and threads counting
+# nothing in shared state.
+# A record that cannot be processed is returned as failed on its own, with its
+# original data, instead of failing the whole batch.
+def instrumented_process_record(record):
+    try:
+        return _instrumented_process_record(record)
+    except Exception as e:
+        return failed_record(record, e)
+
+def failed_record(record, error):
+    logger.warning(json.dumps({
+        'message': 'Record processing failed',
+        'recordId': record.get('recordId'),
+        'error': f"{type(error).__name__}: {error}"[:500]}))
+    output_record = {
+        'recordId': record['recordId'],
+        'result': 'ProcessingFailed',
+        'data': record['data']
+    }
+    return output_record, (None, len(record['data']), len(record['data']), 0, 0, 0), None, None, None
+
+def _instrumented_process_record(record):
+    t0 = perf_counter_ns()
+    payload = CODEC.decode(record['data'])
+    t1 = perf_counter_ns()
     updated_payload = process_record(payload)
-    adjusted_payload = json.dumps(updated_payload) + '\n'
+    counts = None
+    if USER_AGENTS is not None or GEOIP is not None:
+        counts = ((USER_AGENTS.enrich(updated_payload) if USER_AGENTS is not None else (0, 0)) +
+                  (GEOIP.enrich(updated_payload) if GEOIP is not None else (0, 0)))
+    if OUTPUT_FORMAT == FLAT:
+        rows = flatten_record(updated_payload)
+        t2 = perf_counter_ns()
+        data = CODEC.encode_lines(rows)
+    else:
+        t2 = perf_counter_ns()
+        data = CODEC.encode(updated_payload)
+    t3 = perf_counter_ns()
     output_record = {
         'recordId': record['recordId'],
         'result': 'Ok',
-        'data': base64.b64encode(adjusted_payload.encode('utf-8'))
+        'data': data
     }
-    return output_record
+    if PARTITION_KEYS is not None:
+        output_record['metadata'] = {'partitionKeys': PARTITION_KEYS(payload, updated_payload, record)}
+    sample = (updated_payload.get('eventType'), len(record['data']), len(data), t1 - t0, t2 - t1, t3 - t2)
+    key = event_key(updated_payload) if DEDUP is not None else None
+    signal = reputation_signal(payload, updated_payload) if REPUTATION is not None else None
+    return output_record, sample, key, signal, counts
 
-# process individual records extracting only the fields listed in the
-# template defined within this function
-def process_record(record):
-    f = open('schema.json')
-    template = json.load(f)
+# Columnar counterpart of EXECUTOR.map(instrumented_process_record, records),
+# used when COLUMNAR_ENABLED is set. The batch is processed in chunks of
+# COLUMNAR_CHUNK_SIZE records: each chunk is decoded at once into a
+# ColumnarBatch, the partition keys are computed over its columns, the user
+# agents are parsed and the reputation signals computed only for the records
+# of the event types that have them, the IP addresses are looked up, the
+# recipient domains of the flat rows are extracted over the destination
+# column, and each record is encoded from its projected event. The decode, transform and encode
+# times are measured per chunk and added to 'metrics'.
+# The events of a chunk are all alive at the same time, unlike in the per
+# record path, and their allocation would trigger the cyclic garbage
+# collector over and over: it is paused while the batch is processed, the
+# events being plain JSON values that hold no reference cycles.
+def columnar_process_records(records, metrics):
+    paused = gc.isenabled()
+    gc.disable()
+    try:
+        processed = []
+        for i in range(0, len(records), COLUMNAR_CHUNK_SIZE):
+            processed.extend(_columnar_process_chunk(records[i:i + COLUMNAR_CHUNK_SIZE], metrics))
+        return processed
+    finally:
+        if paused:
+            gc.enable()
+
+def _columnar_process_chunk(records, metrics):
+    t0 = perf_counter_ns()
+    batch = ColumnarBatch.decode(PROJECTION, CODEC, [r['data'] for r in records])
+    t1 = perf_counter_ns()
+    projected = batch.rows()
+    event_types = batch.column('eventType')
+    partition_keys = PARTITION_KEYS.for_batch(batch, records) if PARTITION_KEYS is not None else None
+    buckets = batch.buckets() if USER_AGENTS is not None or REPUTATION is not None else None
+    # the counts of the chunk go with its first record
+    counts = None
+    if USER_AGENTS is not None or GEOIP is not None:
+        counts = [0, 0, 0, 0]
+    if USER_AGENTS is not None:
+        for event_type in USER_AGENT_EVENT_TYPES:
+            for i in buckets.get(event_type, ()):
+                hits, misses = USER_AGENTS.enrich(projected[i])
+                counts[0] += hits
+                counts[1] += misses
+    if GEOIP is not None:
+        for updated_payload in projected:
+            if updated_payload is not None:
+                lookups, misses = GEOIP.enrich(updated_payload)
+                counts[2] += lookups
+                counts[3] += misses
+    signals = None
+    if REPUTATION is not None:
+        signals = [None] * len(batch)
+        for event_type in SIGNAL_EVENT_TYPES:
+            for i in buckets.get(event_type, ()):
+                signals[i] = reputation_signal(batch.payloads[i], projected[i])
+    failed = batch.failed
+    if OUTPUT_FORMAT == FLAT:
+        domains = batch.recipient_domains()
+        output_rows = []
+        for i, updated_payload in enumerate(projected):
+            try:
+                output_rows.append(None if updated_payload is None else flatten_record(updated_payload, domains))
+            except Exception as e:
+                failed[i] = e
+                output_rows.append(None)
+        encode = CODEC.encode_lines
+    else:
+        output_rows = projected
+        encode = CODEC.encode
+    t2 = perf_counter_ns()
+    encoded = []
+    for i, rows in enumerate(output_rows):
+        try:
+            encoded.append(None if rows is None else encode(rows))
+        except Exception as e:
+            failed[i] = e
+            encoded.append(None)
+    t3 = perf_counter_ns()
+    metrics.add_times(t1 - t0, t2 - t1, t3 - t2)
+
+    processed = []
+    for i, record in enumerate(records):
+        if i in failed:
+            processed.append(failed_record(record, failed[i])[:4] + (counts if i == 0 else None,))
+            continue
+        data = encoded[i]
+        output_record = {
+            'recordId': record['recordId'],
+            'result': 'Ok',
+            'data': data
+        }
+        if partition_keys is not None:
+            output_record['metadata'] = {'partitionKeys': partition_keys[i]}
+        sample = (event_types[i], len(record['data']), len(data), 0, 0, 0)
+        key = event_key(projected[i]) if DEDUP is not None else None
+        processed.append((output_record, sample, key, signals[i] if signals is not None else None,
+                          counts if i == 0 else None))
+    return processed
+
+# Projection plan compiled from the template defined in schema.json. The
+# template is flat, so the plan is the set of keys to keep plus their default
+# values; the event is walked once, descending only into nested objects, and
+# a projected key found deeper in the event (e.g. mail.commonHeaders.subject)
+# overrides one found earlier, exactly like rec_update does.
+class SchemaProjection:
 
-    # update
-    rec_update(template, record)
+    def __init__(self, template):
+        self.template = template
+        self.fields = frozenset(template)
+        # defaults that are lists must not be shared between output records
+        self.mutable_defaults = tuple(
+            (k, _compile_copier(v)) for k, v in template.items() if isinstance(v, (list, dict)))
 
-    return template
+    @classmethod
+    def from_file(cls, schema_file):
+        with open(schema_file) as f:
+            return cls(json.load(f))
+
+    # fields of the template found in the event, without the defaults
+    def collect(self, record):
+        if type(record) is not dict:
+            raise TypeError(f"Expected a JSON object, got {type(record).__name__}")
+        found = {}
+        self._collect(record, found)
+        return found
+
+    def __call__(self, record):
+        if type(record) is not dict:
+            raise TypeError(f"Expected a JSON object, got {type(record).__name__}")
+
+        projected = dict(self.template)
+        self._collect(record, projected)
+
+        template = self.template
+        for k, copier in self.mutable_defaults:
+            if projected[k] is template[k]:
+                projected[k] = copier()
+        return projected
+
+    def _collect(self, node, projected):
+        fields = self.fields
+        for el, value in node.items():
+            if type(value) is dict:
+                self._collect(value, projected)
+            elif el in fields:
+                projected[el] = value
+
+# build a function returning a fresh copy of a JSON default value, so copying
+# it does not go through copy.deepcopy for every record
+def _compile_copier(value):
+    if isinstance(value, list):
+        copiers = [_compile_copier(v) for v in value]
+        return lambda: [c() for c in copiers]
+    if isinstance(value, dict):
+        copiers = [(k, _compile_copier(v)) for k, v in value.items()]
+        return lambda: {k: c() for k, c in copiers}
+    return lambda: value
+
+
+# compiled once per execution environment and reused across warm invocations
+PROJECTION = SchemaProjection.from_file(SCHEMA_FILE)
+
+# serial, thread or process execution of the batch, configured with the
+# PROCESSING_* environment variables and reused across warm invocations
+EXECUTOR = BatchExecutor.from_environment()
+
+# JSON/base64 codec of the Firehose records, selected with JSON_BACKEND
+CODEC = codec_from_environment()
+
+# process each batch in a columnar layout (see ColumnarBatch) instead of one
+# record at a time; PROCESSING_MODE is then not used
+COLUMNAR = os.environ.get('COLUMNAR_ENABLED', 'false').lower() == 'true'
+COLUMNAR_CHUNK_SIZE = int(os.environ.get('COLUMNAR_CHUNK_SIZE', '256'))
+if COLUMNAR_CHUNK_SIZE < 1:
+    raise ValueError("COLUMNAR_CHUNK_SIZE must be at least 1")
+
+# 'nested' writes the projected event as it is, 'flat' writes the rows the
+# DataBrew recipe would produce from it, one JSON document per row
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'nested').lower()
+if OUTPUT_FORMAT not in OUTPUT_FORMATS:
+    raise ValueError(f"Unknown OUTPUT_FORMAT '{OUTPUT_FORMAT}', expected one of {', '.join(OUTPUT_FORMATS)}")
+
+# Firehose rejects a transformation response larger than the Lambda payload
+# limit; the records past MAX_RESPONSE_BYTES are returned as failed
+RESPONSE_SIZE_LIMIT = PAYLOAD_SIZE_LIMIT
+MAX_RESPONSE_BYTES = int(os.environ.get('MAX_RESPONSE_BYTES', RESPONSE_SIZE_LIMIT - 64 * 1024))
+if not 0 < MAX_RESPONSE_BYTES <= RESPONSE_SIZE_LIMIT:
+    raise ValueError(f"MAX_RESPONSE_BYTES must be between 1 and {RESPONSE_SIZE_LIMIT}")
+# bytes around the data in the response as serialized by the Lambda runtime
+# (json.dumps with its default separators): {"records": []} and, per record,
+# {"recordId": "", "result": "ProcessingFailed", "data": ""}, then
+# , "metadata": {"partitionKeys": {}} and "key": "value", per partition key
+RESPONSE_OVERHEAD = 16
+RECORD_OVERHEAD = 64
+PARTITION_KEYS_OVERHEAD = 40
+PARTITION_KEY_OVERHEAD = 10
+
+# keys of the events already returned, kept across warm invocations in a
+# fixed amount of memory, to drop the events published or put more than once
+DEDUP = None
+if os.environ.get('DEDUP_ENABLED', 'false').lower() == 'true':
+    DEDUP = RotatingBloomFilter.from_environment(os.environ)
+
+# sliding window bounce and complaint rates per sender, configuration set and
+# recipient domain, kept across warm invocations and optionally snapshotted
+# to S3 for the next execution environments; breaches are logged and counted
+REPUTATION = None
+REPUTATION_STATE = None
+if os.environ.get('REPUTATION_ENABLED', 'false').lower() == 'true':
+    REPUTATION = ReputationMonitor.from_environment(os.environ)
+    if os.environ.get('REPUTATION_STATE_S3_URI'):
+        REPUTATION_STATE = ReputationState(os.environ['REPUTATION_STATE_S3_URI'],
+                                           interval=int(os.environ.get('REPUTATION_STATE_SECONDS', '60')))
+        REPUTATION_STATE.load(REPUTATION)
+
+# client, operating system, device type and proxy flag parsed from the
+# userAgent of Open and Click events, cached across warm invocations
+USER_AGENTS = None
+if os.environ.get('USER_AGENT_ENABLED', 'false').lower() == 'true':
+    USER_AGENTS = UserAgentEnricher.from_environment(os.environ)
+
+# country, ASN and AS organization of the ipAddress and ses:source-ip of the
+# events, looked up in the memory mapped index built by ses_blog_geoip.py
+GEOIP = None
+if os.environ.get('GEOIP_ENABLED', 'false').lower() == 'true':
+    GEOIP = GeoIpEnricher.from_environment(os.environ)
+
+# keys for Firehose dynamic partitioning, returned only when it is enabled
+PARTITION_KEYS = None
+if os.environ.get('DYNAMIC_PARTITIONING', 'false').lower() == 'true':
+    PARTITION_KEYS = PartitionKeyBuilder.from_environment(os.environ)
+
+# process individual records extracting only the fields listed in the
+# template defined in schema.json
+def process_record(record):
+    return PROJECTION(record)
 
 # recursively update the json template taken as reference (template) with the values
-# extracted from the event passed to the Lambda (record)
+# extracted from the event passed to the Lambda (record). Reference implementation
+# of the projection, kept to check SchemaProjection against.
 def rec_update(template, record):
     if type(record) is not dict:
         template[record] = record
@@ -52,4 +450,4 @@ def rec_update(template, record):
         if type(record[el]) is dict:
             rec_update(template, record[el])
         elif el in template:
-            template[el] = record[el]
\ No newline at end of file
+            template[el] = record[el]
@@ -0,0 +1,103 @@
+import re
+import time
+from functools import lru_cache
+
+HOUR_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2})')
+
+# Layout of the hour partitions under 'partitioned/', the one place it is
+# defined: the dynamic partitioning prefix of the delivery stream writes the
+# values returned by this module, and ses_blog_partitions.py registers the
+# partition locations and builds the partition projection template from it.
+PARTITION_KEYS = ('year', 'month', 'day', 'hour')
+PARTITION_TEMPLATE = '/'.join(f'{k}={{{k}}}' for k in PARTITION_KEYS)
+
+
+# Partition values of an hour, as strings without leading zeros like the
+# partitions of the DataBrew job
+def hour_values(year, month, day, hour):
+    return (str(int(year)), str(int(month)), str(int(day)), str(int(hour)))
+
+
+# 'year=2023/month=1/day=5/hour=10' for the values of an hour
+def partition_path(values):
+    return PARTITION_TEMPLATE.format(**dict(zip(PARTITION_KEYS, values)))
+
+
+# 'YYYY-MM-DDTHH' -> year, month, day and hour partition values. The events
+# of a batch share a handful of hours, so each one is parsed once.
+@lru_cache(maxsize=256)
+def _hour_keys(hour_prefix):
+    match = HOUR_PATTERN.match(hour_prefix)
+    if match is None:
+        return None
+    return hour_values(*match.groups())
+
+
+def _arrival_hour_prefix(arrival_ms):
+    return time.strftime('%Y-%m-%dT%H', time.gmtime(arrival_ms / 1000))
+
+
+# Builds the keys used by Amazon Kinesis Data Firehose dynamic partitioning,
+# returned in the 'metadata.partitionKeys' of each output record: year, month,
+# day and hour of the event timestamp (or of the arrival of the record in
+# Firehose when the event has none), the eventType and, optionally, the SES
+# configuration set the event was published through.
+class PartitionKeyBuilder:
+
+    def __init__(self, include_configuration_set=False):
+        self.include_configuration_set = include_configuration_set
+
+    @classmethod
+    def from_environment(cls, environ):
+        return cls(include_configuration_set=environ.get('PARTITION_BY_CONFIGURATION_SET', 'false').lower() == 'true')
+
+    def __call__(self, payload, projected, record):
+        hour = _hour_keys(str(projected.get('timestamp', ''))[:13])
+        if hour is None:
+            hour = _hour_keys(_arrival_hour_prefix(record.get('approximateArrivalTimestamp') or time.time() * 1000))
+
+        configuration = None
+        if self.include_configuration_set:
+            configuration = configuration_set(payload) or 'unknown'
+        return self._keys(hour, projected.get('eventType') or 'unknown', configuration)
+
+    # Keys of all the records of a ColumnarBatch, None for the failed ones.
+    # Each distinct timestamp hour is parsed once, and the records with the
+    # same keys share one dict.
+    def for_batch(self, batch, records):
+        hours = {}
+        shared = {}
+        keys = []
+        for i, (timestamp, event_type) in enumerate(zip(batch.column('timestamp'), batch.column('eventType'))):
+            if i in batch.failed:
+                keys.append(None)
+                continue
+            prefix = str(timestamp)[:13]
+            hour = hours.get(prefix)
+            if hour is None:
+                hour = hours[prefix] = _hour_keys(prefix) or ()
+            if not hour:
+                arrival = records[i].get('approximateArrivalTimestamp') or time.time() * 1000
+                hour = _hour_keys(_arrival_hour_prefix(arrival))
+            configuration = None
+            if self.include_configuration_set:
+                configuration = configuration_set(batch.payloads[i]) or 'unknown'
+            combination = (hour, event_type or 'unknown', configuration)
+            record_keys = shared.get(combination)
+            if record_keys is None:
+                record_keys = shared[combination] = self._keys(*combination)
+            keys.append(record_keys)
+        return keys
+
+    def _keys(self, hour, event_type, configuration):
+        keys = dict(zip(PARTITION_KEYS, hour))
+        keys['eventType'] = event_type
+        if configuration is not None:
+            keys['configurationSet'] = configuration
+        return keys
+
+
+def configuration_set(payload):
+    tags = payload.get('mail', {}).get('tags') or {}
+    values = tags.get('ses:configuration-set')
+    return values[0] if values else None
@@ -0,0 +1,321 @@
+import calendar
+import json
+import logging
+import struct
+import time
+import zlib
+from array import array
+from functools import lru_cache
+
+from flatten import mail_recipient_domain
+from partitioning import configuration_set
+
+logger = logging.getLogger()
+
+# Metrics counted per key, in this order in the ring buffers
+SENDS = 0
+BOUNCES = 1
+COMPLAINTS = 2
+METRICS = 3
+
+DIMENSIONS = ('sender', 'configurationSet', 'recipientDomain')
+# Event types that can have a reputation signal
+SIGNAL_EVENT_TYPES = ('Send', 'Bounce', 'Complaint')
+STATE_VERSION = 1
+# Error codes of a conditional write that lost against a concurrent one
+CONFLICT_ERRORS = ('PreconditionFailed', 'ConditionalRequestConflict')
+
+
+@lru_cache(maxsize=1024)
+def _minute_seconds(minute):
+    return calendar.timegm(time.strptime(minute, '%Y-%m-%dT%H:%M'))
+
+
+# Seconds since the epoch of an SES event timestamp, '2023-01-05T10:15:00.000Z',
+# None when it is missing or malformed. The events of a batch share a handful
+# of minutes, each one is parsed once.
+def event_seconds(timestamp):
+    if type(timestamp) is not str or len(timestamp) < 19 or timestamp[16] != ':':
+        return None
+    try:
+        return _minute_seconds(timestamp[:16]) + int(timestamp[17:19])
+    except ValueError:
+        return None
+
+
+# What the reputation monitor needs from an event, computed next to the
+# projection (possibly in a worker process) and returned with the record:
+# (metric, sender, configuration set, recipient domains, event time). Each recipient
+# counts, like in the SES reputation metrics: the recipients of a Send event,
+# the bounced recipients of a permanent Bounce, the complained recipients of a
+# Complaint. Other events return None.
+def reputation_signal(payload, projected):
+    event_type = projected.get('eventType')
+    if event_type == 'Send':
+        metric = SENDS
+        recipients = projected.get('destination') or ()
+    elif event_type == 'Bounce':
+        if projected.get('bounceType') != 'Permanent':
+            return None
+        metric = BOUNCES
+        recipients = [r.get('emailAddress') for r in projected.get('bouncedRecipients') or () if isinstance(r, dict)]
+    elif event_type == 'Complaint':
+        metric = COMPLAINTS
+        recipients = [r.get('emailAddress') for r in projected.get('complainedRecipients') or () if isinstance(r, dict)]
+    else:
+        return None
+    domains = tuple((mail_recipient_domain(r) if isinstance(r, str) else None) or 'unknown' for r in recipients)
+    if not domains:
+        return None
+    return (metric, projected.get('source') or 'unknown', configuration_set(payload) or 'unknown', domains,
+            event_seconds(projected.get('timestamp')))
+
+
+# Counts of one key over a sliding window of 'buckets' buckets, in a ring
+# buffer of METRICS counters per bucket, with running totals. Adding a count
+# and reading a total are O(1); moving to a new bucket clears the buckets that
+# left the window, which is at most 'buckets' clears per bucket period.
+class SlidingWindow:
+    __slots__ = ('buckets', 'counts', 'totals', 'head', 'alerted')
+
+    def __init__(self, buckets, head, counts=None, alerted=0.0):
+        self.buckets = buckets
+        self.counts = counts if counts is not None else array('I', bytes(4 * buckets * METRICS))
+        self.totals = [sum(self.counts[m::METRICS]) for m in range(METRICS)]
+        self.head = head
+        self.alerted = alerted
+
+    def advance(self, bucket):
+        if bucket <= self.head:
+            return
+        counts = self.counts
+        totals = self.totals
+        for b in range(self.head + 1, min(bucket, self.head + self.buckets) + 1):
+            base = (b % self.buckets) * METRICS
+            for m in range(METRICS):
+                totals[m] -= counts[base + m]
+                counts[base + m] = 0
+        self.head = bucket
+
+    def add(self, bucket, metric, n=1):
+        self.advance(bucket)
+        if bucket <= self.head - self.buckets:
+            return
+        self.counts[(bucket % self.buckets) * METRICS + metric] += n
+        self.totals[metric] += n
+
+    @property
+    def empty(self):
+        return not any(self.totals)
+
+
+# Sliding window bounce and complaint rates per sender, configuration set and
+# recipient domain. Events are counted in the bucket of their timestamp, so
+# the rates don't depend on when Firehose delivers them: an event older than
+# the window is not counted, one dated after the invocation (clock skew)
+# counts in the current bucket. Keys are checked against the thresholds once
+# per batch, only those that received events; a breach is reported again
+# after 'alert_interval' seconds if it lasts. Rates are only computed over at
+# least 'min_sends' recipients. Expired keys are dropped once per window.
+# When 'unsaved' is set, the counts are also added to it, for ReputationState.
+class ReputationMonitor:
+
+    def __init__(self, window_seconds=3600, bucket_seconds=60, bounce_rate=0.05, complaint_rate=0.001,
+                 min_sends=100, alert_interval=900):
+        if bucket_seconds <= 0 or window_seconds < bucket_seconds:
+            raise ValueError("The reputation window must be at least one bucket long")
+        self.bucket_seconds = bucket_seconds
+        self.buckets = int(window_seconds // bucket_seconds)
+        self.bounce_rate = bounce_rate
+        self.complaint_rate = complaint_rate
+        self.min_sends = min_sends
+        self.alert_interval = alert_interval
+        self.windows = {}
+        self.touched = set()
+        self.last_sweep = 0
+        self.unsaved = None
+
+    @classmethod
+    def from_environment(cls, environ):
+        return cls(window_seconds=int(environ.get('REPUTATION_WINDOW_SECONDS', '3600')),
+                   bucket_seconds=int(environ.get('REPUTATION_BUCKET_SECONDS', '60')),
+                   bounce_rate=float(environ.get('REPUTATION_BOUNCE_RATE', '0.05')),
+                   complaint_rate=float(environ.get('REPUTATION_COMPLAINT_RATE', '0.001')),
+                   min_sends=int(environ.get('REPUTATION_MIN_SENDS', '100')),
+                   alert_interval=int(environ.get('REPUTATION_ALERT_INTERVAL_SECONDS', '900')))
+
+    # A monitor with the same settings and no counts
+    def empty_copy(self):
+        return ReputationMonitor(self.buckets * self.bucket_seconds, self.bucket_seconds, self.bounce_rate,
+                                 self.complaint_rate, self.min_sends, self.alert_interval)
+
+    def _window(self, key, bucket):
+        window = self.windows.get(key)
+        if window is None:
+            window = self.windows[key] = SlidingWindow(self.buckets, bucket)
+        self.touched.add(key)
+        return window
+
+    def add(self, signal, now):
+        metric, sender, configuration_set_name, domains, event_time = signal
+        bucket = int(now // self.bucket_seconds)
+        if event_time is not None and event_time < now:
+            event_bucket = int(event_time // self.bucket_seconds)
+            if event_bucket <= bucket - self.buckets:
+                return
+            bucket = event_bucket
+        n = len(domains)
+        self._window((DIMENSIONS[0], sender), bucket).add(bucket, metric, n)
+        self._window((DIMENSIONS[1], configuration_set_name), bucket).add(bucket, metric, n)
+        for domain in domains:
+            self._window((DIMENSIONS[2], domain), bucket).add(bucket, metric, 1)
+        if self.unsaved is not None:
+            self.unsaved.add(signal, now)
+
+    # Adds the counts of a monitor with the same bucket layout, bucket by
+    # bucket; a key keeps the latest of the two alert times
+    def merge(self, other):
+        for key, source in other.windows.items():
+            window = self.windows.get(key)
+            if window is None:
+                window = self.windows[key] = SlidingWindow(self.buckets, source.head)
+            for b in range(source.head - self.buckets + 1, source.head + 1):
+                base = (b % self.buckets) * METRICS
+                for m in range(METRICS):
+                    n = source.counts[base + m]
+                    if n:
+                        window.add(b, m, n)
+            window.alerted = max(window.alerted, source.alerted)
+
+    # Breaches of the keys that received events since the last call
+    def breaches(self, now):
+        bucket = int(now // self.bucket_seconds)
+        found = []
+        for key in self.touched:
+            window = self.windows.get(key)
+            if window is None:
+                continue
+            window.advance(bucket)
+            sends, bounces, complaints = window.totals
+            if sends < self.min_sends or now - window.alerted < self.alert_interval:
+                continue
+            bounce_rate = bounces / sends
+            complaint_rate = complaints / sends
+            if bounce_rate >= self.bounce_rate or complaint_rate >= self.complaint_rate:
+                window.alerted = now
+                found.append({
+                    'dimension': key[0], 'value': key[1],
+                    'windowSeconds': self.buckets * self.bucket_seconds,
+                    'sends': sends, 'bounces': bounces, 'complaints': complaints,
+                    'bounceRate': round(bounce_rate, 6), 'complaintRate': round(complaint_rate, 6)})
+        self.touched.clear()
+        if bucket - self.last_sweep >= self.buckets:
+            self.sweep(bucket)
+        return found
+
+    def sweep(self, bucket):
+        for key in [k for k, w in self.windows.items() if w.head <= bucket - self.buckets]:
+            del self.windows[key]
+        self.last_sweep = bucket
+
+    # Compact snapshot: a JSON header with the keys, then the ring buffers of
+    # all the keys, compressed together
+    def to_bytes(self):
+        keys = list(self.windows)
+        header = json.dumps({
+            'version': STATE_VERSION, 'bucketSeconds': self.bucket_seconds, 'buckets': self.buckets,
+            'keys': [[k[0], k[1], self.windows[k].head, self.windows[k].alerted] for k in keys]}).encode('utf-8')
+        body = b''.join(self.windows[k].counts.tobytes() for k in keys)
+        return zlib.compress(struct.pack('<I', len(header)) + header + body)
+
+    # Restores a snapshot taken with the same bucket layout, ignored otherwise
+    def load_bytes(self, data):
+        data = zlib.decompress(data)
+        size = struct.unpack_from('<I', data)[0]
+        header = json.loads(data[4:4 + size])
+        if header.get('version') != STATE_VERSION or header['bucketSeconds'] != self.bucket_seconds or \
+                header['buckets'] != self.buckets:
+            return False
+        stride = 4 * self.buckets * METRICS
+        offset = 4 + size
+        for dimension, value, head, alerted in header['keys']:
+            counts = array('I')
+            counts.frombytes(data[offset:offset + stride])
+            offset += stride
+            self.windows[(dimension, value)] = SlidingWindow(self.buckets, head, counts, alerted)
+        return True
+
+
+# Counts of a monitor shared through an S3 object by the concurrent execution
+# environments: read on cold start, then at most every 'interval' seconds the
+# counts added since the previous save are merged into the object with a read,
+# merge and conditional write on its ETag, retried up to 'attempts' times when
+# another environment wrote it in between. The monitor then takes the merged
+# counts, those of all the environments. Conditional writes need a boto3 with
+# the IfMatch and IfNoneMatch parameters of PutObject. Errors are logged,
+# never raised.
+class ReputationState:
+
+    def __init__(self, uri, interval=60, attempts=3):
+        bucket, _, key = uri[len('s3://'):].partition('/')
+        self.bucket = bucket
+        self.key = key
+        self.interval = interval
+        self.attempts = attempts
+        self.last_save = 0.0
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('s3')
+        return self._client
+
+    # Loads the shared counts into 'monitor' and starts tracking the counts
+    # it adds
+    def load(self, monitor):
+        monitor.unsaved = monitor.empty_copy()
+        try:
+            data = self.client.get_object(Bucket=self.bucket, Key=self.key)['Body'].read()
+            return monitor.load_bytes(data)
+        except Exception as e:
+            logger.warning(json.dumps({'message': 'Reputation state not loaded', 'error': str(e)[:500]}))
+            return False
+
+    def maybe_save(self, monitor, now):
+        if now - self.last_save < self.interval or monitor.unsaved is None:
+            return False
+        self.last_save = now
+        try:
+            for _ in range(self.attempts):
+                if self._merge(monitor, now):
+                    return True
+            logger.warning(json.dumps({'message': 'Reputation state not saved',
+                                       'error': f'{self.attempts} concurrent updates'}))
+        except Exception as e:
+            logger.warning(json.dumps({'message': 'Reputation state not saved', 'error': str(e)[:500]}))
+        return False
+
+    def _merge(self, monitor, now):
+        merged = monitor.empty_copy()
+        condition = {'IfNoneMatch': '*'}
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key)
+        except self.client.exceptions.NoSuchKey:
+            pass
+        else:
+            # a snapshot of another bucket layout is replaced
+            merged.load_bytes(response['Body'].read())
+            condition = {'IfMatch': response['ETag']}
+        merged.merge(monitor.unsaved)
+        merged.sweep(int(now // merged.bucket_seconds))
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=merged.to_bytes(), **condition)
+        except Exception as e:
+            if getattr(e, 'response', {}).get('Error', {}).get('Code') in CONFLICT_ERRORS:
+                return False
+            raise
+        monitor.windows = merged.windows
+        monitor.unsaved = monitor.empty_copy()
+        return True
@@ -13,23 +13,45 @@ This script takes three parameters, in this exact order:
 
 The resources copied are:
 - AWS CloudFormation template;
-- AWS Lambda functions code;
+- AWS Lambda functions code: the transformation function, and the partition registration
+  function built from 'ses_blog_partitions.py';
 - Amazon QuickSight dashboard definition;
 - AWS Glue DataBrew recipe;
 - Python script to create the Amazon QuickSight resources.
+
+The AWS Lambda function code is zipped in memory, with fixed timestamps and permissions, so the
+same code always gives the same archive. Each object stores the SHA-256 of its content in its
+metadata: objects whose content did not change are not uploaded again, which makes running the
+script again, for instance for several accounts and regions, cheap. The other objects are
+uploaded in parallel, with multipart uploads for large ones.
 """
 
 import boto3
+import hashlib
+import io
 import logging
-import shutil
 import os
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
 from boto3 import Session
+from boto3.s3.transfer import TransferConfig
 import zipfile
 import argparse
 
 logging.basicConfig(level=logging.INFO)
 
+RESOURCES_DIR = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_CODE_DIR = os.path.join(RESOURCES_DIR, "..", "TransformationLambdaCode")
+LAMBDA_CODE_KEY = "TransformationLambdaCode.zip"
+PARTITION_CODE_KEY = "PartitionLambdaCode.zip"
+# Modules of the partition registration function, relative to the resources directory
+PARTITION_CODE_FILES = ("ses_blog_partitions.py", "ses_blog_storage.py",
+                        os.path.join("..", "TransformationLambdaCode", "partitioning.py"))
+RESOURCE_FILES = ("cfn.yaml", "recipe.json", "dashboard_definition.json",
+                  "ses-blog-utils.py", "ses_blog_quicksight.py")
+HASH_METADATA = "sha256"
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
                     prog='ses-blog-setup',
@@ -39,6 +61,8 @@ def parse_arguments():
     parser.add_argument('-a', '--account-id', required=True, metavar='', help="AWS Account ID")
     parser.add_argument('-r', '--region', required=True, metavar='', help="AWS Region")
     parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--max-workers', type=int, default=8, metavar='', help="Objects uploaded concurrently")
+    parser.add_argument('--force', action='store_true', help="Upload every object, even when it is unchanged")
     args = parser.parse_args()
     
     return args
@@ -48,7 +72,7 @@ def create_bucket(s3_client, bucket_name, region):
 
     :param bucket_name: Bucket to create
     :param region: String region to create bucket in, e.g., 'eu-west-1'
-    :return: S3 bucket URL if bucket created, else None
+    :return: S3 bucket URL if bucket created, else None if it already exists
     """
     
     # Create bucket
@@ -61,55 +85,124 @@ def create_bucket(s3_client, bucket_name, region):
                                     CreateBucketConfiguration=location)
             
     except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'BucketAlreadyOwnedByYou':
+            logging.info(f"S3 bucket {bucket_name} already exists.")
+            return None
         logging.error(e)
+        raise
         
     return response['Location']
 
-def check_files():
-    directory = os.getcwd()  # Get the current directory
-    file1 = "schema.json"  # Specify the first file name
-    file2 = "index.py"  # Specify the second file name
-
-    files = os.listdir(directory)  # Get all files in the directory
-
-    if file1 in files and file2 in files:
-        return True
-    else:
-        return False
-
-def upload_resources(s3_client, folder_name, key, dest_bucket):
+def check_files(directory):
+    """Check that a directory contains the AWS Lambda function code
 
-    file1 = "schema.json"  # Specify the first file name
-    file2 = "index.py"  # Specify the second file name
+    :param directory: Directory to check
+    :return: True if it contains 'index.py' and 'schema.json'
+    """
+    files = os.listdir(directory)
+    return "schema.json" in files and "index.py" in files
 
-    output_filename = "temp"
-    file_format = "zip"
+def lambda_code_files(folder_name):
+    """List the files of the AWS Lambda function code: its Python modules, 'schema.json'
+    and the IP range index 'geoip.idx' when it was built there
 
-    try:
-        # zip folder
-
-        file_in_root = check_files()
+    :param folder_name: Directory of the code
+    :return: Sorted names of the files
+    """
+    if not check_files(folder_name):
+        raise FileNotFoundError(f"'index.py' or 'schema.json' missing from {folder_name}")
+    return sorted(name for name in os.listdir(folder_name)
+                  if (name.endswith(".py") or name in ("schema.json", "geoip.idx"))
+                  and os.path.isfile(os.path.join(folder_name, name)))
+
+def build_zip(paths):
+    """Zip files in memory, at the root of the archive. The entries are sorted and have
+    fixed timestamps and permissions, so identical code gives identical bytes.
+
+    :param paths: Paths of the files
+    :return: The bytes of the archive
+    """
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zipf:
+        for path in sorted(paths, key=os.path.basename):
+            info = zipfile.ZipInfo(os.path.basename(path), date_time=ZIP_DATE_TIME)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(path, 'rb') as f:
+                zipf.writestr(info, f.read(), compresslevel=9)
+    return buffer.getvalue()
+
+def build_lambda_zip(folder_name):
+    """Zip the AWS Lambda function code in memory
+
+    :param folder_name: Directory of the code
+    :return: The bytes of the archive
+    """
+    return build_zip(os.path.join(folder_name, name) for name in lambda_code_files(folder_name))
 
-        if file_in_root:
+def build_partition_zip(resources_dir=RESOURCES_DIR):
+    """Zip the code of the partition registration AWS Lambda function in memory
 
-            with zipfile.ZipFile(f"{output_filename}.{file_format}", 'w') as zipf:
-                zipf.write(file1)
-                zipf.write(file2)
-        else:
-            shutil.make_archive(output_filename, file_format, folder_name)
+    :param resources_dir: Directory of the resources
+    :return: The bytes of the archive
+    """
+    return build_zip(os.path.join(resources_dir, name) for name in PARTITION_CODE_FILES)
 
-        # upload zipped folder
-        s3_client.upload_file(
-            Filename = ".".join([output_filename, file_format]),
-            Bucket = dest_bucket,
-            Key = key
-        )
+def collect_resources(folder_name, resources_dir=RESOURCES_DIR):
+    """Read the objects to upload
 
-        # delete zipped folder
-        os.remove(".".join([output_filename, file_format]))
-        
-    except Exception as e:
-        logging.error(e)
+    :param folder_name: Directory of the AWS Lambda function code
+    :param resources_dir: Directory of the other resources
+    :return: Dictionary of the object contents by key
+    """
+    resources = {LAMBDA_CODE_KEY: build_lambda_zip(folder_name),
+                 PARTITION_CODE_KEY: build_partition_zip(resources_dir)}
+    for name in RESOURCE_FILES:
+        with open(os.path.join(resources_dir, name), 'rb') as f:
+            resources[name] = f.read()
+    return resources
+
+def upload_resource(s3_client, dest_bucket, key, data, transfer_config, force=False):
+    """Upload an object, unless the bucket already has it with the same content
+
+    :param key: Key of the object
+    :param data: Content of the object
+    :param transfer_config: TransferConfig of the upload, multipart above its threshold
+    :param force: Upload even when the content is unchanged
+    :return: True if the object was uploaded
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    if not force:
+        try:
+            current = s3_client.head_object(Bucket=dest_bucket, Key=key)
+            if current.get('Metadata', {}).get(HASH_METADATA) == digest:
+                logging.info(f"{key} is unchanged.")
+                return False
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                raise
+
+    s3_client.upload_fileobj(
+        io.BytesIO(data), dest_bucket, key,
+        ExtraArgs={'Metadata': {HASH_METADATA: digest}},
+        Config=transfer_config
+    )
+    logging.info(f"{key} uploaded ({len(data)} bytes).")
+    return True
+
+def upload_resources(s3_client, folder_name, dest_bucket, max_workers=8, force=False):
+    """Upload the resources in parallel
+
+    :param folder_name: Directory of the AWS Lambda function code
+    :param dest_bucket: Bucket of the resources
+    :return: Keys of the objects uploaded
+    """
+    resources = collect_resources(folder_name)
+    transfer_config = TransferConfig(multipart_threshold=8 * 1024 * 1024, max_concurrency=4)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {key: pool.submit(upload_resource, s3_client, dest_bucket, key, data, transfer_config, force)
+                   for key, data in resources.items()}
+    return [key for key, future in futures.items() if future.result()]
 
 
 
@@ -131,21 +224,21 @@ def main(args):
             f"Input parameters: account id {account_id}, region '{region}', profile 'default'.")
 
 
-    folder_name = "../TransformationLambdaCode"
-    key = "TransformationLambdaCode.zip"
+    folder_name = os.getcwd() if check_files(os.getcwd()) else LAMBDA_CODE_DIR
     s3_client = aws_session.client('s3', region_name=region)
 
     # create bucket
     dest_bucket = f"{account_id}-{region}-ses-blog-utils-bucket"
     destination_bucket = create_bucket(s3_client, dest_bucket, region)
-    logging.info(f"S3 bucket created: {destination_bucket}")
+    if destination_bucket:
+        logging.info(f"S3 bucket created: {destination_bucket}")
         
     # copy resources to the bucket
-    upload_resources(s3_client, folder_name, key, dest_bucket)
-    logging.info("Object successflly copied to the new bucket.")
+    uploaded = upload_resources(s3_client, folder_name, dest_bucket, args.max_workers, args.force)
+    logging.info(f"{len(uploaded)} objects copied to the bucket, the others were unchanged.")
 
     logging.info("Next step: deploy the CloudFormation template from the AWS console.")
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main(args)
\ No newline at end of file
+    main(args)
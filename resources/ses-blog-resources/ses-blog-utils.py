@@ -11,19 +11,22 @@ This script takes three parameters, in this exact order:
     - the AWS region where the resources will be deployed;
     - (optional) an AWS CLI credentials profile. 
 
+The resources are provisioned by 'ses_blog_quicksight.py': independent resources are created
+concurrently, and resources that already exist are updated, so the script can be run again.
+
 This script requires:
     - an Amazon QuickSight Admin user in the same AWS Region where the resources will be created;
     - 'boto3' version 1.26.37 to work. Required Amazon QuickSight APIs might be missing in other boto3 versions.
 """
 
-import json
 import boto3
 import logging
-import uuid
-import time
 from boto3 import Session
+from botocore.config import Config
 import argparse
 
+from ses_blog_quicksight import DashboardTemplate, QuickSightProvisioner, Step, load_tenants, run_steps
+
 logging.basicConfig(level=logging.INFO)
 
 def parse_arguments():
@@ -35,68 +38,77 @@ def parse_arguments():
     parser.add_argument('-a', '--account-id', required=True, metavar='', help="AWS Account ID")
     parser.add_argument('-r', '--region', required=True, metavar='', help="AWS Region")
     parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--rollups', action='store_true', help="Also create the dataset of the hourly rollups")
+    parser.add_argument('--typed-columns', action='store_true', help="The partitioned table stores timestamps as timestamps")
+    parser.add_argument('--user-agent-columns', action='store_true', help="The partitioned table has the columns parsed from the user agents")
+    parser.add_argument('--geoip-columns', action='store_true', help="The partitioned table has the country and ASN columns of the IP addresses")
+    parser.add_argument('-u', '--user', metavar='', help="Amazon QuickSight user name (default: the first ADMIN user)")
+    parser.add_argument('--timeout', type=int, default=600, metavar='', help="Seconds to wait for each resource")
+    parser.add_argument('--max-workers', type=int, default=4, metavar='', help="Resources provisioned concurrently")
+    parser.add_argument('--tenants', metavar='', help="JSON file of tenants, one dashboard each instead of the default one")
     args = parser.parse_args()
     
     return args
 
-def get_quicksight_user(client, account_id, namespace) -> str:
+def get_quicksight_user(provisioner, namespace, user_name=None) -> str:
     """
-    Gets default Amazon QuickSight user ARN that has permissions to perform
-    the required actions in the next steps.
+    Gets the Amazon QuickSight user ARN that has permissions to perform the
+    required actions in the next steps: the user named 'user_name' or, by
+    default, the first ADMIN user. All the pages of users are read.
 
     Parameters
     ----------
-    client : botocore.client.QuickSight
-        The boto3 client for Amazon QuickSight
-    account_id : str
-        The AWS account ID where the resources will be created
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
     namespace : str
         The Amazon QuickSight namespace
+    user_name : str
+        The Amazon QuickSight user name
         
     Returns
     -------
     str
-        The Amazon QuickSight default user ARN
+        The Amazon QuickSight user ARN
     """
-    response = client.list_users(
-        AwsAccountId=account_id,
-        Namespace=namespace
-    )
     logging.info("Getting Amazon QuickSight user ...")
-    logging.info(response)
-    user_arn = response["UserList"][0]["Arn"]
+    user_arn = provisioner.find_user(namespace, user_name)
+    logging.info(user_arn)
     return user_arn
 
 
-def create_data_source(client, account_id, quicksight_user, data_source_id, data_source_name, workgroup_name) -> None:
+def create_data_source(provisioner, quicksight_user, data_source_id, data_source_name, workgroup_name) -> str:
     """
-    Creates an Amazon Athena data source in Amazon QuickSight
+    Creates an Amazon Athena data source in Amazon QuickSight, or updates it if it
+    exists, and waits until it is available.
 
     Parameters
     ----------
-    client : botocore.client.QuickSight
-        The boto3 client for Amazon QuickSight
-    account_id : str
-        The AWS account ID where the resources will be created
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
     quicksight_user : str
         The Amazon QuickSight user ARN obtained from the 'get_quicksight_user' method
     data_source_id : str
         Amazon QuickSight data source identifier
     data_source_name : str
         Amazon QuickSight data source name
+    workgroup_name : str
+        Amazon Athena workgroup name
+
+    Returns
+    -------
+    str
+        The data source ARN
     """
 
-    logging.info("Creating Amazon QuickSight data source ...")
-    data_source = client.create_data_source(
-        AwsAccountId=account_id,
-        DataSourceId=data_source_id,
-        Name=data_source_name,
-        Type="ATHENA",
-        DataSourceParameters={
+    data_source_arn = provisioner.upsert_data_source(
+        data_source_id,
+        data_source_name,
+        "ATHENA",
+        {
             "AthenaParameters": {
                 "WorkGroup": workgroup_name
             }},
-        Permissions=[
+        [
             {
                 "Principal": quicksight_user,
                 "Actions": [
@@ -110,40 +122,91 @@ def create_data_source(client, account_id, quicksight_user, data_source_id, data
             }
         ]
     )
-    logging.info(data_source)
+    logging.info(data_source_arn)
+    return data_source_arn
 
 
-def create_dataset(client, account_id, region, data_source_id, quicksight_user, dataset_id, dataset_name) -> None:
+def create_dataset(provisioner, data_source_arn, quicksight_user, dataset_id, dataset_name, typed_columns=False,
+                   user_agent_columns=False, geoip_columns=False) -> str:
     """
     Creates an Amazon QuickSight dataset based on an Amazon QuickSight data source
-    created by the 'create_data_source' method. 
+    created by the 'create_data_source' method, or updates it if it exists. 
+
+    By default the 'timestamp' and 'expirationtime' columns are strings, as written by the
+    AWS Glue DataBrew job, and the dataset casts them to dates. With 'typed_columns', they
+    are read as the timestamps written by 'ses_blog_recipe.py', with no cast, so time
+    filters are pushed down to Amazon Athena.
+
+    With 'user_agent_columns', the dataset also has the columns parsed from the user agent
+    of Open and Click events by the transformation Lambda function ('USER_AGENT_ENABLED'),
+    and with 'geoip_columns' the country, ASN and AS organization of the IP addresses
+    ('GEOIP_ENABLED').
 
     Parameters
     ----------
-    client : botocore.client.QuickSight
-        The boto3 client for Amazon QuickSight
-    account_id : str
-        The AWS account ID where the resources will be created
-    region : str
-        AWS Region where the resources will be created
-    data_source_id : str
-        Amazon QuickSight data source identifier
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
+    data_source_arn : str
+        Amazon QuickSight data source ARN
     quicksight_user : str
         The Amazon QuickSight user ARN obtained from the 'get_quicksight_user' method
     dataset_id : str
         Amazon QuickSight dataset identifier
     dataset_name : str
         Amazon QuickSight dataset name
+    typed_columns : bool
+        True if the table stores 'timestamp' and 'expirationtime' as timestamps
+    user_agent_columns : bool
+        True if the table has the 'useragentclient', 'useragentos', 'useragentdevice' and
+        'useragentproxy' columns
+    geoip_columns : bool
+        True if the table has the 'ipcountry', 'ipasn', 'ipasnorg', 'sessourceipcountry',
+        'sessourceipasn' and 'sessourceipasnorg' columns
+
+    Returns
+    -------
+    str
+        The dataset ARN
     """    
-    logging.info("Creating Amazon QuickSight dataset ...")
-    dataset = client.create_data_set(
-        AwsAccountId=account_id,
-        DataSetId=dataset_id,
-        Name=dataset_name,
-        PhysicalTableMap={
+    date_type = "DATETIME" if typed_columns else "STRING"
+    user_agent_inputs = [
+        {"Name": "useragentclient", "Type": "STRING"},
+        {"Name": "useragentos", "Type": "STRING"},
+        {"Name": "useragentdevice", "Type": "STRING"},
+        {"Name": "useragentproxy", "Type": "BOOLEAN" if typed_columns else "STRING"},
+    ] if user_agent_columns else []
+    asn_type = "INTEGER" if typed_columns else "STRING"
+    geoip_inputs = [
+        {"Name": "ipcountry", "Type": "STRING"},
+        {"Name": "ipasn", "Type": asn_type},
+        {"Name": "ipasnorg", "Type": "STRING"},
+        {"Name": "sessourceipcountry", "Type": "STRING"},
+        {"Name": "sessourceipasn", "Type": asn_type},
+        {"Name": "sessourceipasnorg", "Type": "STRING"},
+    ] if geoip_columns else []
+    casts = [] if typed_columns else [
+        {
+            "CastColumnTypeOperation": {
+                "ColumnName": "expirationtime",
+                "NewColumnType": "DATETIME",
+                "Format": "yyyy-MM-dd'T'HH:mm:ss.SSSSZ"
+            }
+        },
+        {
+            "CastColumnTypeOperation": {
+                "ColumnName": "timestamp",
+                "NewColumnType": "DATETIME",
+                "Format": "yyyy-MM-dd'T'HH:mm:ss.SSSSZ"
+            }
+        }
+    ]
+    dataset_arn = provisioner.upsert_data_set(
+        dataset_id,
+        dataset_name,
+        {
             "57daf616-4a5d-4014-8e17-a0324e2c2940": {
                 "RelationalTable": {
-                    "DataSourceArn": f"arn:aws:quicksight:{region}:{account_id}:datasource/{data_source_id}",
+                    "DataSourceArn": data_source_arn,
                     "Catalog": "AwsDataCatalog",
                     "Schema": "ses_event_data_database",
                     "Name": "partitioned",
@@ -170,7 +233,7 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
                         },
                         {
                             "Name": "expirationtime",
-                            "Type": "STRING"
+                            "Type": date_type
                         },
                         {
                             "Name": "feedbackid",
@@ -210,7 +273,7 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
                         },
                         {
                             "Name": "timestamp",
-                            "Type": "STRING"
+                            "Type": date_type
                         },
                         {
                             "Name": "ipaddress",
@@ -253,28 +316,14 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
                             "Type": "STRING"
                         },
 
-                    ]
+                    ] + user_agent_inputs + geoip_inputs
                 }
             }
         },
-        LogicalTableMap={
+        {
             "57daf616-4a5d-4014-8e17-a0324e2c2940": {
                 "Alias": "partitioned",
-                "DataTransforms": [
-                    {
-                        "CastColumnTypeOperation": {
-                            "ColumnName": "expirationtime",
-                            "NewColumnType": "DATETIME",
-                            "Format": "yyyy-MM-dd'T'HH:mm:ss.SSSSZ"
-                        }
-                    },
-                    {
-                        "CastColumnTypeOperation": {
-                            "ColumnName": "timestamp",
-                            "NewColumnType": "DATETIME",
-                            "Format": "yyyy-MM-dd'T'HH:mm:ss.SSSSZ"
-                        }
-                    },
+                "DataTransforms": casts + [
                     {
                         "ProjectOperation": {
                             "ProjectedColumns": [
@@ -303,7 +352,7 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
                                 "month",
                                 "day",
                                 "hour"
-                            ]
+                            ] + [c["Name"] for c in user_agent_inputs + geoip_inputs]
                         }
                     }
                 ],
@@ -312,8 +361,8 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
                 }
             }
         },
-        ImportMode="DIRECT_QUERY",
-        Permissions=[
+        "DIRECT_QUERY",
+        [
             {
                 "Principal": quicksight_user,
                 "Actions": [
@@ -331,25 +380,135 @@ def create_dataset(client, account_id, region, data_source_id, quicksight_user,
             }
         ]
     )
-    logging.info(dataset)
+    logging.info(dataset_arn)
+    return dataset_arn
 
-def get_dashboard_definition(region, account_id, dataset_id, template_file) -> dict:
+def create_rollup_dataset(provisioner, data_source_arn, quicksight_user, dataset_id, dataset_name) -> str:
     """
-    Reads the JSON file named as the 'template_file' parameter, updates the 
-    DataSetArn attribute and returns it. 
+    Creates an Amazon QuickSight dataset over the 'hourly_rollups' table, written by
+    'ses_blog_rollup.py', based on the Amazon QuickSight data source created by the
+    'create_data_source' method, or updates it if it exists. Summary visuals built on it sum the 'events' column
+    instead of counting the rows of the 'partitioned' table.
 
     Parameters
     ----------
-    client : botocore.client.QuickSight
-        The boto3 client for Amazon QuickSight
-    account_id : str
-        The AWS account ID where the resources will be created
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
+    data_source_arn : str
+        Amazon QuickSight data source ARN
     quicksight_user : str
         The Amazon QuickSight user ARN obtained from the 'get_quicksight_user' method
-    data_source_id : str
-        Amazon QuickSight data source identifier
-    data_source_name : str
-        Amazon QuickSight data source name
+    dataset_id : str
+        Amazon QuickSight dataset identifier
+    dataset_name : str
+        Amazon QuickSight dataset name
+
+    Returns
+    -------
+    str
+        The dataset ARN
+    """
+    dataset_arn = provisioner.upsert_data_set(
+        dataset_id,
+        dataset_name,
+        {
+            "b3c1f2a4-6d0e-4c8b-9a57-1e2f3d4c5b6a": {
+                "RelationalTable": {
+                    "DataSourceArn": data_source_arn,
+                    "Catalog": "AwsDataCatalog",
+                    "Schema": "ses_event_data_database",
+                    "Name": "hourly_rollups",
+                    "InputColumns": [
+                        {
+                            "Name": "hour_start",
+                            "Type": "DATETIME"
+                        },
+                        {
+                            "Name": "eventtype",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "sender",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "templatename",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "mailrecipientdomain",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "events",
+                            "Type": "INTEGER"
+                        },
+                        {
+                            "Name": "year",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "month",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "day",
+                            "Type": "STRING"
+                        },
+                        {
+                            "Name": "hour",
+                            "Type": "STRING"
+                        }
+                    ]
+                }
+            }
+        },
+        {
+            "b3c1f2a4-6d0e-4c8b-9a57-1e2f3d4c5b6a": {
+                "Alias": "hourly_rollups",
+                "Source": {
+                    "PhysicalTableId": "b3c1f2a4-6d0e-4c8b-9a57-1e2f3d4c5b6a"
+                }
+            }
+        },
+        "DIRECT_QUERY",
+        [
+            {
+                "Principal": quicksight_user,
+                "Actions": [
+                    "quicksight:UpdateDataSetPermissions",
+                    "quicksight:DescribeDataSet",
+                    "quicksight:DescribeDataSetPermissions",
+                    "quicksight:PassDataSet",
+                    "quicksight:DescribeIngestion",
+                    "quicksight:ListIngestions",
+                    "quicksight:UpdateDataSet",
+                    "quicksight:DeleteDataSet",
+                    "quicksight:CreateIngestion",
+                    "quicksight:CancelIngestion"
+                ]
+            }
+        ]
+    )
+    logging.info(dataset_arn)
+    return dataset_arn
+
+def get_dashboard_definition(dataset_arn, template_file, filters=None, tenant_id=None) -> dict:
+    """
+    Renders the dashboard definition of the JSON file named as the 'template_file'
+    parameter for the dataset 'dataset_arn'. The file is parsed once, and the
+    definitions rendered from it share their unchanged parts.
+
+    Parameters
+    ----------
+    dataset_arn : str
+        Amazon QuickSight dataset ARN
+    template_file : str
+        The name of an external JSON file that contains the dashboard definition
+    filters : dict
+        Default filters of the dashboard, the values kept for each column
+    tenant_id : str
+        Identifier of the tenant of the dashboard
         
     Returns
     -------
@@ -357,46 +516,48 @@ def get_dashboard_definition(region, account_id, dataset_id, template_file) -> d
         Description of the components to create an Amazon QuickSight dashboard
     """
     
-    f = open(template_file)
-    dd = json.load(f)
-    dd['DataSetIdentifierDeclarations'][0][
-        'DataSetArn'] = f"arn:aws:quicksight:{region}:{account_id}:dataset/{dataset_id}"
-    f.close()
-    return dd
-
-def create_dashboard(client, account_id, region, quicksight_user, dataset_id, dashboard_id, dashboard_name, template_file) -> None:
+    template = DashboardTemplate.from_file(template_file)
+    return template.render(dataset_arn, filters=filters, tenant_id=tenant_id)
+
+def create_dashboard(provisioner, quicksight_user, dataset_arn, dashboard_id, dashboard_name, template_file,
+                     filters=None, tenant_id=None) -> str:
     """
     Creates an Amazon QuickSight dashboard based on the 'template_file' parameter and 
-    filled with data coming from the dataset identified by the 'dataset_id' parameter.
+    filled with data coming from the dataset identified by the 'dataset_arn' parameter.
+    If the dashboard exists, a new version is created and published. Waits until the
+    version is created.
     
     Parameters
     ----------
-    client : botocore.client.QuickSight
-        The boto3 client for Amazon QuickSight
-    account_id : str
-        The AWS account ID where the resources will be created
-    region : str
-        AWS Region where the resources will be created
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
     quicksight_user : str
         The Amazon QuickSight user ARN obtained from the 'get_quicksight_user' method
-    dataset_id : str
-        Amazon QuickSight dataset identifier
+    dataset_arn : str
+        Amazon QuickSight dataset ARN
     dashboard_id : str
         Amazon QuickSight dashboard identifier
     dashboard_name : str
         Amazon QuickSight dashboard name
     template_file : str
         The name of an external JSON file that contains the dashboard definition
+    filters : dict
+        Default filters of the dashboard, the values kept for each column
+    tenant_id : str
+        Identifier of the tenant of the dashboard
+
+    Returns
+    -------
+    str
+        The dashboard ARN
     """
     
-    logging.info("Creating Amazon QuickSight dashboard ...")
-    dashboard_definition = get_dashboard_definition(
-        region, account_id, dataset_id, template_file)
-    dashboard = client.create_dashboard(
-        AwsAccountId=account_id,
-        DashboardId=dashboard_id,
-        Name=dashboard_name,
-        Permissions=[
+    dashboard_definition = get_dashboard_definition(dataset_arn, template_file, filters, tenant_id)
+    dashboard_arn = provisioner.upsert_dashboard(
+        dashboard_id,
+        dashboard_name,
+        dashboard_definition,
+        [
             {
                 "Principal": quicksight_user,
                 "Actions": [
@@ -411,8 +572,7 @@ def create_dashboard(client, account_id, region, quicksight_user, dataset_id, da
                 ]
             }
         ],
-        VersionDescription="1",
-        DashboardPublishOptions={
+        {
             "AdHocFilteringOption": {
                 "AvailabilityStatus": "DISABLED"
             },
@@ -423,28 +583,105 @@ def create_dashboard(client, account_id, region, quicksight_user, dataset_id, da
                 "VisibilityState": "EXPANDED"
             }
         },
-        ThemeArn="arn:aws:quicksight::aws:theme/MIDNIGHT",
-        Definition=dashboard_definition
+        theme_arn="arn:aws:quicksight::aws:theme/MIDNIGHT"
     )
-    
-    # wait for Dashboard to reach the "CREATION_SUCCESSFUL" state
-    if dashboard['CreationStatus'] == 'CREATION_IN_PROGRESS':
-        logging.info("Dashboard creation started. Waiting for the dashboard to be available.")
-        
-        while(True):
-            time.sleep(1)   # wait 1 second 
-            response = client.describe_dashboard(
-                AwsAccountId=account_id,
-                DashboardId=dashboard_id
-            )            
-            status = response['Dashboard']['Version']['Status']
-            if  status == 'CREATION_SUCCESSFUL':
-                logging.info("Dashboard successfully created.")
-                break
-            elif status != 'CREATION_IN_PROGRESS':
-                raise Exception("Dashboard couldn't be created.")
-            
-    logging.info("Dashboard ARN: " + dashboard['Arn'])
+    logging.info("Dashboard ARN: " + dashboard_arn)
+    return dashboard_arn
+
+def provisioning_steps(provisioner, args) -> list:
+    """
+    Returns the steps that provision the Amazon QuickSight resources, with their
+    dependencies: the user, then the data source, then the datasets, which are
+    created concurrently, then the dashboard. With '--tenants', one dashboard is
+    created per tenant instead, and 'run_steps' deploys them 'max_workers' at a time.
+
+    Parameters
+    ----------
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
+    args : argparse.Namespace
+        The command line arguments
+
+    Returns
+    -------
+    list
+        The Step of the provisioning graph
+    """
+    namespace = "default"                                   # Amazon QuickSight namespace
+    data_source_id = "AthenaDataSource"                     # Amazon QuickSight data source id
+    data_source_name = "Athena Data Source"                 # Amazon QuickSight data source name
+    athena_workgroup_name = "SesAthenaWorkgroup"            # Amazon Athena workgroup name, defined in the CloudFormation template
+    dataset_id = "SESEventsPartitioned"                     # Amazon QuickSight dataset id, fixed so that runs update it
+    dataset_name = "partitioned"                            # Amazon QuickSight dataset name
+    rollup_dataset_id = "SESEventsHourlyRollups"            # Amazon QuickSight dataset id of the hourly rollups
+    rollup_dataset_name = "hourly_rollups"                  # Amazon QuickSight dataset name of the hourly rollups
+    dashboard_id = "MySESLogDashboard"                      # Amazon QuickSight dashboard id
+    dashboard_name = "MySESLogDashboard"                    # Amazon QuickSight dashboard name
+    dashboard_template_file = "dashboard_definition.json"   # Amazon QuickSight dashboard template, stored externally as a JSON file
+
+    steps = [
+        Step("user", lambda r: get_quicksight_user(provisioner, namespace, args.user)),
+        Step("data_source", lambda r: create_data_source(
+            provisioner, r["user"], data_source_id, data_source_name, athena_workgroup_name),
+            requires=["user"]),
+        Step("dataset", lambda r: create_dataset(
+            provisioner, r["data_source"], r["user"], dataset_id, dataset_name, args.typed_columns,
+            args.user_agent_columns, args.geoip_columns),
+            requires=["user", "data_source"]),
+    ]
+    if args.tenants:
+        for tenant in load_tenants(args.tenants):
+            steps.append(tenant_dashboard_step(provisioner, tenant, namespace, dashboard_id, dashboard_name,
+                                               dashboard_template_file))
+    else:
+        steps.append(Step("dashboard", lambda r: create_dashboard(
+            provisioner, r["user"], r["dataset"], dashboard_id, dashboard_name, dashboard_template_file),
+            requires=["user", "dataset"]))
+    if args.rollups:
+        steps.append(Step("rollup_dataset", lambda r: create_rollup_dataset(
+            provisioner, r["data_source"], r["user"], rollup_dataset_id, rollup_dataset_name),
+            requires=["user", "data_source"]))
+    return steps
+
+def tenant_dashboard_step(provisioner, tenant, namespace, dashboard_id, dashboard_name, template_file) -> Step:
+    """
+    Returns the step that creates the dashboard of a tenant read by 'load_tenants'. It
+    uses the dataset 'dataset_id' of the tenant, or the 'partitioned' dataset of the
+    'dataset' step, and grants access to the user 'user' of the tenant, or to the
+    default user.
+
+    Parameters
+    ----------
+    provisioner : QuickSightProvisioner
+        The provisioner of the AWS account where the resources will be created
+    tenant : dict
+        The tenant
+    namespace : str
+        The Amazon QuickSight namespace
+    dashboard_id : str
+        Amazon QuickSight dashboard identifier, suffixed with the tenant id by default
+    dashboard_name : str
+        Amazon QuickSight dashboard name, suffixed with the tenant name by default
+    template_file : str
+        The name of an external JSON file that contains the dashboard definition
+
+    Returns
+    -------
+    Step
+        The step named 'dashboard:<tenant id>'
+    """
+    tenant_id = tenant["id"]
+    requires = ["user"] if tenant.get("dataset_id") else ["user", "dataset"]
+
+    def deploy(r):
+        user = get_quicksight_user(provisioner, namespace, tenant["user"]) if tenant.get("user") else r["user"]
+        dataset_arn = provisioner.arn("dataset", tenant["dataset_id"]) if tenant.get("dataset_id") else r["dataset"]
+        return create_dashboard(provisioner, user, dataset_arn,
+                                tenant.get("dashboard_id", f"{dashboard_id}-{tenant_id}"),
+                                tenant.get("dashboard_name", f"{dashboard_name} {tenant.get('name', tenant_id)}"),
+                                template_file, tenant.get("filters"), tenant_id)
+
+    return Step(f"dashboard:{tenant_id}", deploy, requires=requires)
 
 def main(args):
     aws_session = Session
@@ -454,7 +691,7 @@ def main(args):
     if args.profile:
         profile = args.profile
 
-        aws_session = boto3.Session(profile_name=profile)
+        aws_session = boto3.Session(profile_name=profile, region_name=region)
         logging.info(
             f"Input parameters: account id {account_id}, region '{region}', profile '{profile}'."
         )
@@ -466,26 +703,12 @@ def main(args):
             f"Input parameters: account id {account_id}, region '{region}', profile 'default'."
         )
 
-    namespace = "default"                                   # Amazon QuickSight namespace
-    data_source_id = "AthenaDataSource"                     # Amazon QuickSight data source id
-    data_source_name = "Athena Data Source"                 # Amazon QuickSight data source name
-    athena_workgroup_name = "SesAthenaWorkgroup"            # Amazon Athena workgroup name, defined in the CloudFormation template
-    dataset_id = str(uuid.uuid4())                          # Amazon QuickSight dataset id
-    dataset_name = "partitioned"                            # Amazon QuickSight dataset name
-    dashboard_id = "MySESLogDashboard"                      # Amazon QuickSight dashboard id
-    dashboard_name = "MySESLogDashboard"                    # Amazon QuickSight dashboard name
-    dashboard_template_file = "dashboard_definition.json"   # Amazon QuickSight dashboard template, stored externally as a JSON file
-
     try:
-        client = aws_session.client('quicksight')
-        quicksight_user = get_quicksight_user(
-            client, account_id, namespace)
-        create_data_source(client, account_id, quicksight_user,
-                            data_source_id, data_source_name, athena_workgroup_name)
-        create_dataset(client, account_id, region, data_source_id,
-                        quicksight_user, dataset_id, dataset_name)
-        create_dashboard(client, account_id, region, quicksight_user,
-                            dataset_id, dashboard_id, dashboard_name, dashboard_template_file)
+        # Throttled calls of concurrent steps are retried by botocore
+        client = aws_session.client('quicksight', config=Config(retries={"max_attempts": 10, "mode": "adaptive"}))
+        provisioner = QuickSightProvisioner(client, account_id, region, timeout=args.timeout)
+        results = run_steps(provisioning_steps(provisioner, args), max_workers=args.max_workers)
+        logging.info(f"{len(results)} steps completed")
 
     except Exception as e:
         logging.error(e)
@@ -493,4 +716,4 @@ def main(args):
 
 if __name__ == "__main__":
     args = parse_arguments()
-    main(args)
\ No newline at end of file
+    main(args)
@@ -0,0 +1,369 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script reprocesses the events stored under 'raw/' with the current transformation Lambda
+function ('TransformationLambdaCode/'), in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+After a change of 'schema.json' or of the output format, only the new events are written the
+new way. This script replays the history: every raw object (newline-delimited JSON, plain or
+GZIP compressed) is streamed through 'process_record', like the records of a Firehose batch,
+and the results are written as GZIP JSON under '<output prefix>year=/month=/day=/hour=/', the
+layout of Firehose dynamic partitioning, partitioned by the timestamp of the events.
+The replay can only keep the fields present in the raw events.
+
+Objects are replayed by a pool of worker processes, each one reading its object as a stream
+and writing its partitions as soon as they reach '--part-size-mb', so the memory used does not
+depend on the size of the objects. The output keys are derived from the input keys: an object
+replayed twice overwrites its own output. A checkpoint manifest, saved while the replay
+progresses, lists the objects done; an interrupted replay started again skips them. The
+checkpoint is discarded when 'schema.json' or the options that change the output do.
+
+This script requires 'boto3' for S3 locations.
+"""
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from ses_blog_benchmark import LAMBDA_DIR, load_handler
+from ses_blog_storage import open_store
+
+logging.basicConfig(level=logging.INFO)
+
+CHECKPOINT_KEY = "_backfill/checkpoint.json"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-backfill',
+                    description='Reprocesses the raw events with the current transformation Lambda function',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory of the raw events")
+    parser.add_argument('--prefix', default="raw/", metavar='', help="Prefix of the raw events (default: raw/)")
+    parser.add_argument('-o', '--output', metavar='', help="s3://<bucket> or local directory of the output (default: the raw events location)")
+    parser.add_argument('--output-prefix', default="replayed/", metavar='', help="Prefix of the output partitions (default: replayed/)")
+    parser.add_argument('--output-format', default="nested", metavar='', help="Output format of the function (nested, flat)")
+    parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local S3 stand-in")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), metavar='', help="Worker processes")
+    parser.add_argument('--part-size-mb', type=int, default=64, metavar='', help="Uncompressed size of the output objects")
+    parser.add_argument('--checkpoint-seconds', type=float, default=10.0, metavar='', help="Interval between checkpoint saves")
+    parser.add_argument('--report-seconds', type=float, default=10.0, metavar='', help="Interval between progress reports")
+    parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint and replay every object")
+    args = parser.parse_args()
+
+    return args
+
+
+class _RawStream(io.RawIOBase):
+    # Adapts a file-like object that only has read(), like the body of an S3 object, so
+    # that it can be buffered and peeked at
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_lines(body):
+    """
+    Returns an iterator over the lines of a raw object, decompressing it on the fly when it
+    is GZIP compressed (possibly as several concatenated members, like compacted objects).
+    """
+    stream = io.BufferedReader(_RawStream(body), buffer_size=1 << 20)
+    if stream.peek(2)[:2] == b"\x1f\x8b":
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+
+def partition_prefix(keys) -> str:
+    return f"year={keys['year']}/month={keys['month']}/day={keys['day']}/hour={keys['hour']}/"
+
+
+class _PartitionOutput:
+    # GZIP member compressed as the rows are added, written as a part when it is full
+    def __init__(self):
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        self.chunks = []
+        self.size = 0
+        self.rows = 0
+
+    def add(self, data):
+        self.chunks.append(self.compressor.compress(data))
+        self.size += len(data)
+        self.rows += 1
+
+    def finish(self) -> bytes:
+        self.chunks.append(self.compressor.flush())
+        return b"".join(self.chunks)
+
+
+class ReplayWorker:
+    """
+    Replays raw objects through the transformation Lambda function. One instance lives in
+    each worker process.
+
+    Parameters
+    ----------
+    source : LocalStore or S3Store
+        The store of the raw events
+    output : LocalStore or S3Store
+        The store where the partitions are written
+    output_prefix : str
+        Prefix of the output partitions
+    environment : dict
+        Environment variables of the function, such as OUTPUT_FORMAT
+    part_size : int
+        Uncompressed size in bytes after which the output of a partition is written
+    """
+
+    def __init__(self, source, output, output_prefix, environment=None, part_size=64 << 20):
+        index = load_handler(dict(environment or {}, PROCESSING_MODE="serial", METRICS_ENABLED="false"))
+        self.process_record = index.process_record
+        self.flatten_record = index.flatten_record if index.OUTPUT_FORMAT == index.FLAT else None
+        self.partition_keys = index.PartitionKeyBuilder()
+        self.dumps = index.CODEC.json.dumps
+        self.source = source
+        self.output = output
+        self.output_prefix = output_prefix
+        self.part_size = part_size
+
+    def output_key(self, prefix, key, part) -> str:
+        name = key.replace("/", "-")
+        return f"{self.output_prefix}{prefix}{name}-{part:04d}.gz"
+
+    def replay(self, key, arrival_ms) -> dict:
+        """
+        Replays the object 'key' and returns its statistics. Events without a timestamp are
+        partitioned by 'arrival_ms', the time the object was written.
+        """
+        stats = {"key": key, "records": 0, "rows": 0, "failed": 0, "bytes_in": 0, "outputs": 0}
+        outputs = {}
+        parts = {}
+        record = {"approximateArrivalTimestamp": arrival_ms}
+        dumps = self.dumps
+        for line in open_lines(self.source.open(key)):
+            stats["bytes_in"] += len(line)
+            if not line.strip():
+                continue
+            try:
+                event = json.loads(line)
+                projected = self.process_record(event)
+                rows = self.flatten_record(projected) if self.flatten_record else (projected,)
+                prefix = partition_prefix(self.partition_keys(event, projected, record))
+            except Exception as e:
+                stats["failed"] += 1
+                if stats["failed"] <= 3:
+                    logging.warning(f"Couldn't replay a line of {key}: {type(e).__name__}: {e}")
+                continue
+            stats["records"] += 1
+            output = outputs.get(prefix)
+            if output is None:
+                output = outputs[prefix] = _PartitionOutput()
+            for row in rows:
+                output.add(dumps(row) + b"\n")
+                stats["rows"] += 1
+            if output.size >= self.part_size:
+                self._write(prefix, key, parts, outputs.pop(prefix))
+                stats["outputs"] += 1
+        for prefix, output in outputs.items():
+            self._write(prefix, key, parts, output)
+            stats["outputs"] += 1
+        return stats
+
+    def _write(self, prefix, key, parts, output):
+        part = parts.get(prefix, 0)
+        parts[prefix] = part + 1
+        self.output.put(self.output_key(prefix, key, part), output.finish())
+
+
+_WORKER = None
+
+
+def _init_worker(location, output_location, profile, endpoint_url, output_prefix, environment, part_size):
+    global _WORKER
+    session = None
+    if profile:
+        import boto3
+        session = boto3.Session(profile_name=profile)
+    source = open_store(location, session=session, endpoint_url=endpoint_url)
+    output = open_store(output_location, session=session, endpoint_url=endpoint_url)
+    _WORKER = ReplayWorker(source, output, output_prefix, environment, part_size)
+
+
+def _replay(key, arrival_ms) -> dict:
+    return _WORKER.replay(key, arrival_ms)
+
+
+def configuration_fingerprint(environment, output_prefix) -> str:
+    """
+    Returns a digest of what determines the output of a replay: 'schema.json', the
+    environment of the function and the output prefix.
+    """
+    digest = hashlib.sha256()
+    with open(os.path.join(LAMBDA_DIR, "schema.json"), "rb") as f:
+        digest.update(f.read())
+    digest.update(json.dumps([sorted(environment.items()), output_prefix]).encode())
+    return digest.hexdigest()
+
+
+class Backfill:
+    """
+    Replays the raw objects of a store in worker processes, keeping a checkpoint of the
+    objects done in the output store.
+
+    Parameters
+    ----------
+    location : str
+        s3://<bucket> or local directory of the raw events
+    output_location : str
+        s3://<bucket> or local directory of the output
+    output_prefix : str
+        Prefix of the output partitions
+    environment : dict
+        Environment variables of the function
+    workers : int
+        Number of worker processes
+    part_size : int
+        Uncompressed size in bytes of the output objects
+    profile : str
+        AWS credentials profile
+    endpoint_url : str
+        Endpoint of a local S3 stand-in
+    """
+
+    def __init__(self, location, output_location=None, output_prefix="replayed/", environment=None,
+                 workers=None, part_size=64 << 20, profile=None, endpoint_url=None,
+                 checkpoint_seconds=10.0, report_seconds=10.0):
+        self.location = location
+        self.output_location = output_location or location
+        self.output_prefix = output_prefix
+        self.environment = dict(environment or {})
+        self.workers = workers or os.cpu_count()
+        self.part_size = part_size
+        self.profile = profile
+        self.endpoint_url = endpoint_url
+        self.checkpoint_seconds = checkpoint_seconds
+        self.report_seconds = report_seconds
+        session = None
+        if profile:
+            import boto3
+            session = boto3.Session(profile_name=profile)
+        self.source = open_store(location, session=session, endpoint_url=endpoint_url)
+        self.output = open_store(self.output_location, session=session, endpoint_url=endpoint_url)
+        self.fingerprint = configuration_fingerprint(self.environment, output_prefix)
+
+    def load_checkpoint(self, restart=False) -> dict:
+        """
+        Returns the checkpoint of the previous replay, or a new one if there is none, if it
+        was made with another configuration or if 'restart' is True.
+        """
+        if not restart and self.output.exists(CHECKPOINT_KEY):
+            checkpoint = json.loads(self.output.get(CHECKPOINT_KEY))
+            if checkpoint.get("fingerprint") == self.fingerprint:
+                return checkpoint
+            logging.info("schema.json or the options changed since the last replay, starting over")
+        return {"fingerprint": self.fingerprint, "completed": {}, "records": 0, "failed": 0}
+
+    def save_checkpoint(self, checkpoint):
+        self.output.put(CHECKPOINT_KEY, json.dumps(checkpoint).encode())
+
+    def pending(self, prefix, checkpoint) -> list:
+        """
+        Returns the objects under 'prefix' not replayed yet, or changed since they were.
+        """
+        completed = checkpoint["completed"]
+        objects = []
+        for obj in self.source.list(prefix):
+            name = obj.key.rpartition("/")[2]
+            if name.startswith(("_", ".")) or completed.get(obj.key) == obj.etag:
+                continue
+            objects.append(obj)
+        return objects
+
+    def run(self, prefix="raw/", restart=False) -> dict:
+        """
+        Replays the objects under 'prefix' and returns the checkpoint of the replay.
+        """
+        checkpoint = self.load_checkpoint(restart)
+        objects = self.pending(prefix, checkpoint)
+        total_bytes = sum(o.size for o in objects)
+        logging.info(f"{len(objects)} objects ({total_bytes / 1e6:.1f} MB) to replay, "
+                     f"{len(checkpoint['completed'])} already done")
+        if not objects:
+            return checkpoint
+
+        initargs = (self.location, self.output_location, self.profile, self.endpoint_url,
+                    self.output_prefix, self.environment, self.part_size)
+        queue = list(reversed(objects))
+        sizes = {o.key: o for o in objects}
+        running = {}
+        done_objects = done_bytes = records = 0
+        start = last_report = last_save = time.monotonic()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=initargs) as pool:
+            while queue or running:
+                # At most two objects per worker are queued, the others wait in the list
+                while queue and len(running) < 2 * self.workers:
+                    obj = queue.pop()
+                    arrival_ms = int(obj.last_modified.timestamp() * 1000)
+                    running[pool.submit(_replay, obj.key, arrival_ms)] = obj.key
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key = running.pop(future)
+                    stats = future.result()
+                    checkpoint["completed"][key] = sizes[key].etag
+                    checkpoint["records"] += stats["records"]
+                    checkpoint["failed"] += stats["failed"]
+                    done_objects += 1
+                    done_bytes += sizes[key].size
+                    records += stats["records"]
+
+                now = time.monotonic()
+                if now - last_save >= self.checkpoint_seconds:
+                    self.save_checkpoint(checkpoint)
+                    last_save = now
+                if now - last_report >= self.report_seconds:
+                    self._report(done_objects, len(objects), done_bytes, total_bytes, records, now - start)
+                    last_report = now
+
+        self.save_checkpoint(checkpoint)
+        self._report(done_objects, len(objects), done_bytes, total_bytes, records, time.monotonic() - start)
+        return checkpoint
+
+    def _report(self, done_objects, objects, done_bytes, total_bytes, records, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        rate = done_bytes / elapsed
+        eta = (total_bytes - done_bytes) / rate if rate else float("inf")
+        logging.info(f"{done_objects}/{objects} objects, {records} records, "
+                     f"{records / elapsed:,.0f} records/s, {rate / 1e6:.1f} MB/s, ETA {eta:.0f}s")
+
+
+def main(args):
+    backfill = Backfill(args.location, args.output, args.output_prefix,
+                        environment={"OUTPUT_FORMAT": args.output_format},
+                        workers=args.workers, part_size=args.part_size_mb << 20,
+                        profile=args.profile, endpoint_url=args.endpoint_url,
+                        checkpoint_seconds=args.checkpoint_seconds, report_seconds=args.report_seconds)
+    checkpoint = backfill.run(args.prefix, restart=args.restart)
+    logging.info(f"{len(checkpoint['completed'])} objects and {checkpoint['records']} records replayed "
+                 f"to {backfill.output.location}/{args.output_prefix}, {checkpoint['failed']} lines failed")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
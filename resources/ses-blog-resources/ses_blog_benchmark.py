@@ -0,0 +1,190 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script benchmarks the transformation Lambda function of the solution
+('TransformationLambdaCode/index.py') on synthetic Firehose batches, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+It calls 'lambda_handler' on batches generated by 'ses_blog_events.py' and reports:
+    - the throughput, in records per second;
+    - the p50 and p99 latency of a batch;
+    - the peak memory allocated while processing a batch (measured in a separate pass, as
+      tracing allocations slows the handler down).
+
+Results can be saved as a baseline and later runs compared to it, failing when the
+throughput drops or the latency grows by more than a given percentage.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+from ses_blog_events import SESEventGenerator, firehose_batches, parse_mix
+
+logging.basicConfig(level=logging.INFO)
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TransformationLambdaCode")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-benchmark',
+                    description='Benchmarks the transformation Lambda function on synthetic Firehose batches',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-n', '--count', type=int, default=20000, metavar='', help="Number of events")
+    parser.add_argument('--mix', metavar='', help="Event type weights, e.g. 'Open=50,Click=20,Bounce=5'")
+    parser.add_argument('--fanout', type=int, default=1, metavar='', help="Maximum number of recipients per message")
+    parser.add_argument('--batch-records', type=int, default=500, metavar='', help="Maximum number of records per batch, 0 to fill batches up to 6 MB")
+    parser.add_argument('--repeat', type=int, default=3, metavar='', help="Number of timed passes over the batches")
+    parser.add_argument('--seed', type=int, default=0, metavar='', help="Random seed")
+    parser.add_argument('--json-backend', metavar='', help="JSON backend of the codec (stdlib, orjson)")
+    parser.add_argument('--output-format', metavar='', help="Output format of the function (nested, flat)")
+    parser.add_argument('--mode', metavar='', help="Batch processing mode (serial, thread, process)")
+    parser.add_argument('--workers', type=int, metavar='', help="Workers of the thread or process pool")
+    parser.add_argument('--columnar', action='store_true', help="Process the batches in the columnar layout")
+    parser.add_argument('--legacy-projection', action='store_true', help="Use the per-record schema.json load and rec_update")
+    parser.add_argument('--save-baseline', metavar='', help="Save the results to this file")
+    parser.add_argument('--baseline', metavar='', help="Compare the results to this file")
+    parser.add_argument('--max-regression', type=float, default=10.0, metavar='', help="Tolerated regression against the baseline, in percent")
+    args = parser.parse_args()
+
+    return args
+
+
+def load_handler(environment=None):
+    """
+    Imports the transformation Lambda function module with the given environment variables.
+    """
+    os.environ.update(environment or {})
+    if LAMBDA_DIR not in sys.path:
+        sys.path.insert(0, LAMBDA_DIR)
+    import index
+    return index
+
+
+def legacy_process_record(index):
+    """
+    Returns the projection as it was done before it was compiled: schema.json loaded for
+    every record and applied with rec_update.
+    """
+    def process_record(record):
+        with open(index.SCHEMA_FILE) as f:
+            template = json.load(f)
+        index.rec_update(template, record)
+        return template
+    return process_record
+
+
+def percentile(values, p) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def _copy_batch(batch) -> dict:
+    # lambda_handler updates the dropped records in place
+    return {**batch, "records": [dict(r) for r in batch["records"]]}
+
+
+def run_benchmark(handler, batches, repeat=3) -> dict:
+    """
+    Calls 'handler' on every batch, 'repeat' times, and returns the measured metrics.
+    """
+    records = sum(len(b["records"]) for b in batches)
+    latencies = []
+    total = 0.0
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        handler(_copy_batch(batches[0]), None)      # warm up pools and caches
+        for _ in range(repeat):
+            for batch in batches:
+                batch = _copy_batch(batch)
+                start = time.perf_counter()
+                handler(batch, None)
+                elapsed = time.perf_counter() - start
+                latencies.append(elapsed)
+                total += elapsed
+
+        tracemalloc.start()
+        peak = 0
+        for batch in batches:
+            batch = _copy_batch(batch)
+            tracemalloc.reset_peak()
+            handler(batch, None)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    return {
+        "batches": len(batches),
+        "records": records,
+        "records_per_second": records * repeat / total,
+        "p50_batch_ms": percentile(latencies, 50) * 1000,
+        "p99_batch_ms": percentile(latencies, 99) * 1000,
+        "peak_memory_mb": peak / (1 << 20),
+    }
+
+
+def compare(results, baseline, max_regression) -> list:
+    """
+    Returns the regressions of 'results' against 'baseline' larger than 'max_regression'
+    percent.
+    """
+    regressions = []
+    for metric, higher_is_better in (("records_per_second", True), ("p50_batch_ms", False),
+                                     ("p99_batch_ms", False), ("peak_memory_mb", False)):
+        before, after = baseline[metric], results[metric]
+        change = (after - before) / before * 100 if before else 0.0
+        worse = -change if higher_is_better else change
+        logging.info(f"{metric}: {before:.2f} -> {after:.2f} ({change:+.1f}%)")
+        if worse > max_regression:
+            regressions.append(f"{metric} regressed by {worse:.1f}%")
+    return regressions
+
+
+def main(args):
+    environment = {}
+    if args.json_backend:
+        environment["JSON_BACKEND"] = args.json_backend
+    if args.output_format:
+        environment["OUTPUT_FORMAT"] = args.output_format
+    if args.mode:
+        environment["PROCESSING_MODE"] = args.mode
+    if args.workers:
+        environment["PROCESSING_WORKERS"] = str(args.workers)
+    if args.columnar:
+        environment["COLUMNAR_ENABLED"] = "true"
+    index = load_handler(environment)
+    if args.legacy_projection:
+        index.process_record = legacy_process_record(index)
+
+    generator = SESEventGenerator(mix=parse_mix(args.mix) if args.mix else None, fanout=args.fanout, seed=args.seed)
+    batches = list(firehose_batches(generator.events(args.count), max_records=args.batch_records or None, seed=args.seed))
+    logging.info(f"Benchmarking {args.count} events in {len(batches)} batches ({index.CODEC.name} JSON backend)")
+
+    results = run_benchmark(index.lambda_handler, batches, args.repeat)
+    results["configuration"] = {**environment, "legacy_projection": args.legacy_projection}
+    for metric in ("records_per_second", "p50_batch_ms", "p99_batch_ms", "peak_memory_mb"):
+        logging.info(f"{metric}: {results[metric]:.2f}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logging.info(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            for regression in regressions:
+                logging.error(regression)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,499 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script compacts the small objects of the hour partitions of the 'partitioned' table of
+the AWS Glue Data Catalog, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+Amazon Kinesis Data Firehose writes a new object every buffering interval, so every hour
+partition ends up with dozens of small objects that Amazon Athena has to list and open on
+every query. Once an hour is closed (no more objects are expected for it), this script merges
+its small Parquet objects into Parquet files with large, evenly sized row groups, and its
+small GZIP JSON objects into larger GZIP objects.
+
+Only the bucket the table reads is compacted: the aggregated bucket, or the destination
+bucket when the dynamic partitioning of the transformation Lambda function is enabled. The
+'partitioned/' prefix of the destination bucket is otherwise copied to the aggregated bucket
+by the 'SESPartitionedObjectReplicationFunction', and its 'raw/' prefix is read by the
+'SESDataBrewDataset'; rewriting either would make the downstream copies count events twice.
+
+Compacted objects are never written into the partition prefix. Each compaction publishes a
+new generation of the partition and swaps it with a single UpdatePartition call:
+    1. a manifest stored under '_compaction/manifests/' lists the input objects, in the
+       'staging' state;
+    2. the compacted objects are written under '_compacted/<partition>/<run id>/', outside
+       of the table location, and the large input objects are copied there;
+    3. the manifest moves to the 'publishing' state;
+    4. the location of the partition in the catalog is changed to the new generation: this is
+       the commit point, queries read either all the inputs or all the compacted objects;
+    5. the manifest moves to the 'committed' state. The inputs are retired: they are kept for
+       '--retention-minutes', so queries planned before the swap can still read them, and are
+       deleted by a later run, which moves the manifest to the 'collected' state.
+A run that fails before the commit point leaves the partition untouched and its staged
+objects are discarded by the next run; a run that fails after it is completed by the next
+run. Objects that arrive in a partition after it was compacted are only read by Athena once
+they are compacted into the next generation, which the next run does for every such
+partition. 'live_partitions' gives the other scripts the objects the table reads.
+
+The partitions must not be updated by a crawler, which would point them back to their
+original prefix: the script refuses tables kept up to date by a scheduled crawler, and tables
+that use partition projection, for which Athena ignores the locations of the catalog. Register
+the partitions with 'ses_blog_partitions.py' instead. The script is meant to be run by a
+single scheduler at a time.
+
+A local directory, such as a copy of the bucket or the output of the local tools, has no
+catalog: the partitions under '--prefix' are compacted the same way, and the commit point is
+the manifest moving to the 'committed' state. Only the readers that go through
+'live_partitions', like the other scripts, see the compacted generation.
+
+This script requires 'boto3', and 'pyarrow' to compact Parquet objects.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import boto3
+
+from ses_blog_partitions import DEFAULT_DATABASE, DEFAULT_TABLE, PartitionManager, partition_values
+from ses_blog_storage import open_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO)
+
+MANIFEST_PREFIX = "_compaction/manifests/"
+COMPACTED_PREFIX = "_compacted/"
+
+STAGING = "staging"
+PUBLISHING = "publishing"
+COMMITTED = "committed"
+COLLECTED = "collected"
+
+PARQUET = "parquet"
+JSON = "json"
+
+HOUR_PATTERNS = (
+    re.compile(r"(?:^|/)(\d{4})/(\d{2})/(\d{2})/(\d{2})$"),
+    re.compile(r"(?:^|/)year=(\d{4})/month=(\d{1,2})/day=(\d{1,2})/hour=(\d{1,2})$"),
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-compaction',
+                    description='Compacts the small objects of the closed hour partitions of the partitioned table',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> read by the table, or local directory")
+    parser.add_argument('--prefix', default='partitioned/', metavar='', help="Prefix of the partitions of a local directory")
+    parser.add_argument('--database', default=DEFAULT_DATABASE, metavar='', help="AWS Glue database")
+    parser.add_argument('--table', default=DEFAULT_TABLE, metavar='', help="AWS Glue table")
+    parser.add_argument('-r', '--region', metavar='', help="AWS Region")
+    parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local AWS stand-in")
+    parser.add_argument('--target-file-size-mb', type=int, default=128, metavar='', help="Size of the compacted objects")
+    parser.add_argument('--row-group-size', type=int, default=131072, metavar='', help="Rows per Parquet row group")
+    parser.add_argument('--min-files', type=int, default=2, metavar='', help="Minimum number of small objects to compact a partition")
+    parser.add_argument('--grace-minutes', type=int, default=15, metavar='', help="Delay after the end of an hour before it is closed")
+    parser.add_argument('--retention-minutes', type=int, default=60, metavar='', help="Delay before the compacted objects are deleted")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the partitions that would be compacted")
+    args = parser.parse_args()
+
+    return args
+
+
+def partition_hour(partition):
+    """
+    Returns the hour of a 'YYYY/MM/DD/HH' or 'year=/month=/day=/hour=' partition, or None.
+    """
+    for pattern in HOUR_PATTERNS:
+        match = pattern.search(partition)
+        if match:
+            return datetime(*(int(v) for v in match.groups()), tzinfo=timezone.utc)
+    return None
+
+
+def _manifest_key(partition, run_id) -> str:
+    return f"{MANIFEST_PREFIX}{partition}/{run_id}.json"
+
+
+def _manifests(store, prefix=""):
+    for obj in store.list(f"{MANIFEST_PREFIX}{prefix}"):
+        yield json.loads(store.get(obj.key))
+
+
+def live_partitions(store, prefix) -> dict:
+    """
+    Returns the hour partitions under 'prefix', mapped to the data objects the table reads for
+    them: the objects of the last generation published by a compaction, and the objects of the
+    partition prefix that no compaction retired. Scripts that read the partitions from the
+    bucket rather than through Athena use it, so compacted events are neither missed nor
+    counted twice.
+    """
+    published = {}
+    retired = set()
+    for manifest in _manifests(store, prefix):
+        if manifest["state"] not in (COMMITTED, COLLECTED):
+            continue
+        retired.update(i["key"] for i in manifest["inputs"])
+        current = published.get(manifest["partition"])
+        if current is None or manifest["committed_at"] > current["committed_at"]:
+            published[manifest["partition"]] = manifest
+
+    partitions = {}
+    for obj in store.list(prefix):
+        partition, _, name = obj.key.rpartition("/")
+        if obj.key.startswith("_") or name.startswith(("_", ".")) or obj.key in retired or \
+                partition_hour(partition) is None:
+            continue
+        partitions.setdefault(partition, []).append(obj)
+    for partition, manifest in published.items():
+        partitions.setdefault(partition, []).extend(store.list(manifest["location"]))
+    return partitions
+
+
+class Compactor:
+    """
+    Compacts the closed hour partitions of a table of the AWS Glue Data Catalog.
+
+    Parameters
+    ----------
+    store : S3Store
+        The bucket the table reads
+    catalog : PartitionManager
+        The table, whose partition locations are swapped; None for a local directory, read
+        through 'live_partitions' only
+    target_file_size : int
+        Size in bytes of the compacted objects; objects above half of it are copied as is
+    row_group_size : int
+        Rows per row group of the compacted Parquet objects
+    min_files : int
+        Minimum number of small objects for a partition to be compacted
+    grace : timedelta
+        Delay after the end of an hour before the partition is considered closed
+    retention : timedelta
+        Delay after a swap before the retired objects are deleted
+    compression : str
+        Parquet compression codec
+    prefix : str
+        Prefix of the partitions when there is no catalog
+    """
+
+    def __init__(self, store, catalog, target_file_size=128 << 20, row_group_size=131072, min_files=2,
+                 grace=timedelta(minutes=15), retention=timedelta(hours=1), compression="gzip", now=None,
+                 prefix="partitioned/"):
+        self.store = store
+        self.catalog = catalog
+        self.prefix = prefix
+        self.target_file_size = target_file_size
+        self.row_group_size = row_group_size
+        self.min_files = min_files
+        self.grace = grace
+        self.retention = retention
+        self.compression = compression
+        self.now = now or datetime.now(timezone.utc)
+
+    def table_prefix(self) -> str:
+        """
+        Returns the prefix of the table in the bucket, after checking that the locations of
+        its partitions can be swapped, or 'prefix' when there is no catalog.
+        """
+        if self.catalog is None:
+            return self.prefix.rstrip("/") + "/" if self.prefix else ""
+        table = self.catalog.table
+        name = f"{self.catalog.database}.{self.catalog.table_name}"
+        parameters = table.get("Parameters", {})
+        if parameters.get("projection.enabled", "").lower() == "true":
+            raise ValueError(f"{name} uses partition projection, Athena doesn't read the locations of its partitions")
+        crawler = parameters.get("UPDATED_BY_CRAWLER")
+        if crawler and self._is_scheduled(crawler):
+            raise ValueError(f"{name} is updated by the scheduled crawler {crawler}, which would point the compacted "
+                             f"partitions back to their prefix: stop its schedule and register the partitions with "
+                             f"ses_blog_partitions.py")
+        location = table["StorageDescriptor"]["Location"]
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        if not location.startswith("s3://") or bucket != getattr(self.store, "bucket", None):
+            raise ValueError(f"{name} reads {location}, not {self.store.location}: only the bucket read by the "
+                             f"table can be compacted")
+        return prefix.rstrip("/") + "/" if prefix else ""
+
+    def _is_scheduled(self, crawler) -> bool:
+        client = self.catalog.client
+        try:
+            schedule = client.get_crawler(Name=crawler)["Crawler"].get("Schedule", {})
+        except client.exceptions.EntityNotFoundException:
+            return False
+        return schedule.get("State") == "SCHEDULED"
+
+    def partitions(self, prefix) -> dict:
+        """
+        Returns the hour partitions under 'prefix', mapped to the data objects the table reads
+        for them.
+        """
+        return live_partitions(self.store, prefix)
+
+    def is_closed(self, partition) -> bool:
+        return partition_hour(partition) + timedelta(hours=1) + self.grace <= self.now
+
+    def candidates(self, prefix):
+        """
+        Yields the closed partitions under 'prefix' that have enough small objects to be
+        compacted, or objects that arrived after their last compaction, with all their objects.
+        """
+        for partition, objects in sorted(self.partitions(prefix).items()):
+            if not self.is_closed(partition):
+                continue
+            small = [o for o in objects if o.size < self.target_file_size // 2]
+            compacted = [o for o in objects if o.key.startswith(COMPACTED_PREFIX)]
+            if len(small) >= self.min_files or 0 < len(compacted) < len(objects):
+                yield partition, objects
+
+    def recover(self, prefix):
+        """
+        Completes or rolls back the compactions left unfinished by a previous run, and deletes
+        the objects retired for longer than the retention delay.
+        """
+        for manifest in _manifests(self.store, prefix):
+            if manifest["state"] == STAGING:
+                logging.info(f"Rolling back interrupted compaction of {manifest['partition']}")
+                self.store.delete(o.key for o in self.store.list(manifest["location"]))
+                self.store.delete([_manifest_key(manifest["partition"], manifest["run_id"])])
+            elif manifest["state"] == PUBLISHING:
+                logging.info(f"Completing interrupted compaction of {manifest['partition']}")
+                self._publish(manifest)
+            elif manifest["state"] == COMMITTED and \
+                    datetime.fromisoformat(manifest["committed_at"]) + self.retention <= self.now:
+                self.store.delete(i["key"] for i in manifest["inputs"])
+                manifest["state"] = COLLECTED
+                manifest["collected_at"] = self.now.isoformat()
+                self._save(manifest)
+
+    def run(self, dry_run=False) -> list:
+        """
+        Compacts the candidate partitions of the table and returns their manifests.
+        """
+        prefix = self.table_prefix()
+        if not dry_run:
+            self.recover(prefix)
+        manifests = []
+        for partition, objects in self.candidates(prefix):
+            if dry_run:
+                logging.info(f"Would compact {len(objects)} objects in {partition}")
+                continue
+            try:
+                manifests.append(self.compact(partition, objects))
+            except Exception as e:
+                logging.error(f"Couldn't compact {partition}: {e}")
+        return manifests
+
+    def compact(self, partition, objects) -> dict:
+        """
+        Merges the small objects of 'objects', copies the others, into a new generation of
+        'partition', and swaps it with the current one.
+        """
+        run_id = uuid.uuid4().hex[:12]
+        manifest = {
+            "partition": partition,
+            "run_id": run_id,
+            "state": STAGING,
+            "location": f"{COMPACTED_PREFIX}{partition}/{run_id}/",
+            "inputs": [{"key": o.key, "size": o.size, "etag": o.etag} for o in objects],
+            "outputs": [],
+        }
+        self._save(manifest)
+
+        small, large = self.split(objects)
+        for obj in large:
+            key = f"{manifest['location']}{obj.key.rpartition('/')[2]}"
+            self.store.copy(obj.key, key)
+            manifest["outputs"].append({"key": key, "size": obj.size})
+
+        workdir = tempfile.mkdtemp(prefix="ses-compaction-")
+        try:
+            inputs = []
+            for i, obj in enumerate(small):
+                path = os.path.join(workdir, f"input-{i:05d}")
+                with self.store.open(obj.key) as src, open(path, "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                inputs.append(path)
+
+            outputs = []
+            extension = None
+            if inputs and _is_parquet(inputs[0]):
+                outputs = self._merge_parquet(inputs, workdir)
+                extension = "parquet"
+            elif inputs:
+                outputs = self._merge_json(inputs, workdir)
+                extension = "gz"
+
+            for i, path in enumerate(outputs):
+                key = f"{manifest['location']}compacted-{run_id}-{i:05d}.{extension}"
+                self.store.put_file(key, path)
+                manifest["outputs"].append({"key": key, "size": os.path.getsize(path)})
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        manifest["state"] = PUBLISHING
+        self._save(manifest)
+        self._publish(manifest)
+        logging.info(f"Compacted {len(objects)} objects into {len(manifest['outputs'])} in {partition}")
+        return manifest
+
+    def split(self, objects) -> tuple:
+        """
+        Returns the objects of a partition to merge, and those to copy as is.
+        """
+        small = [o for o in objects if o.size < self.target_file_size // 2]
+        if len(small) < 2:
+            return [], objects
+        return small, [o for o in objects if o.size >= self.target_file_size // 2]
+
+    def _publish(self, manifest):
+        if self.catalog is not None:
+            values = partition_values(f"{manifest['partition']}/")
+            self.catalog.set_location(values, f"s3://{self.store.bucket}/{manifest['location']}")
+        manifest["state"] = COMMITTED
+        manifest["committed_at"] = datetime.now(timezone.utc).isoformat()
+        self._save(manifest)
+
+    def _save(self, manifest):
+        key = _manifest_key(manifest["partition"], manifest["run_id"])
+        self.store.put(key, json.dumps(manifest, indent=2).encode("utf-8"))
+
+    def _merge_parquet(self, inputs, workdir) -> list:
+        if pq is None:
+            raise ImportError("'pyarrow' is required to compact Parquet objects: pip3 install pyarrow")
+        schema = pa.unify_schemas([pq.read_schema(path) for path in inputs])
+        writer = ParquetFileRoller(workdir, schema, self.target_file_size, self.row_group_size, self.compression)
+        for path in inputs:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=self.row_group_size):
+                writer.write(align_to_schema(pa.Table.from_batches([batch]), schema))
+        return writer.close()
+
+    def _merge_json(self, inputs, workdir) -> list:
+        # concatenated GZIP members are a valid GZIP stream
+        outputs = []
+        out = None
+        for path in inputs:
+            if out is None or out.tell() >= self.target_file_size:
+                if out is not None:
+                    out.close()
+                outputs.append(os.path.join(workdir, f"output-{len(outputs):05d}.gz"))
+                out = open(outputs[-1], "wb")
+            with open(path, "rb") as f:
+                compressed = f.read(2) == b"\x1f\x8b"
+                f.seek(0)
+                if compressed:
+                    shutil.copyfileobj(f, out)
+                else:
+                    out.write(gzip.compress(f.read()))
+        if out is not None:
+            out.close()
+        return outputs
+
+
+def _is_parquet(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(4) == b"PAR1"
+
+
+def align_to_schema(table, schema):
+    """
+    Returns 'table' with the columns of 'schema', in its order and with its types; missing
+    columns are filled with nulls.
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            columns.append(table.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, type=field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+class ParquetFileRoller:
+    """
+    Writes tables into Parquet files of about 'target_file_size' bytes, with row groups of
+    exactly 'row_group_size' rows except for the last one of each file. Rows are buffered
+    until a full row group is available.
+    """
+
+    def __init__(self, directory, schema, target_file_size, row_group_size, compression="gzip"):
+        self.directory = directory
+        self.schema = schema
+        self.target_file_size = target_file_size
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.files = []
+        self._writer = None
+        self._pending = []
+        self._pending_rows = 0
+
+    def write(self, table):
+        self._pending.append(table)
+        self._pending_rows += table.num_rows
+        while self._pending_rows >= self.row_group_size:
+            buffered = pa.concat_tables(self._pending)
+            self._write_row_group(buffered.slice(0, self.row_group_size))
+            rest = buffered.slice(self.row_group_size)
+            self._pending = [rest] if rest.num_rows else []
+            self._pending_rows = rest.num_rows
+
+    def _write_row_group(self, table):
+        if self._writer is None:
+            self.files.append(os.path.join(self.directory, f"output-{len(self.files):05d}.parquet"))
+            self._writer = pq.ParquetWriter(self.files[-1], self.schema, compression=self.compression)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        if os.path.getsize(self.files[-1]) >= self.target_file_size:
+            self._writer.close()
+            self._writer = None
+
+    def close(self) -> list:
+        if self._pending_rows:
+            self._write_row_group(pa.concat_tables(self._pending))
+            self._pending = []
+            self._pending_rows = 0
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        return self.files
+
+
+def main(args):
+    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+    store = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+    catalog = None
+    if args.location.startswith("s3://"):
+        catalog = PartitionManager(session.client("glue", endpoint_url=args.endpoint_url), args.database, args.table)
+    compactor = Compactor(store, catalog,
+                          target_file_size=args.target_file_size_mb << 20,
+                          row_group_size=args.row_group_size,
+                          min_files=args.min_files,
+                          grace=timedelta(minutes=args.grace_minutes),
+                          retention=timedelta(minutes=args.retention_minutes),
+                          prefix=args.prefix)
+    try:
+        manifests = compactor.run(dry_run=args.dry_run)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    logging.info(f"{len(manifests)} partitions compacted in {store.location}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
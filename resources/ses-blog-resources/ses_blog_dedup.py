@@ -0,0 +1,247 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script removes the duplicate events from the closed hour partitions of the destination
+bucket, typically after a backfill, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+SES event publishing and Amazon Kinesis Data Firehose both deliver at least once, so the same
+event can be written more than once. The transformation Lambda function drops most duplicates
+with a probabilistic filter ('DEDUP_ENABLED'); this script is the exact counterpart for data
+written before it was enabled or replayed from another source:
+    - events written by the function in the 'nested' format are duplicates when they have the
+      same messageId, eventType, timestamp and recipients, the key used by the function
+      (the recipients of the event itself for Bounce, Complaint, Delivery and DeliveryDelay
+      events, of the message otherwise);
+    - rows written in the 'flat' format or by the AWS Glue DataBrew job, where one event is
+      spread over several rows, are duplicates when all their columns are equal.
+
+A partition is only rewritten when it contains duplicates, and it is swapped like in
+'ses_blog_compaction.py': the rewritten objects are published as a new generation of the
+partition and the location of the partition in the AWS Glue Data Catalog is changed to it, so
+queries never see a partially rewritten partition and an interrupted run never loses data.
+Like 'ses_blog_compaction.py', it only applies to the bucket the 'partitioned' table reads.
+Duplicates are searched within each partition.
+
+This script requires 'boto3', and 'pyarrow' for Parquet objects.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+from datetime import timedelta
+
+import boto3
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TransformationLambdaCode")
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+from dedup import event_key as lambda_event_key
+from ses_blog_compaction import Compactor, ParquetFileRoller, align_to_schema
+from ses_blog_partitions import DEFAULT_DATABASE, DEFAULT_TABLE, PartitionManager
+from ses_blog_storage import open_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-dedup',
+                    description='Removes the duplicate events from the closed hour partitions of the partitioned table',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> read by the table")
+    parser.add_argument('--database', default=DEFAULT_DATABASE, metavar='', help="AWS Glue database")
+    parser.add_argument('--table', default=DEFAULT_TABLE, metavar='', help="AWS Glue table")
+    parser.add_argument('-r', '--region', metavar='', help="AWS Region")
+    parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local AWS stand-in")
+    parser.add_argument('--target-file-size-mb', type=int, default=128, metavar='', help="Size of the rewritten objects")
+    parser.add_argument('--row-group-size', type=int, default=131072, metavar='', help="Rows per Parquet row group")
+    parser.add_argument('--grace-minutes', type=int, default=15, metavar='', help="Delay after the end of an hour before it is closed")
+    parser.add_argument('--retention-minutes', type=int, default=60, metavar='', help="Delay before the replaced objects are deleted")
+    parser.add_argument('--dry-run', action='store_true', help="Only count the duplicates")
+    args = parser.parse_args()
+
+    return args
+
+
+def event_key(obj):
+    """
+    Returns the duplicate key of an event or row read from the destination bucket: the key
+    of 'event_key' in the transformation Lambda function for a nested event (which has the
+    'destination' list), the values of all the columns for a row.
+    """
+    if isinstance(obj.get("destination"), list):
+        return lambda_event_key(obj).decode("utf-8")
+    return json.dumps(obj, sort_keys=True, separators=(",", ":"))
+
+
+def _read_lines(data):
+    # GZIP objects written by Firehose, or several of them concatenated by compaction
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return [line for line in data.splitlines(keepends=True) if line.strip()]
+
+
+def _row_keys(table):
+    names = sorted(table.column_names)
+    columns = [table.column(name).to_pylist() for name in names]
+    for values in zip(*columns):
+        yield json.dumps(dict(zip(names, values)), sort_keys=True, separators=(",", ":"), default=str)
+
+
+class Deduplicator(Compactor):
+    """
+    Rewrites the closed hour partitions of a store that contain duplicate events, without
+    the duplicates. The first copy of each event, in object and row order, is kept.
+
+    Parameters
+    ----------
+    store : S3Store
+        The bucket the table reads
+    catalog : PartitionManager
+        The table, whose partition locations are swapped
+    target_file_size : int
+        Size in bytes of the rewritten objects
+    row_group_size : int
+        Rows per row group of the rewritten Parquet objects
+    grace : timedelta
+        Delay after the end of an hour before the partition is considered closed
+    retention : timedelta
+        Delay after a swap before the replaced objects are deleted
+    """
+
+    def __init__(self, store, catalog, target_file_size=128 << 20, row_group_size=131072,
+                 grace=timedelta(minutes=15), retention=timedelta(hours=1), compression="gzip", now=None):
+        super().__init__(store, catalog, target_file_size=target_file_size, row_group_size=row_group_size,
+                         min_files=1, grace=grace, retention=retention, compression=compression, now=now)
+        self.duplicates = {}
+
+    def candidates(self, prefix):
+        """
+        Yields the closed partitions under 'prefix' that contain duplicates, with all their
+        objects.
+        """
+        for partition, objects in sorted(self.partitions(prefix).items()):
+            if not self.is_closed(partition):
+                continue
+            duplicates = self.count_duplicates(objects)
+            if duplicates:
+                self.duplicates[partition] = duplicates
+                yield partition, objects
+
+    def count_duplicates(self, objects) -> int:
+        """
+        Returns the number of duplicate events or rows in 'objects'.
+        """
+        seen = set()
+        duplicates = 0
+        for obj in objects:
+            if obj.key.endswith(".parquet"):
+                keys = self._parquet_keys(obj.key)
+            else:
+                keys = self._json_keys(obj.key)
+            for key in keys:
+                if key in seen:
+                    duplicates += 1
+                else:
+                    seen.add(key)
+        return duplicates
+
+    def split(self, objects) -> tuple:
+        # every object is rewritten, whatever its size
+        return objects, []
+
+    def run(self, dry_run=False) -> list:
+        manifests = super().run(dry_run=dry_run)
+        for partition, duplicates in self.duplicates.items():
+            logging.info(f"{duplicates} duplicates in {partition}")
+        return manifests
+
+    def _parquet_keys(self, key):
+        if pq is None:
+            raise ImportError("'pyarrow' is required to deduplicate Parquet objects: pip3 install pyarrow")
+        with self.store.open(key) as f:
+            parquet_file = pq.ParquetFile(pa.BufferReader(f.read()))
+        for batch in parquet_file.iter_batches(batch_size=self.row_group_size):
+            yield from _row_keys(pa.Table.from_batches([batch]))
+
+    def _json_keys(self, key):
+        for line in _read_lines(self.store.get(key)):
+            yield event_key(json.loads(line))
+
+    def _merge_parquet(self, inputs, workdir) -> list:
+        if pq is None:
+            raise ImportError("'pyarrow' is required to deduplicate Parquet objects: pip3 install pyarrow")
+        schema = pa.unify_schemas([pq.read_schema(path) for path in inputs])
+        writer = ParquetFileRoller(workdir, schema, self.target_file_size, self.row_group_size, self.compression)
+        seen = set()
+        for path in inputs:
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=self.row_group_size):
+                table = align_to_schema(pa.Table.from_batches([batch]), schema)
+                mask = []
+                for key in _row_keys(table):
+                    mask.append(key not in seen)
+                    seen.add(key)
+                writer.write(table.filter(pa.array(mask, type=pa.bool_())))
+        return writer.close()
+
+    def _merge_json(self, inputs, workdir) -> list:
+        outputs = []
+        out = None
+        seen = set()
+        for path in inputs:
+            with open(path, "rb") as f:
+                lines = _read_lines(f.read())
+            for line in lines:
+                key = event_key(json.loads(line))
+                if key in seen:
+                    continue
+                seen.add(key)
+                if out is None or out.fileobj.tell() >= self.target_file_size:
+                    if out is not None:
+                        out.close()
+                    outputs.append(os.path.join(workdir, f"output-{len(outputs):05d}.gz"))
+                    out = gzip.open(outputs[-1], "wb")
+                out.write(line if line.endswith(b"\n") else line + b"\n")
+        if out is not None:
+            out.close()
+        return outputs
+
+
+def main(args):
+    if not args.location.startswith("s3://"):
+        logging.error("The location must be the s3://<bucket> read by the table")
+        sys.exit(1)
+    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+    store = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+    catalog = PartitionManager(session.client("glue", endpoint_url=args.endpoint_url), args.database, args.table)
+    deduplicator = Deduplicator(store, catalog,
+                                target_file_size=args.target_file_size_mb << 20,
+                                row_group_size=args.row_group_size,
+                                grace=timedelta(minutes=args.grace_minutes),
+                                retention=timedelta(minutes=args.retention_minutes))
+    try:
+        manifests = deduplicator.run(dry_run=args.dry_run)
+    except ValueError as e:
+        logging.error(e)
+        sys.exit(1)
+    logging.info(f"{sum(deduplicator.duplicates.values())} duplicates found, "
+                 f"{len(manifests)} partitions rewritten in {store.location}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,318 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script generates synthetic Amazon SES events, in the format SES publishes them to
+Amazon Kinesis Data Firehose through a configuration set, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+Every event type covered by 'schema.json' can be generated: Send, Delivery, Bounce,
+Complaint, Open, Click, DeliveryDelay, Rendering Failure, Reject and Subscription, in a
+configurable mix and with a configurable number of recipients per message. Events can be
+written as newline-delimited JSON (like the 'raw/' objects) or packed into Firehose
+transformation batches (the 'event' received by the transformation Lambda function).
+
+The generated data is used to test and benchmark the transformation path and the local
+tools of the solution; it's deterministic for a given seed and start time, which defaults to
+the start of the hour a day before the run.
+"""
+
+import argparse
+import base64
+import gzip
+import json
+import logging
+import os
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta, timezone
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TransformationLambdaCode")
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+from codec import PAYLOAD_SIZE_LIMIT
+
+logging.basicConfig(level=logging.INFO)
+
+EVENT_TYPES = ("Send", "Delivery", "Bounce", "Complaint", "Open", "Click",
+               "DeliveryDelay", "Rendering Failure", "Reject", "Subscription")
+
+# Rough proportions of each event type for a healthy sender
+DEFAULT_MIX = {
+    "Send": 25, "Delivery": 24, "Open": 20, "Click": 8, "Bounce": 1.5, "Complaint": 0.2,
+    "DeliveryDelay": 0.5, "Rendering Failure": 0.1, "Reject": 0.1, "Subscription": 0.6,
+}
+
+# Firehose invokes the transformation function with up to the 6 MiB Lambda
+# payload limit of data, the limit the function sizes its responses to
+FIREHOSE_MAX_PAYLOAD = PAYLOAD_SIZE_LIMIT
+FIREHOSE_RECORD_OVERHEAD = 120
+
+USER_AGENTS = (
+    "Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)",
+    "Mozilla/5.0 (iPhone; CPU iPhone OS 16_5 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko)",
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36 Edg/114.0.1823.67",
+    "Microsoft Office/16.0 (Windows NT 10.0; Microsoft Outlook 16.0.16529; Pro)",
+    "Mozilla/5.0 (Linux; Android 13; SM-S911B) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.5735.196 Mobile Safari/537.36",
+    "Mozilla/5.0 (X11; Linux x86_64; rv:109.0) Gecko/20100101 Thunderbird/102.13.0",
+    "YahooMailProxy; https://help.yahoo.com/kb/yahoo-mail-proxy-SLN28749.html",
+)
+DOMAINS = ("example.com", "example.org", "mail.example.net", "example.co.uk", "corp.example.io")
+SUBJECTS = ("Your weekly digest", "Order confirmation", "Welcome aboard!", "Password reset", "Last chance: 20% off")
+TEMPLATES = ("weekly-digest", "order-confirmation", "welcome", "password-reset", "promotion")
+LINKS = ("https://www.example.com/offers", "https://www.example.com/account", "https://docs.example.com/start")
+BOUNCE_TYPES = (("Permanent", "General", "5.1.1", "smtp; 550 5.1.1 user unknown"),
+                ("Permanent", "Suppressed", "5.1.1", "Amazon SES has suppressed sending to this address"),
+                ("Transient", "MailboxFull", "4.2.2", "smtp; 452 4.2.2 mailbox full"))
+DELAY_TYPES = ("MailboxFull", "SpamDetected", "TransientCommunicationFailure", "InternalFailure")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-events',
+                    description='Generates synthetic Amazon SES events',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-n', '--count', type=int, default=10000, metavar='', help="Number of events")
+    parser.add_argument('-o', '--output', required=True, metavar='', help="Output file (.gz to compress)")
+    parser.add_argument('--mix', metavar='', help="Event type weights, e.g. 'Open=50,Click=20,Bounce=5'")
+    parser.add_argument('--fanout', type=int, default=1, metavar='', help="Maximum number of recipients per message")
+    parser.add_argument('--senders', type=int, default=5, metavar='', help="Number of distinct senders")
+    parser.add_argument('--recipients', type=int, default=50000, metavar='', help="Number of distinct recipients")
+    parser.add_argument('--seed', type=int, default=0, metavar='', help="Random seed")
+    parser.add_argument('--start', metavar='', help="Timestamp of the first event (ISO 8601, default: now - 1 day)")
+    parser.add_argument('--hours', type=float, default=24, metavar='', help="Time range covered by the events")
+    parser.add_argument('--firehose', action='store_true', help="Write Firehose transformation batches (one JSON per line) instead of events")
+    args = parser.parse_args()
+
+    return args
+
+
+def parse_mix(value) -> dict:
+    """
+    Parses an event type mix given as 'Type=weight,Type=weight'.
+    """
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in EVENT_TYPES:
+            raise ValueError(f"Unknown event type '{name}', expected one of {', '.join(EVENT_TYPES)}")
+        mix[name] = float(weight)
+    return mix
+
+
+def _iso(moment) -> str:
+    return moment.strftime("%Y-%m-%dT%H:%M:%S.") + f"{moment.microsecond // 1000:03d}Z"
+
+
+class SESEventGenerator:
+    """
+    Generates synthetic SES events.
+
+    Parameters
+    ----------
+    mix : dict
+        Event type to relative weight
+    fanout : int
+        Maximum number of recipients per message, drawn uniformly between 1 and fanout
+    senders : int
+        Number of distinct sender addresses
+    recipients : int
+        Number of distinct recipient addresses, drawn with a skew towards the first ones
+    start : datetime
+        Timestamp of the first event, by default the start of the hour a day ago
+    hours : float
+        Time range over which the events are spread, in order
+    seed : int
+        Random seed
+    configuration_set : str
+        The SES configuration set recorded in the events
+    """
+
+    def __init__(self, mix=None, fanout=1, senders=5, recipients=50000, start=None, hours=24.0,
+                 seed=0, configuration_set="SESConfigurationSet"):
+        mix = mix or DEFAULT_MIX
+        self.event_types = list(mix)
+        self.weights = [mix[t] for t in self.event_types]
+        self.fanout = max(1, fanout)
+        self.senders = [f"sender{i}@{DOMAINS[i % len(DOMAINS)]}" for i in range(senders)]
+        self.recipients = recipients
+        self.start = start or (datetime.now(timezone.utc) - timedelta(days=1)).replace(minute=0, second=0, microsecond=0)
+        self.hours = hours
+        self.configuration_set = configuration_set
+        self.random = random.Random(seed)
+
+    def _recipient(self) -> str:
+        # a few recipients receive most of the messages
+        index = int(self.recipients * self.random.random() ** 2)
+        return f"user{index}@{DOMAINS[index % len(DOMAINS)]}"
+
+    def _mail(self, moment, destination, template):
+        rnd = self.random
+        sender = rnd.choice(self.senders)
+        message_id = f"{uuid.UUID(int=rnd.getrandbits(128))}-000000"
+        subject = rnd.choice(SUBJECTS)
+        return {
+            "timestamp": _iso(moment),
+            "source": sender,
+            "sourceArn": f"arn:aws:ses:us-east-1:123456789012:identity/{sender.split('@')[1]}",
+            "sendingAccountId": "123456789012",
+            "messageId": message_id,
+            "destination": destination,
+            "headersTruncated": False,
+            "headers": [
+                {"name": "From", "value": sender},
+                {"name": "To", "value": ", ".join(destination)},
+                {"name": "Subject", "value": subject},
+                {"name": "MIME-Version", "value": "1.0"},
+                {"name": "Content-Type", "value": "text/html; charset=UTF-8"},
+            ],
+            "commonHeaders": {
+                "from": [sender],
+                "to": destination,
+                "messageId": message_id,
+                "subject": subject,
+            },
+            "tags": {
+                "ses:configuration-set": [self.configuration_set],
+                "ses:source-ip": [f"192.0.2.{rnd.randint(1, 254)}"],
+                "ses:from-domain": [sender.split("@")[1]],
+                "ses:caller-identity": ["ses_user"],
+                "ses:outgoing-ip": [f"198.51.100.{rnd.randint(1, 254)}"],
+                "template": [template],
+            },
+        }
+
+    def event(self, event_type, moment):
+        """
+        Returns one event of 'event_type' that happened at 'moment'.
+        """
+        rnd = self.random
+        destination = [self._recipient() for _ in range(rnd.randint(1, self.fanout))]
+        template = rnd.choice(TEMPLATES)
+        mail = self._mail(moment - timedelta(seconds=rnd.randint(1, 600)), destination, template)
+        at = _iso(moment)
+        one = destination[:1]
+
+        if event_type == "Send":
+            return {"eventType": event_type, "mail": mail, "send": {}}
+        if event_type == "Delivery":
+            return {"eventType": event_type, "mail": mail, "delivery": {
+                "timestamp": at, "processingTimeMillis": rnd.randint(200, 5000), "recipients": destination,
+                "smtpResponse": "250 2.6.0 Message received", "reportingMTA": "a8-70.smtp-out.amazonses.com"}}
+        if event_type == "Bounce":
+            bounce_type, sub_type, status, diagnostic = rnd.choice(BOUNCE_TYPES)
+            return {"eventType": event_type, "bounce": {
+                "bounceType": bounce_type, "bounceSubType": sub_type,
+                "bouncedRecipients": [{"emailAddress": r, "action": "failed", "status": status, "diagnosticCode": diagnostic}
+                                      for r in destination],
+                "timestamp": at, "feedbackId": f"{uuid.UUID(int=rnd.getrandbits(128))}-000000",
+                "reportingMTA": "dsn; e226-55.smtp-out.us-east-1.amazonses.com"}, "mail": mail}
+        if event_type == "Complaint":
+            return {"eventType": event_type, "complaint": {
+                "complainedRecipients": [{"emailAddress": r} for r in one], "timestamp": at,
+                "feedbackId": f"{uuid.UUID(int=rnd.getrandbits(128))}-000000",
+                "userAgent": "Mozilla/5.0", "complaintFeedbackType": "abuse", "arrivalDate": at}, "mail": mail}
+        if event_type == "Open":
+            return {"eventType": event_type, "mail": mail, "open": {
+                "ipAddress": f"203.0.113.{rnd.randint(1, 254)}", "timestamp": at, "userAgent": rnd.choice(USER_AGENTS)}}
+        if event_type == "Click":
+            link = rnd.choice(LINKS)
+            return {"eventType": event_type, "click": {
+                "ipAddress": f"203.0.113.{rnd.randint(1, 254)}", "timestamp": at, "userAgent": rnd.choice(USER_AGENTS),
+                "link": link, "linkTags": {"campaign": [template]}}, "mail": mail}
+        if event_type == "DeliveryDelay":
+            return {"eventType": event_type, "mail": mail, "deliveryDelay": {
+                "timestamp": at, "delayType": rnd.choice(DELAY_TYPES),
+                "expirationTime": _iso(moment + timedelta(hours=12)),
+                "delayedRecipients": [{"emailAddress": r, "status": "4.4.7", "diagnosticCode": "smtp; 421 4.4.7 try again later"}
+                                      for r in destination]}}
+        if event_type == "Rendering Failure":
+            return {"eventType": event_type, "mail": mail, "failure": {
+                "templateName": template, "errorMessage": "Attribute 'name' is not present in the rendering data."}}
+        if event_type == "Reject":
+            return {"eventType": event_type, "mail": mail, "reject": {"reason": "Bad content"}}
+        if event_type == "Subscription":
+            preferences = {"unsubscribeAll": False, "topicSubscriptionStatus": [
+                {"topicName": "newsletter", "subscriptionStatus": "OptIn"}]}
+            return {"eventType": event_type, "mail": mail, "subscription": {
+                "contactList": "customers", "timestamp": at, "source": "UnsubscribeHeader",
+                "newTopicPreferences": {**preferences, "unsubscribeAll": True}, "oldTopicPreferences": preferences}}
+        raise ValueError(f"Unknown event type '{event_type}'")
+
+    def events(self, count):
+        """
+        Yields 'count' events, spread in order over the configured time range.
+        """
+        step = timedelta(hours=self.hours) / max(count, 1)
+        for i in range(count):
+            event_type = self.random.choices(self.event_types, self.weights)[0]
+            yield self.event(event_type, self.start + step * i)
+
+
+def firehose_record(event, record_id, arrival_ms) -> dict:
+    """
+    Wraps an event the way Firehose passes it to the transformation function.
+    """
+    return {
+        "recordId": record_id,
+        "approximateArrivalTimestamp": arrival_ms,
+        "data": base64.b64encode(json.dumps(event).encode("utf-8")).decode("ascii"),
+    }
+
+
+def firehose_batches(events, max_payload=FIREHOSE_MAX_PAYLOAD, max_records=None, seed=0):
+    """
+    Packs events into Firehose transformation requests of at most 'max_payload' bytes and,
+    optionally, 'max_records' records. The invocation ids are drawn from 'seed', so the same
+    events and seed give the same batches.
+    """
+    rnd = random.Random(seed)
+    records = []
+    size = 0
+    for i, event in enumerate(events):
+        arrival = datetime.strptime(event["mail"]["timestamp"], "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc)
+        record = firehose_record(event, f"{i:020d}", int(arrival.timestamp() * 1000))
+        record_size = len(record["data"]) + FIREHOSE_RECORD_OVERHEAD
+        if records and (size + record_size > max_payload or (max_records and len(records) >= max_records)):
+            yield _batch(records, rnd)
+            records = []
+            size = 0
+        records.append(record)
+        size += record_size
+    if records:
+        yield _batch(records, rnd)
+
+
+def _batch(records, rnd) -> dict:
+    return {
+        "invocationId": str(uuid.UUID(int=rnd.getrandbits(128), version=4)),
+        "deliveryStreamArn": "arn:aws:firehose:us-east-1:123456789012:deliverystream/KinesisFirehoseStream",
+        "region": "us-east-1",
+        "records": records,
+    }
+
+
+def main(args):
+    start = datetime.fromisoformat(args.start.replace("Z", "+00:00")) if args.start else None
+    generator = SESEventGenerator(mix=parse_mix(args.mix) if args.mix else None, fanout=args.fanout,
+                                  senders=args.senders, recipients=args.recipients,
+                                  start=start, hours=args.hours, seed=args.seed)
+    opener = gzip.open if args.output.endswith(".gz") else open
+    with opener(args.output, "wt", encoding="utf-8") as f:
+        events = generator.events(args.count)
+        items = firehose_batches(events, seed=args.seed) if args.firehose else events
+        written = 0
+        for item in items:
+            f.write(json.dumps(item) + "\n")
+            written += 1
+    logging.info(f"{args.count} events written to {args.output} ({written} lines)")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,258 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script builds the IP range index read by the transformation Lambda function of the
+solution ('TransformationLambdaCode/geoip.py', 'GEOIP_ENABLED') from a CSV dump of IP ranges,
+in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+Each row of the dump gives a range of addresses, as its first and last addresses ('start',
+'end') or as a CIDR block ('network'), with its country code ('country'), autonomous system
+number ('asn') and organization ('org'); any of the last three can be missing. Addresses are
+IPv4 or IPv6, as text or integers. The first row names the columns, unless they are given in
+order with '--columns', e.g. for the 'ip2asn-combined.tsv.gz' dump of iptoasn.com:
+
+    python3 ses_blog_geoip.py -i ip2asn-combined.tsv.gz --tsv --columns start,end,asn,country,org
+
+The ranges are sorted, the most specific one is kept where they overlap, adjacent ranges of
+the same network are merged, and the index is written as flat sorted arrays that the function
+memory maps and searches in place.
+"""
+
+import argparse
+import csv
+import gzip
+import ipaddress
+import logging
+import os
+import sys
+import time
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TransformationLambdaCode")
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+from geoip import GeoIpIndex, pack_index
+
+logging.basicConfig(level=logging.INFO)
+
+COLUMNS = ("start", "end", "network", "country", "asn", "org")
+# Column names of common dumps
+COLUMN_ALIASES = {
+    "range_start": "start", "start_ip": "start", "ip_from": "start",
+    "range_end": "end", "end_ip": "end", "ip_to": "end",
+    "country_code": "country", "country_iso_code": "country",
+    "as_number": "asn", "autonomous_system_number": "asn",
+    "as_description": "org", "as_organization": "org", "autonomous_system_organization": "org",
+}
+# Values meaning that the country is not known
+UNKNOWN_COUNTRIES = frozenset(("", "-", "none", "zz"))
+IPV4_MAX = (1 << 32) - 1
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-geoip',
+                    description='Builds the IP range index of the transformation Lambda function from a CSV dump',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-i', '--input', required=True, metavar='', help="CSV dump of IP ranges, optionally gzipped")
+    parser.add_argument('-o', '--output', default='geoip.idx', metavar='', help="Index file to write")
+    parser.add_argument('--columns', metavar='', help="Names of the columns, in order, when the dump has no header")
+    parser.add_argument('--tsv', action='store_true', help="The dump is tab separated")
+    parser.add_argument('--lookup', action='append', metavar='', help="Address to look up in the written index")
+    args = parser.parse_args()
+
+    return args
+
+
+def parse_address(value):
+    """
+    Returns the IP version and the integer value of an address given as text or as an integer.
+    """
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return (4 if number <= IPV4_MAX else 6), number
+    address = ipaddress.ip_address(value)
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return 4, int(address.ipv4_mapped)
+    return address.version, int(address)
+
+
+def parse_range(row):
+    """
+    Returns the IP version, first and last addresses of the range of a row.
+    """
+    if row.get("network"):
+        network = ipaddress.ip_network(row["network"].strip(), strict=False)
+        return network.version, int(network.network_address), int(network.broadcast_address)
+    first_version, first = parse_address(row["start"])
+    last_version, last = parse_address(row["end"])
+    if first_version != last_version and max(first, last) > IPV4_MAX:
+        first_version = last_version = 6
+    if first > last:
+        raise ValueError(f"range {row['start']} - {row['end']} ends before it starts")
+    return first_version, first, last
+
+
+def parse_asn(value):
+    value = (value or "").strip()
+    if value[:2].upper() == "AS":
+        value = value[2:]
+    return int(value) if value else 0
+
+
+def read_rows(path, columns=None, delimiter=","):
+    """
+    Yields the rows of a CSV dump as dictionaries of the canonical column names.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter=delimiter)
+        if columns is None:
+            columns = next(reader, [])
+        names = [COLUMN_ALIASES.get(c.strip().lower(), c.strip().lower()) for c in columns]
+        if "network" not in names and not {"start", "end"} <= set(names):
+            raise ValueError(f"{path} has no 'network' column nor 'start' and 'end' columns: {', '.join(names)}")
+        for values in reader:
+            if values and not values[0].startswith("#"):
+                yield {n: v for n, v in zip(names, values) if n in COLUMNS}
+
+
+def resolve_overlaps(ranges):
+    """
+    Returns sorted, non overlapping (first, last, entry) ranges from possibly overlapping
+    ones, keeping the most specific range where one contains another, the one that starts
+    last where two overlap partially. Adjacent ranges of the same entry are merged.
+
+    Parameters
+    ----------
+    ranges : list
+        (first, last, entry) tuples
+
+    Returns
+    -------
+    tuple
+        The ranges, and the number of input ranges that overlapped another one
+    """
+    segments = []
+    stack = []
+    cursor = 0
+    overlaps = 0
+
+    def emit(first, last, entry):
+        if segments and segments[-1][2] == entry and segments[-1][1] + 1 == first:
+            segments[-1] = (segments[-1][0], last, entry)
+        else:
+            segments.append((first, last, entry))
+
+    for first, last, entry in sorted(ranges, key=lambda r: (r[0], -r[1])):
+        while stack and stack[-1][0] < first:
+            end, outer = stack.pop()
+            if cursor <= end:
+                emit(cursor, end, outer)
+                cursor = end + 1
+        if stack:
+            overlaps += 1
+            if cursor < first:
+                emit(cursor, first - 1, stack[-1][1])
+            while stack and stack[-1][0] < last:
+                stack.pop()
+        cursor = first
+        stack.append((last, entry))
+    while stack:
+        end, outer = stack.pop()
+        if cursor <= end:
+            emit(cursor, end, outer)
+            cursor = end + 1
+    return segments, overlaps
+
+
+class GeoIpIndexBuilder:
+    """
+    Collects IP ranges and serializes them in the index format of
+    'TransformationLambdaCode/geoip.py'. Each distinct (country, ASN, organization) is stored
+    once. IPv6 ranges are indexed on their /64 prefix: a range smaller than a /64 takes the
+    whole /64.
+    """
+
+    def __init__(self):
+        self.ranges = {4: [], 6: []}
+        self.entries = {}
+        self.strings = {"": 0}
+        self.skipped = 0
+        self.overlaps = 0
+
+    def _string(self, value):
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def _entry(self, country, asn, org):
+        key = (asn, self._string(country), self._string(org))
+        index = self.entries.get(key)
+        if index is None:
+            index = self.entries[key] = len(self.entries)
+        return index
+
+    def add(self, version, first, last, country, asn, org):
+        """
+        Adds a range of addresses. A range with neither a country nor an ASN, like the
+        unrouted ranges of some dumps, is skipped.
+        """
+        country = (country or "").strip()
+        if country.lower() in UNKNOWN_COUNTRIES:
+            country = ""
+        org = (org or "").strip()
+        if not country and not asn:
+            self.skipped += 1
+            return
+        if version == 6:
+            first >>= 64
+            last >>= 64
+        self.ranges[version].append((first, last, self._entry(country.upper(), asn, org)))
+
+    def add_row(self, row):
+        version, first, last = parse_range(row)
+        self.add(version, first, last, row.get("country"), parse_asn(row.get("asn")), row.get("org"))
+
+    def build(self) -> bytes:
+        v4, v4_overlaps = resolve_overlaps(self.ranges[4])
+        v6, v6_overlaps = resolve_overlaps(self.ranges[6])
+        self.overlaps = v4_overlaps + v6_overlaps
+        return pack_index(v4, v6, list(self.entries), list(self.strings))
+
+
+def main(args):
+    columns = args.columns.split(",") if args.columns else None
+    builder = GeoIpIndexBuilder()
+    started = time.perf_counter()
+    rows = 0
+    try:
+        for row in read_rows(args.input, columns, "\t" if args.tsv else ","):
+            rows += 1
+            builder.add_row(row)
+    except (KeyError, ValueError) as e:
+        logging.error(f"Row {rows} of {args.input}: {e}")
+        sys.exit(1)
+    data = builder.build()
+    with open(args.output, "wb") as f:
+        f.write(data)
+    logging.info(f"{rows} rows read in {time.perf_counter() - started:.1f} s: {builder.skipped} without "
+                 f"network data skipped, {builder.overlaps} overlapping another range")
+
+    started = time.perf_counter()
+    index = GeoIpIndex.open(args.output)
+    opened = time.perf_counter() - started
+    logging.info(f"{len(index)} ranges and {len(builder.entries)} networks written to {args.output} "
+                 f"({len(data) / 1e6:.1f} MB), opened in {opened * 1e3:.2f} ms")
+    for address in args.lookup or ():
+        logging.info(f"{address}: {index.lookup(address)}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,311 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script applies the AWS Glue DataBrew recipe of the solution ('recipe.json') to the raw
+events of the destination bucket incrementally, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+The 'SESDataBrewDataset' selects the raw objects modified during the last hour and the job
+runs every hour: an object written close to a run can be read by two runs, and an object
+written late for an hour, or while the job was not running, by none. This script keeps a
+manifest of the raw objects it has processed instead, and each run only processes the
+objects that are not in it:
+    - the raw objects are listed from the watermark, the latest hour seen by the previous
+      runs, minus '--lookback-hours', so the late objects of the previous hours are found
+      without listing the whole history;
+    - the new objects of an hour are run through the recipe and written as new Parquet
+      objects in its partition, under '<output prefix>year=/month=/day=/hour=/', next to
+      the objects written by the previous runs;
+    - an hour whose processed objects changed or disappeared, or that was processed with
+      another recipe, is rewritten from all its raw objects.
+The work of a run is proportional to the new objects, and only the partitions they belong
+to are written. Like with the DataBrew dataset, the partition of an event is the
+'raw/YYYY/MM/DD/HH/' hour of its object.
+
+Each hour has a manifest under '_incremental/hours/', which also journals the writes of its
+partition:
+    1. the manifest moves to the 'staging' state with the id of the run;
+    2. the new objects are written into the partition, named after the run id;
+    3. the manifest lists the processed objects and moves to the 'publishing' state, with
+       the objects replaced by a rewrite: this is the commit point;
+    4. the replaced objects are deleted and the manifest is saved without a state.
+A run that fails before the commit point leaves the partition as it was (its new objects are
+deleted by the next run) and one that fails after it is completed by the next run. The
+script is meant to be run by a single scheduler at a time.
+
+This script requires 'pyarrow' and 'boto3' for S3 locations.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from ses_blog_backfill import open_lines
+from ses_blog_recipe import RAW_PATH_PATTERN, PartitionedParquetWriter, Recipe
+from ses_blog_storage import open_store
+
+logging.basicConfig(level=logging.INFO)
+
+STATE_KEY = "_incremental/state.json"
+HOURS_PREFIX = "_incremental/hours/"
+RECIPE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipe.json")
+
+STAGING = "staging"
+PUBLISHING = "publishing"
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-incremental',
+                    description='Applies the DataBrew recipe to the raw objects not processed yet',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory of the raw events")
+    parser.add_argument('--prefix', default="raw/", metavar='', help="Prefix of the raw events (default: raw/)")
+    parser.add_argument('-o', '--output', metavar='', help="s3://<bucket> or local directory of the output and manifests (default: the raw events location)")
+    parser.add_argument('--output-prefix', default="partitioned/", metavar='', help="Prefix of the output partitions (default: partitioned/)")
+    parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local S3 stand-in")
+    parser.add_argument('--recipe', default=RECIPE_FILE, metavar='', help="AWS Glue DataBrew recipe")
+    parser.add_argument('--lookback-hours', type=int, default=24, metavar='', help="Hours before the watermark listed for late objects")
+    parser.add_argument('--full-scan', action='store_true', help="List every raw object, whatever the watermark")
+    parser.add_argument('--row-group-size', type=int, default=50000, metavar='', help="Rows per Parquet row group")
+    parser.add_argument('--dry-run', action='store_true', help="Only list the hours that would be processed")
+    args = parser.parse_args()
+
+    return args
+
+
+def raw_hour(key):
+    """
+    Returns the hour of the 'YYYY/MM/DD/HH/' path of a raw object, or None.
+    """
+    match = RAW_PATH_PATTERN.search(key)
+    if match is None:
+        return None
+    return datetime(*(int(v) for v in match.groups()), tzinfo=timezone.utc)
+
+
+def _hour_manifest_key(hour) -> str:
+    return f"{HOURS_PREFIX}{hour:%Y/%m/%d/%H}.json"
+
+
+class IncrementalRunner:
+    """
+    Processes the raw objects of a store that are not in its manifests.
+
+    Parameters
+    ----------
+    source : LocalStore or S3Store
+        The store of the raw events
+    output : LocalStore or S3Store
+        The store where the partitions and the manifests are written
+    prefix : str
+        Prefix of the raw events
+    output_prefix : str
+        Prefix of the output partitions
+    recipe_file : str
+        The AWS Glue DataBrew recipe applied to the events
+    lookback : timedelta
+        How long before the watermark the raw objects are listed
+    writer_options : dict
+        Options of the PartitionedParquetWriter, such as row_group_size
+    """
+
+    def __init__(self, source, output=None, prefix="raw/", output_prefix="partitioned/", recipe_file=RECIPE_FILE,
+                 lookback=timedelta(hours=24), **writer_options):
+        self.source = source
+        self.output = output or source
+        self.prefix = prefix
+        self.output_prefix = output_prefix
+        self.recipe = Recipe.from_file(recipe_file)
+        self.lookback = lookback
+        self.writer_options = writer_options
+        with open(recipe_file, "rb") as f:
+            self.fingerprint = hashlib.sha256(f.read() + json.dumps([prefix, output_prefix]).encode()).hexdigest()
+
+    def partition_prefix(self, hour) -> str:
+        return f"{self.output_prefix}year={hour.year}/month={hour.month}/day={hour.day}/hour={hour.hour}/"
+
+    def load_state(self) -> dict:
+        if self.output.exists(STATE_KEY):
+            return json.loads(self.output.get(STATE_KEY))
+        return {"fingerprint": None, "watermark": None}
+
+    def raw_objects(self, since=None) -> dict:
+        """
+        Returns the raw objects of the hours from 'since' on, or of all the hours, by hour.
+        """
+        start_after = f"{self.prefix}{since:%Y/%m/%d/%H}/" if since else None
+        hours = {}
+        for obj in self.source.list(self.prefix, start_after=start_after):
+            hour = raw_hour(obj.key)
+            if hour is None or obj.key.rpartition("/")[2].startswith(("_", ".")):
+                continue
+            hours.setdefault(hour, []).append(obj)
+        return hours
+
+    def manifests(self, since=None) -> dict:
+        """
+        Returns the manifests of the hours from 'since' on, or of all the hours, by hour.
+        """
+        start_after = f"{HOURS_PREFIX}{since:%Y/%m/%d/%H}" if since else None
+        manifests = {}
+        for obj in self.output.list(HOURS_PREFIX, start_after=start_after):
+            manifest = json.loads(self.output.get(obj.key))
+            manifests[datetime.fromisoformat(manifest["hour"])] = manifest
+        return manifests
+
+    def plan(self, hour, objects, manifest):
+        """
+        Returns the raw objects of an hour to process and whether its partition is rewritten,
+        or None when all of them were processed.
+        """
+        processed = manifest["objects"] if manifest and manifest["fingerprint"] == self.fingerprint else None
+        current = {o.key: o.etag for o in objects}
+        if processed is None or any(current.get(k) != etag for k, etag in processed.items()):
+            return objects, True
+        new = [o for o in objects if o.key not in processed]
+        return (new, False) if new else None
+
+    def run(self, full_scan=False, dry_run=False) -> dict:
+        """
+        Processes the raw objects not processed yet and returns the statistics of the run.
+        """
+        state = self.load_state()
+        watermark = datetime.fromisoformat(state["watermark"]) if state["watermark"] else None
+        if state["fingerprint"] not in (None, self.fingerprint):
+            logging.info("The recipe or the prefixes changed since the last run, processing every hour again")
+            full_scan = True
+        since = None if full_scan or watermark is None else watermark - self.lookback
+
+        hours = self.raw_objects(since)
+        manifests = self.manifests(since)
+        stats = {"hours": 0, "rewritten": 0, "objects": 0, "rows": 0}
+        if not dry_run:
+            for hour, manifest in sorted(manifests.items()):
+                if manifest.get("state"):
+                    self.recover(manifest)
+
+        run_id = uuid.uuid4().hex[:12]
+        for hour, objects in sorted(hours.items()):
+            planned = self.plan(hour, objects, manifests.get(hour))
+            if planned is None:
+                continue
+            inputs, rewrite = planned
+            if dry_run:
+                logging.info(f"Would {'rewrite' if rewrite else 'append to'} {self.partition_prefix(hour)} "
+                             f"from {len(inputs)} objects")
+                continue
+            rows = self.process_hour(hour, objects, inputs, rewrite, manifests.get(hour), run_id)
+            stats["hours"] += 1
+            stats["rewritten"] += rewrite
+            stats["objects"] += len(inputs)
+            stats["rows"] += rows
+
+        if hours and not dry_run:
+            latest = max(hours)
+            state = {"fingerprint": self.fingerprint,
+                     "watermark": max(latest, watermark).isoformat() if watermark else latest.isoformat()}
+            self.output.put(STATE_KEY, json.dumps(state).encode("utf-8"))
+        return stats
+
+    def process_hour(self, hour, objects, inputs, rewrite, manifest, run_id) -> int:
+        """
+        Writes the rows of 'inputs' into the partition of 'hour', replacing its objects if
+        'rewrite' is True, and returns the number of rows written.
+        """
+        partition = self.partition_prefix(hour)
+        manifest = manifest or {"hour": hour.isoformat(), "fingerprint": self.fingerprint, "objects": {}}
+        replaced = [o.key for o in self.output.list(partition)] if rewrite else []
+        manifest.update(state=STAGING, run_id=run_id)
+        self._save(manifest)
+
+        rows = self.write_partition(hour, inputs, run_id)
+
+        processed = {} if rewrite else manifest["objects"]
+        processed.update((o.key, o.etag) for o in inputs)
+        manifest.update(fingerprint=self.fingerprint, objects=processed, state=PUBLISHING, replaced=replaced)
+        self._save(manifest)
+        self._publish(manifest)
+        logging.info(f"{'Rewrote' if rewrite else 'Appended to'} {partition}: {len(inputs)} of "
+                     f"{len(objects)} raw objects, {rows} rows")
+        return rows
+
+    def write_partition(self, hour, inputs, run_id) -> int:
+        workdir = tempfile.mkdtemp(prefix="ses-incremental-")
+        try:
+            writer = PartitionedParquetWriter(workdir, overwrite=False, run_id=run_id, **self.writer_options)
+            with writer:
+                writer.write_all(self.recipe.apply(self._events(hour, inputs)))
+            for path in writer.files_written:
+                relative = os.path.relpath(path, workdir).replace(os.sep, "/")
+                self.output.put_file(f"{self.output_prefix}{relative}", path)
+            return writer.rows_written
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    def _events(self, hour, inputs):
+        columns = {"year": hour.year, "month": hour.month, "day": hour.day, "hour": hour.hour}
+        for obj in inputs:
+            for line_number, line in enumerate(open_lines(self.source.open(obj.key)), 1):
+                if not line.strip():
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Skipping malformed JSON in {obj.key}, line {line_number}")
+                    continue
+                event.update(columns)
+                yield event
+
+    def recover(self, manifest):
+        """
+        Completes or rolls back the writes of a partition left unfinished by a previous run.
+        """
+        partition = self.partition_prefix(datetime.fromisoformat(manifest["hour"]))
+        if manifest["state"] == STAGING:
+            logging.info(f"Rolling back interrupted run {manifest['run_id']} of {partition}")
+            self.output.delete(o.key for o in self.output.list(partition)
+                               if o.key.rpartition("/")[2].startswith(f"part-{manifest['run_id']}-"))
+            del manifest["state"], manifest["run_id"]
+            self._save(manifest)
+        elif manifest["state"] == PUBLISHING:
+            logging.info(f"Completing interrupted run {manifest['run_id']} of {partition}")
+            self._publish(manifest)
+
+    def _publish(self, manifest):
+        self.output.delete(manifest.pop("replaced", []))
+        del manifest["state"], manifest["run_id"]
+        self._save(manifest)
+
+    def _save(self, manifest):
+        hour = datetime.fromisoformat(manifest["hour"])
+        self.output.put(_hour_manifest_key(hour), json.dumps(manifest).encode("utf-8"))
+
+
+def main(args):
+    session = None
+    if args.profile:
+        import boto3
+        session = boto3.Session(profile_name=args.profile)
+
+    source = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+    output = open_store(args.output, session=session, endpoint_url=args.endpoint_url) if args.output else source
+    runner = IncrementalRunner(source, output, args.prefix, args.output_prefix, args.recipe,
+                               lookback=timedelta(hours=args.lookback_hours), row_group_size=args.row_group_size)
+    stats = runner.run(full_scan=args.full_scan, dry_run=args.dry_run)
+    logging.info(f"{stats['objects']} raw objects and {stats['rows']} rows processed in {stats['hours']} hours "
+                 f"({stats['rewritten']} rewritten) to {output.location}/{args.output_prefix}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,343 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script replays Firehose batches against the transformation Lambda function
+('TransformationLambdaCode/index.py') and recommends a memory size for it, in the context of the
+AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+The batches are generated by 'ses_blog_events.py' or read from a file it wrote (events or
+Firehose batches, one per line). They are sent to 'lambda_handler' in '--concurrency' worker
+processes, each one playing an execution environment, at '--rate' records per second (or as
+fast as possible). Each invocation is measured: wall time, CPU time (including the worker
+processes of PROCESSING_MODE=process) and peak resident memory of the environment.
+
+AWS Lambda allocates CPU in proportion to memory, one vCPU at 1,769 MB. From the CPU time and
+the time not spent on CPU of each invocation, the script models the duration of the
+invocations for each memory size, and from it the cost per million events, the concurrency
+needed at the target rate, and the cheapest memory size that holds the peak memory with
+'--headroom' and keeps the p99 duration under '--max-duration'.
+
+The workers can be confined to a CPU quota, to check the model against a throttled run:
+'--cpus' pins them to some CPUs (sched_setaffinity), '--cpu-quota' puts them in a cgroup v2
+limited to a fraction of a CPU (cpu.max, which requires write access to the cgroup tree).
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import math
+import multiprocessing
+import os
+import resource
+import time
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from ses_blog_benchmark import _copy_batch, load_handler, percentile
+from ses_blog_events import SESEventGenerator, firehose_batches, parse_mix
+
+logging.basicConfig(level=logging.INFO)
+
+FULL_VCPU_MB = 1769
+MAX_VCPUS = 6
+MEMORY_SIZES = (128, 256, 512, 768, 1024, 1536, 1769, 2048, 3008, 4096, 6144, 8192, 10240)
+# us-east-1 on-demand prices, in USD
+PRICE_PER_GB_SECOND = {"x86_64": 0.0000166667, "arm64": 0.0000133334}
+PRICE_PER_REQUEST = 0.20 / 1e6
+CGROUP_ROOT = "/sys/fs/cgroup"
+CGROUP_PERIOD_US = 100000
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-loadtest',
+                    description='Replays Firehose batches against the transformation Lambda function and recommends a memory size',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-i', '--input', metavar='', help="File of events or Firehose batches written by ses_blog_events.py (default: generated events)")
+    parser.add_argument('-n', '--count', type=int, default=20000, metavar='', help="Number of generated events")
+    parser.add_argument('--mix', metavar='', help="Event type weights of the generated events, e.g. 'Open=50,Click=20,Bounce=5'")
+    parser.add_argument('--fanout', type=int, default=1, metavar='', help="Maximum number of recipients per generated message")
+    parser.add_argument('--batch-records', type=int, default=500, metavar='', help="Maximum number of records per batch, 0 to fill batches up to 6 MB")
+    parser.add_argument('--seed', type=int, default=0, metavar='', help="Random seed")
+    parser.add_argument('--invocations', type=int, default=200, metavar='', help="Number of invocations replayed, cycling over the batches")
+    parser.add_argument('--concurrency', type=int, default=1, metavar='', help="Number of concurrent execution environments")
+    parser.add_argument('--rate', type=float, default=0, metavar='', help="Target rate in records per second, 0 for as fast as possible")
+    parser.add_argument('--cpus', type=int, metavar='', help="Pin the execution environments to this many CPUs")
+    parser.add_argument('--cpu-quota', type=float, metavar='', help="Limit the execution environments to this many CPUs with a cgroup")
+    parser.add_argument('--mode', metavar='', help="Batch processing mode of the function (serial, thread, process)")
+    parser.add_argument('--workers', type=int, metavar='', help="Workers of the thread or process pool of the function")
+    parser.add_argument('--output-format', metavar='', help="Output format of the function (nested, flat)")
+    parser.add_argument('--architecture', default="x86_64", choices=sorted(PRICE_PER_GB_SECOND), metavar='', help="Lambda architecture, for the price (x86_64, arm64)")
+    parser.add_argument('--headroom', type=float, default=0.25, metavar='', help="Memory kept free above the peak, as a fraction of it")
+    parser.add_argument('--max-duration', type=float, default=30.0, metavar='', help="Maximum p99 duration of an invocation, in seconds")
+    parser.add_argument('-o', '--output', metavar='', help="Write the measurements and the model to this JSON file")
+    args = parser.parse_args()
+
+    return args
+
+
+def read_batches(path, max_records=None) -> list:
+    """
+    Reads the Firehose batches of a file written by 'ses_blog_events.py', with '--firehose'
+    or without it, in which case the events are packed into batches.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        items = [json.loads(line) for line in f if line.strip()]
+    if items and "records" in items[0]:
+        return items
+    return list(firehose_batches(iter(items), max_records=max_records))
+
+
+def vcpus(memory_mb) -> float:
+    """
+    Returns the vCPUs AWS Lambda allocates to a function with 'memory_mb' of memory.
+    """
+    return min(MAX_VCPUS, memory_mb / FULL_VCPU_MB)
+
+
+def _worker_pids():
+    return [p.pid for p in multiprocessing.active_children()]
+
+
+def _children_cpu_seconds(pids) -> float:
+    # utime + stime of the live worker processes of PROCESSING_MODE=process
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total / ticks
+
+
+def _children_peak_rss_kb(pids) -> int:
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        total += int(line.split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def cgroup_v2() -> bool:
+    """
+    Whether CGROUP_ROOT is a cgroup v2 hierarchy, the only one join_cgroup supports.
+    """
+    return os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers"))
+
+
+def join_cgroup(cpu_quota, name):
+    """
+    Moves the calling process into the cgroup v2 'name', limited to 'cpu_quota' CPUs.
+    """
+    path = os.path.join(CGROUP_ROOT, name)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, "cpu.max"), "w") as f:
+        f.write(f"{int(cpu_quota * CGROUP_PERIOD_US)} {CGROUP_PERIOD_US}")
+    with open(os.path.join(path, "cgroup.procs"), "w") as f:
+        f.write(str(os.getpid()))
+
+
+_HANDLER = None
+_BATCHES = None
+
+
+def _init_environment(environment, batches, cpus, cpu_quota, cgroup_prefix):
+    global _HANDLER, _BATCHES
+    if cpus:
+        os.sched_setaffinity(0, list(sorted(os.sched_getaffinity(0)))[:cpus])
+    if cpu_quota:
+        # one cgroup per environment: the quota of a Lambda function applies to each one
+        join_cgroup(cpu_quota, f"{cgroup_prefix}-{os.getpid()}")
+    _HANDLER = load_handler(environment).lambda_handler
+    _BATCHES = batches
+    _HANDLER(_copy_batch(batches[0]), None)     # cold start, not measured
+
+
+def _invoke(i, scheduled) -> dict:
+    batch = _copy_batch(_BATCHES[i % len(_BATCHES)])
+    children = _worker_pids()
+    start = time.time()
+    cpu = time.process_time()
+    children_cpu = _children_cpu_seconds(children)
+    _HANDLER(batch, None)
+    wall = time.time() - start
+    children = _worker_pids()
+    cpu = time.process_time() - cpu + _children_cpu_seconds(children) - children_cpu
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + _children_peak_rss_kb(children)
+    return {"records": len(batch["records"]), "wall": wall, "cpu": cpu, "peak_rss_mb": peak_kb / 1024,
+            "start": start, "latency": start + wall - scheduled}
+
+
+def replay(batches, environment=None, invocations=200, concurrency=1, rate=0.0, cpus=None, cpu_quota=None) -> dict:
+    """
+    Replays 'invocations' batches against the function in 'concurrency' execution
+    environments, at 'rate' records per second (as fast as possible if 0), and returns the
+    measurements of the invocations.
+    """
+    records_per_batch = sum(len(b["records"]) for b in batches) / len(batches)
+    interval = records_per_batch / rate if rate else 0.0
+    initargs = (dict(environment or {}), batches, cpus, cpu_quota, f"ses-blog-loadtest-{os.getpid()}")
+    with ProcessPoolExecutor(max_workers=concurrency, initializer=_init_environment, initargs=initargs) as pool:
+        # wait for the cold starts of all the environments
+        list(pool.map(time.sleep, [0.01] * concurrency))
+        begin = time.time()
+        futures = []
+        for i in range(invocations):
+            scheduled = begin + i * interval
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(_invoke, i, scheduled))
+        invocations = [f.result() for f in futures]
+    elapsed = max(i["start"] + i["wall"] for i in invocations) - begin
+    records = sum(i["records"] for i in invocations)
+    return {
+        "invocations": invocations,
+        "records": records,
+        "elapsed": elapsed,
+        "records_per_second": records / elapsed,
+        "target_records_per_second": rate,
+        "p50_latency_ms": percentile([i["latency"] for i in invocations], 50) * 1000,
+        "p99_latency_ms": percentile([i["latency"] for i in invocations], 99) * 1000,
+        "peak_rss_mb": max(i["peak_rss_mb"] for i in invocations),
+    }
+
+
+def cost_model(measurements, parallelism=1, measured_cpus=1.0, architecture="x86_64", headroom=0.25,
+               max_duration=30.0, rate=0.0, memory_sizes=MEMORY_SIZES) -> list:
+    """
+    Models the invocations of the replay at each memory size and returns one row per size.
+
+    Parameters
+    ----------
+    measurements : dict
+        The result of 'replay'
+    parallelism : int
+        CPUs the function can use at once: 1 in serial or thread mode, the workers in
+        process mode
+    measured_cpus : float
+        CPUs each environment had during the replay, fractional when they shared CPUs
+    architecture : str
+        x86_64 or arm64
+    headroom : float
+        Memory kept free above the peak, as a fraction of it
+    max_duration : float
+        Maximum p99 duration of an invocation, in seconds
+    rate : float
+        Target rate in records per second, for the concurrency needed
+
+    Returns
+    -------
+    list
+        For each memory size: the vCPUs, p50 and p99 durations, cost per million events,
+        concurrency needed and whether the size is feasible
+    """
+    invocations = measurements["invocations"]
+    records = sum(i["records"] for i in invocations)
+    used = min(parallelism, measured_cpus)
+    # time not spent on CPU (waits, pool hand-offs) does not depend on the memory size
+    waits = [max(0.0, i["wall"] - i["cpu"] / used) for i in invocations]
+    required_mb = measurements["peak_rss_mb"] * (1 + headroom)
+    price = PRICE_PER_GB_SECOND[architecture]
+    rows = []
+    for memory in memory_sizes:
+        cpus = min(parallelism, vcpus(memory))
+        durations = [w + i["cpu"] / cpus for w, i in zip(waits, invocations)]
+        billed = sum(math.ceil(d * 1000) / 1000 for d in durations)
+        cost = billed * memory / 1024 * price + len(invocations) * PRICE_PER_REQUEST
+        mean = sum(durations) / len(durations)
+        p99 = percentile(durations, 99)
+        rows.append({
+            "memory_mb": memory,
+            "vcpus": round(vcpus(memory), 3),
+            "p50_duration_ms": percentile(durations, 50) * 1000,
+            "p99_duration_ms": p99 * 1000,
+            "cost_per_million_events": cost / records * 1e6,
+            "concurrency_needed": rate * mean / (records / len(invocations)) if rate else None,
+            "feasible": memory >= required_mb and p99 <= max_duration,
+        })
+    return rows
+
+
+def recommend(rows):
+    """
+    Returns the feasible row with the lowest cost per million events, the fastest one among
+    equal costs, or None if no memory size is feasible.
+    """
+    feasible = [r for r in rows if r["feasible"]]
+    if not feasible:
+        return None
+    return min(feasible, key=lambda r: (round(r["cost_per_million_events"], 6), r["p99_duration_ms"]))
+
+
+def main(args):
+    if args.cpu_quota and not cgroup_v2():
+        logging.error(f"{CGROUP_ROOT} is not a cgroup v2 hierarchy, use --cpus to limit the CPUs instead")
+        sys.exit(1)
+    environment = {"METRICS_ENABLED": "false"}
+    if args.mode:
+        environment["PROCESSING_MODE"] = args.mode
+    if args.workers:
+        environment["PROCESSING_WORKERS"] = str(args.workers)
+    if args.output_format:
+        environment["OUTPUT_FORMAT"] = args.output_format
+
+    if args.input:
+        batches = read_batches(args.input, args.batch_records or None)
+    else:
+        generator = SESEventGenerator(mix=parse_mix(args.mix) if args.mix else None, fanout=args.fanout, seed=args.seed)
+        batches = list(firehose_batches(generator.events(args.count), max_records=args.batch_records or None, seed=args.seed))
+    logging.info(f"Replaying {args.invocations} invocations of {len(batches)} batches, "
+                 f"concurrency {args.concurrency}, rate {args.rate or 'unbounded'} records/s")
+
+    measurements = replay(batches, environment, args.invocations, args.concurrency, args.rate,
+                          cpus=args.cpus, cpu_quota=args.cpu_quota)
+    logging.info(f"{measurements['records_per_second']:,.0f} records/s, latency p50 "
+                 f"{measurements['p50_latency_ms']:.1f} ms, p99 {measurements['p99_latency_ms']:.1f} ms, "
+                 f"peak RSS {measurements['peak_rss_mb']:.1f} MB")
+
+    # CPUs of each environment: its quota, or its share of the CPUs when there are more
+    # environments than CPUs
+    available = len(os.sched_getaffinity(0))
+    measured_cpus = min(args.cpu_quota or available, (args.cpus or available) / args.concurrency)
+    parallelism = 1
+    if args.mode == "process":
+        parallelism = args.workers or available
+    rows = cost_model(measurements, parallelism, measured_cpus, args.architecture, args.headroom,
+                      args.max_duration, args.rate)
+    print(f"{'memory MB':>10} {'vCPU':>6} {'p50 ms':>9} {'p99 ms':>9} {'$/1M events':>12} {'concurrency':>12}")
+    for r in rows:
+        concurrency = f"{r['concurrency_needed']:.1f}" if r["concurrency_needed"] is not None else "-"
+        print(f"{r['memory_mb']:>10} {r['vcpus']:>6.2f} {r['p50_duration_ms']:>9.1f} {r['p99_duration_ms']:>9.1f} "
+              f"{r['cost_per_million_events']:>12.4f} {concurrency:>12}{'' if r['feasible'] else '  (not feasible)'}")
+
+    best = recommend(rows)
+    if best is None:
+        logging.warning("No memory size holds the peak memory within the maximum duration")
+    else:
+        logging.info(f"Recommended memory size: {best['memory_mb']} MB "
+                     f"(${best['cost_per_million_events']:.4f} per million events, p99 {best['p99_duration_ms']:.0f} ms)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"measurements": {k: v for k, v in measurements.items() if k != "invocations"},
+                       "model": rows, "recommended_memory_mb": best and best["memory_mb"]}, f, indent=2)
+        logging.info(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,393 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script registers the hour partitions of the 'partitioned' table in the AWS Glue Data
+Catalog as the objects are written, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+A crawl of the whole 'partitioned/' prefix takes longer as history grows, so the
+'SESEventDataCrawler' only runs on demand, to create the tables and pick up new columns. Once
+the crawler has created a table, 'PartitionManager' adds the missing 'year=/month=/day=/hour='
+partitions with batched BatchCreatePartition calls, keeping the partitions already in the
+catalog in memory so each one is created once. It runs:
+    - as an AWS Lambda function, with 'lambda_handler', subscribed to the S3 notifications of
+      the objects written under 'partitioned/' and 'hourly_rollups/' ('GLUE_DATABASE',
+      'GLUE_TABLE' and 'GLUE_ROLLUP_TABLE' environment variables);
+    - from the command line, with the 'sync' command, which lists the objects of the bucket
+      and registers the partitions missing from the catalog.
+
+As an alternative, the 'projection' command generates the definition of a table that uses
+Amazon Athena partition projection: Athena computes the partitions from the query filters
+and the table never needs to be crawled or updated.
+
+Both commands accept '--endpoint-url', so they can be run against a local AWS stand-in such
+as moto. This script requires 'boto3'.
+"""
+
+import argparse
+import copy
+import json
+import logging
+import os
+import re
+import sys
+from urllib.parse import unquote_plus
+
+import boto3
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TransformationLambdaCode")
+if LAMBDA_DIR not in sys.path:
+    sys.path.insert(0, LAMBDA_DIR)
+
+from partitioning import PARTITION_KEYS, PARTITION_TEMPLATE, hour_values, partition_path
+from ses_blog_storage import open_store
+
+logging.basicConfig(level=logging.INFO)
+
+PARTITION_PATTERN = re.compile(r"(?:^|/)year=(\d{4})/month=(\d{1,2})/day=(\d{1,2})/hour=(\d{1,2})/")
+# maximum number of partitions of a BatchCreatePartition call
+MAX_BATCH_SIZE = 100
+
+DEFAULT_DATABASE = "ses_event_data_database"
+DEFAULT_TABLE = "partitioned"
+DEFAULT_ROLLUP_TABLE = "hourly_rollups"
+# prefixes of the objects whose partitions the Lambda function registers, with the
+# environment variable and default of their table
+TABLE_PREFIXES = (("partitioned/", "GLUE_TABLE", DEFAULT_TABLE),
+                  ("hourly_rollups/", "GLUE_ROLLUP_TABLE", DEFAULT_ROLLUP_TABLE))
+
+# Columns of the flat JSON records written by the transformation Lambda function, used when
+# there is no crawled table to take the schema from
+DEFAULT_COLUMNS = [
+    ("eventtype", "string"), ("timestamp", "string"), ("ipaddress", "string"),
+    ("useragent", "string"), ("link", "string"), ("messageid", "string"),
+    ("processingtimemillis", "bigint"), ("bouncetype", "string"), ("feedbackid", "string"),
+    ("complaintfeedbacktype", "string"), ("reason", "string"), ("errormessage", "string"),
+    ("templatename", "string"), ("delaytype", "string"), ("expirationtime", "string"),
+    ("subject", "string"), ("recipientevent", "string"), ("recipientmail", "string"),
+    ("mailrecipientdomain", "string"), ("sender", "string"), ("sesoutgoingip", "string"),
+    ("sessourceip", "string"),
+]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-partitions',
+                    description='Registers the hour partitions of the partitioned table in the AWS Glue Data Catalog',
+                    epilog='Check the README for more information')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync = subparsers.add_parser('sync', help="Register the partitions of the objects of a bucket")
+    sync.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory")
+    sync.add_argument('--prefix', default='partitioned/', metavar='', help="Prefix of the partitions")
+
+    projection = subparsers.add_parser('projection', help="Generate a table definition that uses partition projection")
+    projection.add_argument('--name', default='partitioned_projection', metavar='', help="Name of the generated table")
+    projection.add_argument('--location', metavar='', help="s3://<bucket>/<prefix>/ of the data (default: the location of --table)")
+    projection.add_argument('--start-year', type=int, default=2023, metavar='', help="First year of the projected partitions")
+    projection.add_argument('--end-year', type=int, default=2035, metavar='', help="Last year of the projected partitions")
+    projection.add_argument('--apply', action='store_true', help="Create or update the table instead of printing its definition")
+
+    for subparser in (sync, projection):
+        subparser.add_argument('--database', default=DEFAULT_DATABASE, metavar='', help="AWS Glue database")
+        subparser.add_argument('--table', default=DEFAULT_TABLE, metavar='', help="AWS Glue table")
+        subparser.add_argument('-r', '--region', metavar='', help="AWS Region")
+        subparser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+        subparser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local AWS stand-in")
+    args = parser.parse_args()
+
+    return args
+
+
+def partition_values(key):
+    """
+    Returns the (year, month, day, hour) values of the partition of an object key, or None.
+    The partition must be written in the layout of the producers, 'PARTITION_TEMPLATE' of the
+    transformation Lambda function, without leading zeros: the location registered for the
+    partition and the partition projection template are built from that layout, and would
+    not match a key like 'month=01'.
+    """
+    match = PARTITION_PATTERN.search(key)
+    if match is None:
+        return None
+    values = hour_values(*match.groups())
+    if match.group(0).lstrip("/") != f"{partition_path(values)}/":
+        return None
+    return values
+
+
+class PartitionManager:
+    """
+    Adds partitions to a table of the AWS Glue Data Catalog, skipping the partitions it
+    already knows of.
+
+    Parameters
+    ----------
+    client : botocore.client.Glue
+        The boto3 client for AWS Glue
+    database : str
+        The AWS Glue database
+    table : str
+        The partitioned table, which must exist
+    batch_size : int
+        Partitions per BatchCreatePartition call, at most 100
+    """
+
+    def __init__(self, client, database=DEFAULT_DATABASE, table=DEFAULT_TABLE, batch_size=MAX_BATCH_SIZE):
+        self.client = client
+        self.database = database
+        self.table_name = table
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self._table = None
+        self._known = None
+
+    @property
+    def table(self) -> dict:
+        if self._table is None:
+            self._table = self.client.get_table(DatabaseName=self.database, Name=self.table_name)["Table"]
+        return self._table
+
+    @property
+    def known(self) -> set:
+        """
+        The values of the partitions of the table, read once from the catalog and kept up to
+        date with the partitions created since.
+        """
+        if self._known is None:
+            known = set()
+            paginator = self.client.get_paginator("get_partitions")
+            for page in paginator.paginate(DatabaseName=self.database, TableName=self.table_name,
+                                           ExcludeColumnSchema=True):
+                for partition in page["Partitions"]:
+                    known.add(tuple(partition["Values"]))
+            self._known = known
+        return self._known
+
+    def partition_input(self, values) -> dict:
+        """
+        Returns the PartitionInput of 'values', with the storage descriptor of the table.
+        """
+        names = tuple(k["Name"] for k in self.table.get("PartitionKeys", []))
+        if names != PARTITION_KEYS:
+            raise ValueError(f"The partition keys of {self.database}.{self.table_name} are {', '.join(names)}, "
+                             f"expected {', '.join(PARTITION_KEYS)}")
+        descriptor = copy.deepcopy(self.table["StorageDescriptor"])
+        descriptor["Location"] = f"{descriptor['Location'].rstrip('/')}/{partition_path(values)}/"
+        return {"Values": list(values), "StorageDescriptor": descriptor}
+
+    def register(self, partitions) -> list:
+        """
+        Creates the partitions of 'partitions' missing from the catalog and returns the values
+        of the ones created.
+        """
+        known = self.known
+        missing = sorted({tuple(p) for p in partitions} - known,
+                         key=lambda p: tuple(int(v) if v.isdigit() else v for v in p))
+        created = []
+        for i in range(0, len(missing), self.batch_size):
+            created.extend(self._create(missing[i:i + self.batch_size]))
+        return created
+
+    def register_keys(self, keys) -> list:
+        """
+        Creates the partitions of the objects 'keys' missing from the catalog. Keys whose
+        partition isn't written in the layout of the producers are skipped.
+        """
+        partitions = []
+        for key in keys:
+            values = partition_values(key)
+            if values is not None:
+                partitions.append(values)
+            elif PARTITION_PATTERN.search(key):
+                logging.warning(f"{key} isn't in a {PARTITION_TEMPLATE} partition without leading zeros, skipped")
+        return self.register(partitions)
+
+    def sync(self, store, prefix="partitioned/") -> list:
+        """
+        Creates the partitions of the objects under 'prefix' missing from the catalog.
+        """
+        return self.register_keys(o.key for o in store.list(prefix))
+
+    def set_location(self, values, location):
+        """
+        Points the partition of 'values' to 'location' with a single UpdatePartition call, so
+        queries read either the objects of the previous location or those of the new one. The
+        partition is created if it is missing.
+        """
+        try:
+            partition = self.client.get_partition(DatabaseName=self.database, TableName=self.table_name,
+                                                  PartitionValues=list(values))["Partition"]
+        except self.client.exceptions.EntityNotFoundException:
+            partition_input = self.partition_input(values)
+            partition_input["StorageDescriptor"]["Location"] = location
+            self.client.create_partition(DatabaseName=self.database, TableName=self.table_name,
+                                         PartitionInput=partition_input)
+        else:
+            descriptor = copy.deepcopy(partition["StorageDescriptor"])
+            descriptor["Location"] = location
+            partition_input = {"Values": list(values), "StorageDescriptor": descriptor}
+            if partition.get("Parameters"):
+                partition_input["Parameters"] = partition["Parameters"]
+            self.client.update_partition(DatabaseName=self.database, TableName=self.table_name,
+                                         PartitionValueList=list(values), PartitionInput=partition_input)
+        if self._known is not None:
+            self._known.add(tuple(values))
+
+    def _create(self, batch) -> list:
+        response = self.client.batch_create_partition(
+            DatabaseName=self.database,
+            TableName=self.table_name,
+            PartitionInputList=[self.partition_input(values) for values in batch])
+        failed = set()
+        for error in response.get("Errors", []):
+            values = tuple(error["PartitionValues"])
+            code = error.get("ErrorDetail", {}).get("ErrorCode")
+            if code == "AlreadyExistsException":
+                self._known.add(values)
+            else:
+                logging.error(f"Couldn't create partition {values}: {error.get('ErrorDetail')}")
+            failed.add(values)
+        created = [values for values in batch if values not in failed]
+        self._known.update(created)
+        if created:
+            logging.info(f"{len(created)} partitions created in {self.database}.{self.table_name}")
+        return created
+
+
+def projection_table_input(name, location, template=None, start_year=2023, end_year=2035) -> dict:
+    """
+    Returns the TableInput of a table that uses Amazon Athena partition projection for the
+    year, month, day and hour partitions under 'location'.
+
+    Parameters
+    ----------
+    name : str
+        The name of the table
+    location : str
+        s3://<bucket>/<prefix>/ of the partitions
+    template : dict
+        A table of the AWS Glue Data Catalog whose columns and storage format are used, the
+        flat JSON records of the transformation Lambda function if None
+    start_year : int
+        First year of the projected partitions
+    end_year : int
+        Last year of the projected partitions
+    """
+    location = location.rstrip("/") + "/"
+    if template is not None:
+        descriptor = copy.deepcopy(template["StorageDescriptor"])
+        parameters = {k: v for k, v in template.get("Parameters", {}).items()
+                      if not k.startswith(("projection.", "storage.location.template"))
+                      and k not in ("UPDATED_BY_CRAWLER", "CrawlerSchemaDeserializerVersion",
+                                    "CrawlerSchemaSerializerVersion", "averageRecordSize",
+                                    "objectCount", "recordCount", "sizeKey")}
+    else:
+        descriptor = {
+            "Columns": [{"Name": n, "Type": t} for n, t in DEFAULT_COLUMNS],
+            "InputFormat": "org.apache.hadoop.mapred.TextInputFormat",
+            "OutputFormat": "org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat",
+            "SerdeInfo": {
+                "SerializationLibrary": "org.openx.data.jsonserde.JsonSerDe",
+                "Parameters": {"case.insensitive": "TRUE", "ignore.malformed.json": "TRUE"},
+            },
+        }
+        parameters = {"classification": "json", "compressionType": "gzip"}
+    descriptor["Location"] = location
+
+    parameters.update({
+        "projection.enabled": "true",
+        "projection.year.type": "integer",
+        "projection.year.range": f"{start_year},{end_year}",
+        "projection.month.type": "integer",
+        "projection.month.range": "1,12",
+        "projection.day.type": "integer",
+        "projection.day.range": "1,31",
+        "projection.hour.type": "integer",
+        "projection.hour.range": "0,23",
+        "storage.location.template": location + PARTITION_TEMPLATE.replace("{", "${"),
+    })
+    return {
+        "Name": name,
+        "TableType": "EXTERNAL_TABLE",
+        "Parameters": parameters,
+        "StorageDescriptor": descriptor,
+        "PartitionKeys": [{"Name": k, "Type": "string"} for k in PARTITION_KEYS],
+    }
+
+
+def apply_table(client, database, table_input):
+    """
+    Creates the table described by 'table_input', or updates it if it exists.
+    """
+    try:
+        client.create_table(DatabaseName=database, TableInput=table_input)
+        logging.info(f"Table {database}.{table_input['Name']} created")
+    except client.exceptions.AlreadyExistsException:
+        client.update_table(DatabaseName=database, TableInput=table_input)
+        logging.info(f"Table {database}.{table_input['Name']} updated")
+
+
+# partition managers of the Lambda function by prefix, kept across warm invocations with their
+# cache
+MANAGERS = None
+
+
+def lambda_handler(event, context):
+    """
+    Registers the partitions of the objects of an S3 event notification, in the table of the
+    prefix of each object.
+    """
+    global MANAGERS
+    if MANAGERS is None:
+        client = boto3.client("glue")
+        database = os.environ.get("GLUE_DATABASE", DEFAULT_DATABASE)
+        MANAGERS = {prefix: PartitionManager(client, database, os.environ.get(variable, default))
+                    for prefix, variable, default in TABLE_PREFIXES}
+    keys = [unquote_plus(record["s3"]["object"]["key"]) for record in event.get("Records", []) if "s3" in record]
+    created = []
+    for prefix, manager in MANAGERS.items():
+        table_keys = [key for key in keys if key.startswith(prefix)]
+        if not table_keys:
+            continue
+        try:
+            values = manager.register_keys(table_keys)
+        except manager.client.exceptions.EntityNotFoundException:
+            # the table is created by the first run of the crawler, the partitions of the
+            # objects written before are added by that run
+            logging.warning(f"Table {manager.database}.{manager.table_name} not found, "
+                            f"{len(table_keys)} objects skipped")
+            continue
+        created.extend(f"{manager.table_name}/{partition_path(v)}" for v in values)
+    return {"created": created}
+
+
+def main(args):
+    session = boto3.Session(profile_name=args.profile, region_name=args.region)
+    client = session.client("glue", endpoint_url=args.endpoint_url)
+
+    if args.command == "sync":
+        store = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+        manager = PartitionManager(client, args.database, args.table)
+        created = manager.sync(store, args.prefix)
+        logging.info(f"{len(created)} partitions created, {len(manager.known)} partitions in {args.database}.{args.table}")
+        return
+
+    template = None
+    try:
+        template = client.get_table(DatabaseName=args.database, Name=args.table)["Table"]
+    except client.exceptions.EntityNotFoundException:
+        if not args.location:
+            raise
+        logging.info(f"Table {args.database}.{args.table} not found, using the flat JSON records schema")
+    location = args.location or template["StorageDescriptor"]["Location"]
+    table_input = projection_table_input(args.name, location, template, args.start_year, args.end_year)
+    if args.apply:
+        apply_table(client, args.database, table_input)
+    else:
+        print(json.dumps(table_input, indent=2))
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
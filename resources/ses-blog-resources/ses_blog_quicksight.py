@@ -0,0 +1,480 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This module provisions the Amazon QuickSight resources of 'ses-blog-utils.py', in the context
+of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+The data source, the datasets and the dashboard are steps of a dependency graph: a step
+starts as soon as the steps it depends on are done, so the datasets are created together
+once the data source is available, and the dashboard once its dataset is. Every step is
+idempotent: a resource that already exists is updated (or left alone when it is unchanged)
+instead of failing the run, so the script can be run again after a partial failure or to
+roll out a new dashboard definition.
+
+Asynchronous operations are awaited by polling with exponential backoff and jitter, up to a
+deadline, instead of a fixed one second loop.
+
+Dashboards of several tenants (configuration sets, business units) are rendered from one
+parsed dashboard template, each with its own dataset, identifiers and default filters, and
+deployed as steps of the same graph, a bounded number at a time.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from botocore.exceptions import ClientError
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ProvisioningError(Exception):
+    """
+    Raised when a resource reaches a failed state or when steps of a graph failed.
+    """
+
+
+def wait_until(poll, description, timeout=600.0, initial_delay=1.0, max_delay=20.0,
+               sleep=time.sleep, clock=time.monotonic, jitter=random.random):
+    """
+    Calls 'poll' until it returns something else than None and returns it. The delay between
+    two calls doubles from 'initial_delay' up to 'max_delay', and a random half of it is
+    dropped, so that concurrent waiters don't poll in lockstep.
+
+    Parameters
+    ----------
+    poll : callable
+        Returns None while the operation is in progress, raises if it failed
+    description : str
+        What is awaited, for the messages
+    timeout : float
+        Seconds after which TimeoutError is raised
+
+    Returns
+    -------
+    object
+        The first value returned by 'poll' that is not None
+    """
+    deadline = clock() + timeout
+    delay = initial_delay
+    while True:
+        result = poll()
+        if result is not None:
+            return result
+        remaining = deadline - clock()
+        if remaining <= 0:
+            raise TimeoutError(f"Timed out after {timeout:.0f}s waiting for {description}")
+        sleep(min(remaining, delay * (0.5 + jitter() / 2)))
+        delay = min(max_delay, delay * 2)
+
+
+class Step:
+    """
+    A step of a provisioning graph.
+
+    Parameters
+    ----------
+    name : str
+        Unique name of the step
+    action : callable
+        Called with a dict of the results of the steps it depends on, returns its result
+    requires : tuple
+        Names of the steps that must succeed first
+    """
+
+    def __init__(self, name, action, requires=()):
+        self.name = name
+        self.action = action
+        self.requires = tuple(requires)
+
+
+def _topological_order(steps) -> list:
+    by_name = {}
+    for step in steps:
+        if step.name in by_name:
+            raise ValueError(f"Duplicate step '{step.name}'")
+        by_name[step.name] = step
+    for step in steps:
+        missing = [r for r in step.requires if r not in by_name]
+        if missing:
+            raise ValueError(f"Step '{step.name}' requires unknown steps {missing}")
+
+    order = []
+    state = {}
+
+    def visit(step, path):
+        if state.get(step.name) == "done":
+            return
+        if state.get(step.name) == "visiting":
+            raise ValueError(f"Cycle between steps {path + [step.name]}")
+        state[step.name] = "visiting"
+        for name in step.requires:
+            visit(by_name[name], path + [step.name])
+        state[step.name] = "done"
+        order.append(step)
+
+    for step in steps:
+        visit(step, [])
+    return order
+
+
+def run_steps(steps, max_workers=4) -> dict:
+    """
+    Runs a graph of steps, each one as soon as the steps it requires succeeded, at most
+    'max_workers' at a time. When a step fails, the steps that depend on it are skipped and
+    the others still run. With 'max_workers=1', steps run one at a time in a topological
+    order that follows the order of 'steps', which makes the calls predictable.
+
+    Parameters
+    ----------
+    steps : list
+        The Step of the graph
+    max_workers : int
+        Number of steps run concurrently
+
+    Returns
+    -------
+    dict
+        The results of the steps, by name
+
+    Raises
+    ------
+    ProvisioningError
+        If a step failed, once all the steps that could run are done
+    """
+    pending = _topological_order(steps)
+    results = {}
+    failed = {}
+    skipped = []
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            # Pending steps are in topological order: a step whose requirement was just
+            # skipped is skipped in the same pass
+            for step in list(pending):
+                if any(r in failed or r in skipped for r in step.requires):
+                    skipped.append(step.name)
+                    pending.remove(step)
+                elif all(r in results for r in step.requires):
+                    inputs = {r: results[r] for r in step.requires}
+                    running[pool.submit(step.action, inputs)] = step.name
+                    pending.remove(step)
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    logging.error(f"Step '{name}' failed: {e}")
+                    failed[name] = e
+
+    if failed:
+        message = "; ".join(f"{name}: {e}" for name, e in failed.items())
+        if skipped:
+            message += f" (skipped: {', '.join(skipped)})"
+        raise ProvisioningError(message)
+    return results
+
+
+def _error_code(error) -> str:
+    return error.response.get("Error", {}).get("Code", "")
+
+
+def _version_number(version_arn) -> int:
+    return int(version_arn.rsplit("/", 1)[1])
+
+
+class QuickSightProvisioner:
+    """
+    Creates or updates Amazon QuickSight resources of an account. The client is shared by
+    the threads of 'run_steps', which boto3 clients support.
+
+    Parameters
+    ----------
+    client : botocore.client.QuickSight
+        The boto3 client for Amazon QuickSight
+    account_id : str
+        The AWS account ID where the resources are created
+    region : str
+        AWS Region where the resources are created
+    timeout : float
+        Seconds to wait for each asynchronous operation
+    sleep : callable
+        Used between polls, replaced in tests
+    """
+
+    def __init__(self, client, account_id, region, timeout=600.0, sleep=time.sleep):
+        self.client = client
+        self.account_id = account_id
+        self.region = region
+        self.timeout = timeout
+        self.sleep = sleep
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def arn(self, resource_type, resource_id) -> str:
+        return f"arn:aws:quicksight:{self.region}:{self.account_id}:{resource_type}/{resource_id}"
+
+    def list_users(self, namespace="default") -> list:
+        """
+        Returns all the users of 'namespace', following the pagination. The list is read once
+        per namespace and cached.
+        """
+        with self._lock:
+            if namespace not in self._users:
+                users = []
+                paginator = self.client.get_paginator("list_users")
+                for page in paginator.paginate(AwsAccountId=self.account_id, Namespace=namespace):
+                    users.extend(page.get("UserList", []))
+                logging.info(f"{len(users)} Amazon QuickSight users in namespace '{namespace}'")
+                self._users[namespace] = users
+            return self._users[namespace]
+
+    def find_user(self, namespace="default", user_name=None) -> str:
+        """
+        Returns the ARN of the user named 'user_name' or, by default, of the first active
+        ADMIN user of 'namespace'.
+        """
+        users = self.list_users(namespace)
+        if user_name is not None:
+            matches = [u for u in users if u.get("UserName") == user_name]
+        else:
+            matches = [u for u in users if u.get("Role") == "ADMIN" and u.get("Active", True)]
+        if not matches:
+            wanted = f"user '{user_name}'" if user_name else "active ADMIN user"
+            raise ProvisioningError(f"No {wanted} in the Amazon QuickSight namespace '{namespace}'")
+        return matches[0]["Arn"]
+
+    def _describe(self, method, key, **kwargs):
+        try:
+            return getattr(self.client, method)(AwsAccountId=self.account_id, **kwargs)[key]
+        except ClientError as e:
+            if _error_code(e) == "ResourceNotFoundException":
+                return None
+            raise
+
+    def _wait_for_status(self, description, describe):
+        def poll():
+            status = describe()
+            if status.endswith("_SUCCESSFUL"):
+                return status
+            if status.endswith("_FAILED"):
+                raise ProvisioningError(f"{description} is {status}")
+            return None
+
+        return wait_until(poll, description, timeout=self.timeout, sleep=self.sleep)
+
+    def upsert_data_source(self, data_source_id, name, data_source_type, parameters, permissions) -> str:
+        """
+        Creates the data source, or updates it if its name or parameters changed, waits until
+        it is available and returns its ARN.
+        """
+        current = self._describe("describe_data_source", "DataSource", DataSourceId=data_source_id)
+        if current is None:
+            logging.info(f"Creating Amazon QuickSight data source {data_source_id} ...")
+            self.client.create_data_source(
+                AwsAccountId=self.account_id, DataSourceId=data_source_id, Name=name,
+                Type=data_source_type, DataSourceParameters=parameters, Permissions=permissions)
+        else:
+            self.client.update_data_source_permissions(
+                AwsAccountId=self.account_id, DataSourceId=data_source_id, GrantPermissions=permissions)
+            if current.get("Name") == name and current.get("DataSourceParameters") == parameters:
+                logging.info(f"Amazon QuickSight data source {data_source_id} is up to date")
+                return current["Arn"]
+            logging.info(f"Updating Amazon QuickSight data source {data_source_id} ...")
+            self.client.update_data_source(
+                AwsAccountId=self.account_id, DataSourceId=data_source_id, Name=name,
+                DataSourceParameters=parameters)
+
+        self._wait_for_status(
+            f"data source {data_source_id}",
+            lambda: self._describe("describe_data_source", "DataSource", DataSourceId=data_source_id)["Status"])
+        return self.arn("datasource", data_source_id)
+
+    def upsert_data_set(self, data_set_id, name, physical_table_map, logical_table_map,
+                        import_mode, permissions) -> str:
+        """
+        Creates the dataset, or updates it if its definition changed, and returns its ARN.
+        """
+        definition = dict(Name=name, PhysicalTableMap=physical_table_map,
+                          LogicalTableMap=logical_table_map, ImportMode=import_mode)
+        current = self._describe("describe_data_set", "DataSet", DataSetId=data_set_id)
+        if current is None:
+            logging.info(f"Creating Amazon QuickSight dataset {data_set_id} ...")
+            self.client.create_data_set(AwsAccountId=self.account_id, DataSetId=data_set_id,
+                                        Permissions=permissions, **definition)
+            return self.arn("dataset", data_set_id)
+
+        self.client.update_data_set_permissions(
+            AwsAccountId=self.account_id, DataSetId=data_set_id, GrantPermissions=permissions)
+        if all(current.get(k) == v for k, v in definition.items()):
+            logging.info(f"Amazon QuickSight dataset {data_set_id} is up to date")
+        else:
+            logging.info(f"Updating Amazon QuickSight dataset {data_set_id} ...")
+            self.client.update_data_set(AwsAccountId=self.account_id, DataSetId=data_set_id, **definition)
+        return current["Arn"]
+
+    def upsert_dashboard(self, dashboard_id, name, definition, permissions, publish_options,
+                         theme_arn=None, version_description="1") -> str:
+        """
+        Creates the dashboard or, if it exists, a new version of it, waits until the version
+        is created, publishes it and returns the ARN of the dashboard.
+        """
+        kwargs = dict(AwsAccountId=self.account_id, DashboardId=dashboard_id, Name=name,
+                      Definition=definition, VersionDescription=version_description,
+                      DashboardPublishOptions=publish_options)
+        if theme_arn:
+            kwargs["ThemeArn"] = theme_arn
+        current = self._describe("describe_dashboard", "Dashboard", DashboardId=dashboard_id)
+        if current is None:
+            logging.info(f"Creating Amazon QuickSight dashboard {dashboard_id} ...")
+            response = self.client.create_dashboard(Permissions=permissions, **kwargs)
+        else:
+            logging.info(f"Updating Amazon QuickSight dashboard {dashboard_id} ...")
+            self.client.update_dashboard_permissions(
+                AwsAccountId=self.account_id, DashboardId=dashboard_id, GrantPermissions=permissions)
+            response = self.client.update_dashboard(**kwargs)
+
+        version = _version_number(response["VersionArn"])
+        self._wait_for_status(
+            f"dashboard {dashboard_id} version {version}",
+            lambda: self._describe("describe_dashboard", "Dashboard", DashboardId=dashboard_id,
+                                   VersionNumber=version)["Version"]["Status"])
+        if current is not None:
+            self.client.update_dashboard_published_version(
+                AwsAccountId=self.account_id, DashboardId=dashboard_id, VersionNumber=version)
+        logging.info(f"Amazon QuickSight dashboard {dashboard_id} version {version} published")
+        return self.arn("dashboard", dashboard_id)
+
+
+class DashboardTemplate:
+    """
+    A parsed dashboard definition, rendered for several datasets and tenants. Rendering
+    copies only the parts of the definition that change (the dataset declarations and the
+    filter groups): the sheets, visuals and calculated fields are shared by all the rendered
+    definitions, which must therefore not be modified.
+
+    Parameters
+    ----------
+    definition : dict
+        The dashboard definition, whose first dataset declaration is replaced on rendering
+    """
+
+    _cache = {}
+    _cache_lock = threading.Lock()
+
+    def __init__(self, definition):
+        self.definition = definition
+        self.identifier = definition["DataSetIdentifierDeclarations"][0]["Identifier"]
+        self.sheet_ids = [sheet["SheetId"] for sheet in definition.get("Sheets", [])]
+
+    @classmethod
+    def from_file(cls, path):
+        """
+        Returns the template of a JSON file, parsed once and cached until the file changes.
+        """
+        path = os.path.abspath(path)
+        mtime = os.stat(path).st_mtime_ns
+        with cls._cache_lock:
+            cached = cls._cache.get(path)
+            if cached is None or cached[0] != mtime:
+                with open(path) as f:
+                    cached = (mtime, cls(json.load(f)))
+                cls._cache[path] = cached
+            return cached[1]
+
+    def render(self, dataset_arn, filters=None, tenant_id=None) -> dict:
+        """
+        Returns the definition of a dashboard over 'dataset_arn'.
+
+        Parameters
+        ----------
+        dataset_arn : str
+            Amazon QuickSight dataset ARN
+        filters : dict
+            Default filters of the dashboard: the values kept for each column, applied to
+            all the visuals
+        tenant_id : str
+            Identifier of the tenant, from which the filter identifiers are derived so that
+            a dashboard rendered again gets the same ones
+
+        Returns
+        -------
+        dict
+            The dashboard definition
+        """
+        definition = dict(self.definition)
+        declarations = [dict(d) for d in self.definition["DataSetIdentifierDeclarations"]]
+        declarations[0]["DataSetArn"] = dataset_arn
+        definition["DataSetIdentifierDeclarations"] = declarations
+        if filters:
+            definition["FilterGroups"] = list(self.definition.get("FilterGroups", [])) + [
+                self._filter_group(column, values, tenant_id) for column, values in sorted(filters.items())]
+        return definition
+
+    def _filter_group(self, column, values, tenant_id) -> dict:
+        ids = uuid.uuid5(uuid.NAMESPACE_URL, f"ses-blog/{tenant_id or ''}/{column}")
+        return {
+            "FilterGroupId": f"default-{ids}",
+            "Filters": [{
+                "CategoryFilter": {
+                    "FilterId": f"default-filter-{ids}",
+                    "Column": {"DataSetIdentifier": self.identifier, "ColumnName": column},
+                    "Configuration": {
+                        "FilterListConfiguration": {
+                            "MatchOperator": "CONTAINS",
+                            "CategoryValues": [str(v) for v in values],
+                        }
+                    },
+                }
+            }],
+            "ScopeConfiguration": {
+                "SelectedSheets": {
+                    "SheetVisualScopingConfigurations": [
+                        {"SheetId": sheet_id, "Scope": "ALL_VISUALS"} for sheet_id in self.sheet_ids]
+                }
+            },
+            "Status": "ENABLED",
+            "CrossDataset": "SINGLE_DATASET",
+        }
+
+
+def load_tenants(path) -> list:
+    """
+    Reads the tenants of a JSON file: a list of objects with an 'id' and, optionally, a
+    'name', 'dashboard_id', 'dataset_id', 'user' and 'filters' (column to list of values).
+
+    Parameters
+    ----------
+    path : str
+        The JSON file
+
+    Returns
+    -------
+    list
+        The tenants, as dicts
+    """
+    with open(path) as f:
+        tenants = json.load(f)
+    seen = set()
+    for tenant in tenants:
+        tenant_id = tenant.get("id")
+        if not isinstance(tenant_id, str) or not re.fullmatch(r"[\w-]+", tenant_id):
+            raise ValueError(f"Invalid tenant id {tenant_id!r}: letters, digits, '_' and '-' only")
+        if tenant_id in seen:
+            raise ValueError(f"Duplicate tenant id '{tenant_id}'")
+        seen.add(tenant_id)
+        for column, values in tenant.get("filters", {}).items():
+            if not isinstance(values, list) or not values:
+                raise ValueError(f"Filter '{column}' of tenant '{tenant_id}' must be a non empty list")
+    return tenants
@@ -0,0 +1,497 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script applies the AWS Glue DataBrew recipe of the solution ('recipe.json') locally,
+in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+It reads the newline-delimited JSON objects written by Amazon Kinesis Data Firehose under
+the 'raw/' prefix (plain or GZIP compressed), runs them through the recipe as a pipeline of
+generators and writes Apache Parquet files partitioned by year, month, day and hour, as the
+DataBrew job does. Events are streamed one at a time and rows are buffered only up to a
+bounded number before they are spilled to temporary files, so memory use grows with the size
+of the largest partition, not with the size of the input.
+
+The year, month, day and hour columns are taken from the 'raw/YYYY/MM/DD/HH/' path of each
+object, like the 'SESDataBrewDataset' path parameters, or from the event timestamp when the
+path doesn't follow that layout.
+
+Columns are written with native types: 'timestamp' and 'expirationTime' as UTC timestamps,
+'processingTimeMillis' and the ASNs as 64-bit integers, 'userAgentProxy' as a boolean, so
+Amazon Athena and Amazon QuickSight don't have to cast strings on every query. The columns
+with few distinct values are dictionary encoded, and the rows of each partition are sorted
+by timestamp before its file is written, so the row groups of the file cover successive time
+ranges and their min/max statistics let Athena skip most of them when a query filters on
+time.
+
+This script requires 'pyarrow' to write Parquet files.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import uuid
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO)
+
+PARTITION_COLUMNS = ("year", "month", "day", "hour")
+RAW_PATH_PATTERN = re.compile(r"(?:^|/)(\d{4})/(\d{2})/(\d{2})/(\d{2})/")
+TIMESTAMP_PATTERN = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2})")
+
+# Columns stored with a type other than string in the Parquet output
+COLUMN_TYPES = {
+    "processingTimeMillis": "int64",
+    "timestamp": "timestamp",
+    "expirationTime": "timestamp",
+    "userAgentProxy": "bool",
+    "ipAsn": "int64",
+    "sesSourceIpAsn": "int64",
+}
+
+# Columns with few distinct values, dictionary encoded in the Parquet output. The other
+# columns (message ids, addresses, links, ...) are mostly unique and plain encoded.
+DICTIONARY_COLUMNS = (
+    "eventType", "bounceType", "complaintFeedbackType", "delayType", "reason", "templateName",
+    "sender", "mailRecipientDomain", "sesOutgoingIp", "sesSourceIp", "subject", "action",
+    "status", "userAgentClient", "userAgentOs", "userAgentDevice", "ipCountry", "ipAsnOrg",
+    "sesSourceIpCountry", "sesSourceIpAsnOrg",
+)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-recipe',
+                    description='Applies the AWS Glue DataBrew recipe to raw event data and writes partitioned Parquet files',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-i', '--input', required=True, nargs='+', metavar='', help="Raw event files or directories")
+    parser.add_argument('-o', '--output', required=True, metavar='', help="Output directory")
+    parser.add_argument('--recipe', default='recipe.json', metavar='', help="AWS Glue DataBrew recipe file")
+    parser.add_argument('--compression', default='gzip', metavar='', help="Parquet compression codec")
+    parser.add_argument('--row-group-size', type=int, default=50000, metavar='', help="Rows per Parquet row group")
+    parser.add_argument('--append', action='store_true', help="Keep the files already in the output partitions")
+    parser.add_argument('--sort-by', default='timestamp', metavar='', help="Column the rows are sorted by within a partition, '' to keep the input order")
+    args = parser.parse_args()
+
+    return args
+
+
+def _flag(value) -> bool:
+    return str(value).lower() == "true"
+
+
+def _columns(value) -> list:
+    return json.loads(value) if isinstance(value, str) else list(value)
+
+
+def unnest_array(rows, sourceColumn, targetColumn, removeSourceColumn="true", **_):
+    """
+    UNNEST_ARRAY: one row per element of the array in 'sourceColumn'. Rows where the
+    array is empty or missing are kept, with a null 'targetColumn'.
+    """
+    remove = _flag(removeSourceColumn)
+    for row in rows:
+        values = row.pop(sourceColumn, None) if remove else row.get(sourceColumn)
+        if values is None or values == []:
+            values = [None]
+        elif not isinstance(values, list):
+            values = [values]
+        if len(values) == 1:
+            row[targetColumn] = values[0]
+            yield row
+            continue
+        for value in values:
+            unnested = dict(row)
+            unnested[targetColumn] = value
+            yield unnested
+
+
+def _flatten_struct(prefix, value, delimiter, levels, row):
+    for key, item in value.items():
+        column = f"{prefix}{delimiter}{key}"
+        if isinstance(item, dict) and levels > 1:
+            _flatten_struct(column, item, delimiter, levels - 1, row)
+        else:
+            row[column] = item
+
+
+def unnest_struct_n(rows, sourceColumns, delimiter="_", unnestLevel="1", removeSourceColumn="true", **_):
+    """
+    UNNEST_STRUCT_N: one column '<source><delimiter><field>' per field of the structs in
+    'sourceColumns', down to 'unnestLevel' levels of nesting.
+    """
+    sources = _columns(sourceColumns)
+    levels = int(unnestLevel)
+    remove = _flag(removeSourceColumn)
+    for row in rows:
+        for source in sources:
+            value = row.pop(source, None) if remove else row.get(source)
+            if isinstance(value, dict):
+                _flatten_struct(source, value, delimiter, levels, row)
+        yield row
+
+
+def merge(rows, sourceColumns, targetColumn, delimiter="", **_):
+    """
+    MERGE: concatenates the non-null values of 'sourceColumns' into 'targetColumn' and
+    drops the source columns.
+    """
+    sources = _columns(sourceColumns)
+    for row in rows:
+        values = [row.pop(source, None) for source in sources]
+        values = [str(v) for v in values if v is not None]
+        row[targetColumn] = delimiter.join(values) if values else None
+        yield row
+
+
+def rename(rows, sourceColumn, targetColumn, **_):
+    """
+    RENAME: renames 'sourceColumn' to 'targetColumn'.
+    """
+    for row in rows:
+        if sourceColumn in row:
+            row[targetColumn] = row.pop(sourceColumn)
+        yield row
+
+
+def extract_pattern(rows, sourceColumn, targetColumn, pattern, **_):
+    """
+    EXTRACT_PATTERN: writes the first match of 'pattern' in 'sourceColumn' into
+    'targetColumn', or null when there is no match.
+    """
+    regex = re.compile(pattern)
+    for row in rows:
+        value = row.get(sourceColumn)
+        match = regex.search(value) if isinstance(value, str) else None
+        row[targetColumn] = match.group(0) if match else None
+        yield row
+
+
+def delete(rows, sourceColumns, **_):
+    """
+    DELETE: drops 'sourceColumns'.
+    """
+    sources = _columns(sourceColumns)
+    for row in rows:
+        for source in sources:
+            row.pop(source, None)
+        yield row
+
+
+OPERATIONS = {
+    "UNNEST_ARRAY": unnest_array,
+    "UNNEST_STRUCT_N": unnest_struct_n,
+    "MERGE": merge,
+    "RENAME": rename,
+    "EXTRACT_PATTERN": extract_pattern,
+    "DELETE": delete,
+}
+
+
+class Recipe:
+    """
+    An AWS Glue DataBrew recipe compiled into a chain of generators.
+
+    Parameters
+    ----------
+    steps : list
+        The recipe steps, as found in a DataBrew recipe JSON file
+    """
+
+    def __init__(self, steps):
+        self.steps = []
+        for step in steps:
+            action = step["Action"]
+            operation = action["Operation"]
+            if operation not in OPERATIONS:
+                raise ValueError(f"Unsupported recipe operation '{operation}'")
+            self.steps.append((OPERATIONS[operation], action.get("Parameters", {})))
+
+    @classmethod
+    def from_file(cls, recipe_file):
+        with open(recipe_file) as f:
+            return cls(json.load(f))
+
+    def apply(self, rows):
+        """
+        Lazily applies the recipe to an iterable of rows (dicts) and returns an iterator
+        over the transformed rows.
+        """
+        for operation, parameters in self.steps:
+            rows = operation(rows, **parameters)
+        return rows
+
+
+def iter_input_files(paths):
+    """
+    Yields the files found in 'paths', walking directories in lexicographic order.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if not name.startswith("."):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def open_raw_object(path):
+    with open(path, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    return gzip.open(path, "rb") if compressed else open(path, "rb")
+
+
+def partition_values(path, event) -> dict:
+    """
+    Returns the year, month, day and hour of an event, from the Firehose 'YYYY/MM/DD/HH/'
+    path of the object that contains it or, if there is none, from the event timestamp.
+    """
+    match = RAW_PATH_PATTERN.search(path.replace(os.sep, "/"))
+    if match is None:
+        match = TIMESTAMP_PATTERN.match(str(event.get("timestamp", "")))
+    if match is None:
+        return dict.fromkeys(PARTITION_COLUMNS)
+    return dict(zip(PARTITION_COLUMNS, (int(v) for v in match.groups())))
+
+
+def read_events(paths):
+    """
+    Yields one row per event found in the raw objects under 'paths', with the partition
+    columns added.
+    """
+    for path in iter_input_files(paths):
+        with open_raw_object(path) as f:
+            for line_number, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning(f"Skipping malformed JSON in {path}, line {line_number}")
+                    continue
+                event.update(partition_values(path, event))
+                yield event
+
+
+def _to_string(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _to_timestamp(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00")).astimezone(timezone.utc)
+    except (AttributeError, ValueError):
+        logging.warning(f"Storing invalid timestamp {value!r} as null")
+        return None
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        logging.warning(f"Storing invalid integer {value!r} as null")
+        return None
+
+
+def _to_column(name, values):
+    column_type = COLUMN_TYPES.get(name)
+    if column_type == "int64":
+        return pa.array([None if v in (None, "") else _to_int(v) for v in values], type=pa.int64())
+    if column_type == "bool":
+        return pa.array([None if v in (None, "") else v if isinstance(v, bool) else str(v).lower() == "true"
+                         for v in values], type=pa.bool_())
+    if column_type == "timestamp":
+        timestamp_type = pa.timestamp("ms", tz="UTC")
+        strings = pa.array([None if v in (None, "") else _to_string(v) for v in values], type=pa.string())
+        try:
+            return strings.cast(timestamp_type)
+        except pa.ArrowInvalid:
+            # a malformed value fails the vectorized cast: parse them one by one
+            return pa.array([None if v is None else _to_timestamp(v) for v in strings.to_pylist()],
+                            type=timestamp_type)
+    return pa.array([_to_string(v) for v in values], type=pa.string())
+
+
+class PartitionedParquetWriter:
+    """
+    Writes rows into Hive-style 'year=/month=/day=/hour=' partitions of Parquet files, one
+    file per partition.
+
+    Rows are buffered per partition. When more than 'max_buffered_rows' rows are buffered
+    across all the partitions, the rows of the largest partition are converted to columns and
+    spilled to a temporary Parquet file. When the writer is closed, the spilled runs and the
+    buffered rows of each partition are combined, sorted by 'sort_by' and written as row
+    groups of 'row_group_size' rows. The schema of a file is the union of the columns of all
+    the rows of its partition, missing values being nulls, so the columns that only appear
+    late in the input, like the user agent or geo IP columns, are never dropped. Memory holds
+    at most 'max_buffered_rows' rows, and one partition in columnar form while it is written.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory where the partitions are written
+    partition_columns : tuple
+        Columns used to partition the output, removed from the rows written to the files
+    row_group_size : int
+        Rows per Parquet row group
+    compression : str
+        Parquet compression codec
+    overwrite : bool
+        If True, the files found in a partition are deleted before it is written
+    max_buffered_rows : int
+        Rows buffered across the partitions before the largest one is spilled
+    sort_by : str
+        Column the rows of each file are sorted by, nulls last; None to keep the input order
+    run_id : str
+        Identifier in the names of the files written, a random one if not given
+    """
+
+    def __init__(self, output_dir, partition_columns=PARTITION_COLUMNS, row_group_size=50000,
+                 compression="gzip", overwrite=True, max_buffered_rows=200000, sort_by="timestamp",
+                 run_id=None):
+        if pq is None:
+            raise ImportError("'pyarrow' is required to write Parquet files: pip3 install pyarrow")
+        self.output_dir = output_dir
+        self.partition_columns = partition_columns
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.overwrite = overwrite
+        self.sort_by = sort_by or None
+        self.max_buffered_rows = max_buffered_rows
+        self.run_id = run_id or uuid.uuid4().hex[:12]
+        self.rows_written = 0
+        self.files_written = []
+        self._buffers = {}
+        self._buffered = 0
+        self._runs = {}
+        self._spills = 0
+        self._spill_dir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def partition_path(self, key) -> str:
+        return os.path.join(self.output_dir, *(f"{c}={v}" for c, v in zip(self.partition_columns, key)))
+
+    def write(self, row):
+        key = tuple(row.pop(c, None) for c in self.partition_columns)
+        buffer = self._buffers.setdefault(key, [])
+        buffer.append(row)
+        self._buffered += 1
+        if self._buffered >= self.max_buffered_rows:
+            self._spill(max(self._buffers, key=lambda k: len(self._buffers[k])))
+
+    def write_all(self, rows):
+        for row in rows:
+            self.write(row)
+        return self
+
+    def _table(self, key):
+        rows = self._buffers.pop(key, None)
+        if not rows:
+            return None
+        self._buffered -= len(rows)
+        columns = dict.fromkeys(c for row in rows for c in row)
+        return pa.table({c: _to_column(c, [row.get(c) for row in rows]) for c in columns})
+
+    def _spill(self, key):
+        table = self._table(key)
+        if table is None:
+            return
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="ses-recipe-")
+        path = os.path.join(self._spill_dir, f"run-{self._spills:05d}.parquet")
+        self._spills += 1
+        pq.write_table(table, path, compression="none")
+        self._runs.setdefault(key, []).append(path)
+
+    def _write_partition(self, key):
+        tables = [pq.read_table(path) for path in self._runs.pop(key, [])]
+        buffered = self._table(key)
+        if buffered is not None:
+            tables.append(buffered)
+        if not tables:
+            return
+        # each column has the same type in every run, see _to_column
+        table = pa.concat_tables(tables, promote_options="default")
+        if self.sort_by in table.column_names:
+            table = table.sort_by([(self.sort_by, "ascending")])
+
+        path = self.partition_path(key)
+        if self.overwrite and os.path.isdir(path):
+            for name in os.listdir(path):
+                if name.endswith(".parquet"):
+                    os.remove(os.path.join(path, name))
+        os.makedirs(path, exist_ok=True)
+        file_name = os.path.join(path, f"part-{self.run_id}-00000.parquet")
+        options = {}
+        if self.sort_by in table.column_names:
+            # recorded in the metadata of each row group
+            options["sorting_columns"] = [pq.SortingColumn(table.schema.get_field_index(self.sort_by),
+                                                           nulls_first=False)]
+        pq.write_table(table, file_name, row_group_size=self.row_group_size, compression=self.compression,
+                       use_dictionary=[c for c in DICTIONARY_COLUMNS if c in table.column_names], **options)
+        self.files_written.append(file_name)
+        self.rows_written += table.num_rows
+
+    def close(self):
+        try:
+            for key in sorted(set(self._buffers) | set(self._runs), key=str):
+                self._write_partition(key)
+        finally:
+            if self._spill_dir is not None:
+                shutil.rmtree(self._spill_dir, ignore_errors=True)
+                self._spill_dir = None
+
+
+def run(input_paths, output_dir, recipe_file="recipe.json", **writer_options) -> PartitionedParquetWriter:
+    """
+    Applies the recipe in 'recipe_file' to the raw events under 'input_paths' and writes
+    the result under 'output_dir'.
+
+    Returns
+    -------
+    PartitionedParquetWriter
+        The writer used, with the number of rows and the files written
+    """
+    recipe = Recipe.from_file(recipe_file)
+    with PartitionedParquetWriter(output_dir, **writer_options) as writer:
+        writer.write_all(recipe.apply(read_events(input_paths)))
+    return writer
+
+
+def main(args):
+    writer = run(args.input, args.output, args.recipe,
+                 row_group_size=args.row_group_size,
+                 compression=args.compression,
+                 overwrite=not args.append,
+                 sort_by=args.sort_by)
+    logging.info(f"{writer.rows_written} rows written to {len(writer.files_written)} files under {args.output}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
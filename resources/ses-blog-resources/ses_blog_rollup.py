@@ -0,0 +1,276 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script computes hourly rollups of the SES events stored in the destination buckets, in
+the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+The summary visuals of the dashboard count events by eventType, sender, templateName and
+recipient domain. Computed from the 'partitioned' table, every refresh scans all the events of
+the selected time range. This script counts them once per hour partition and writes the
+counts under 'hourly_rollups/year=/month=/day=/hour=/', one small Parquet object per hour,
+crawled into the 'hourly_rollups' table:
+    - hour_start (timestamp), eventtype, sender, templatename, mailrecipientdomain;
+    - events, the number of rows of the 'partitioned' table with these values.
+Counts are additive: the rollups of any set of hours are merged by summing the 'events' of
+the rows with the same dimensions, which is what a SUM over the table does.
+
+The events are read from the hour partitions of any prefix: Parquet objects written by the
+AWS Glue DataBrew job, JSON objects written by the transformation Lambda function in the
+'flat' format, or in the 'nested' format under 'raw/', run through 'recipe.json' first.
+An hour is rolled up again when one of its objects is newer than its rollup, so the script
+can be scheduled every hour or after 'ses_blog_compaction.py'.
+
+This script requires 'pyarrow' and 'boto3' for S3 locations.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import tempfile
+from datetime import timedelta
+
+from ses_blog_compaction import live_partitions, partition_hour
+from ses_blog_recipe import Recipe
+from ses_blog_storage import open_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO)
+
+ROLLUP_PREFIX = "hourly_rollups/"
+ROLLUP_OBJECT = "rollup.parquet"
+RECIPE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recipe.json")
+
+# Dimensions of the rollups, with the names of the columns they are read from
+DIMENSIONS = ("eventtype", "sender", "templatename", "mailrecipientdomain")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-rollup',
+                    description='Computes hourly rollups of the SES events of the destination buckets',
+                    epilog='Check the README for more information')
+
+    parser.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory of the events")
+    parser.add_argument('--prefix', action='append', metavar='', help="Prefix of the events (default: partitioned/)")
+    parser.add_argument('-o', '--output', metavar='', help="s3://<bucket> or local directory of the rollups (default: the events location)")
+    parser.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    parser.add_argument('--endpoint-url', metavar='', help="Endpoint of a local S3 stand-in")
+    parser.add_argument('--recipe', default=RECIPE_FILE, metavar='', help="AWS Glue DataBrew recipe applied to nested events")
+    parser.add_argument('--force', action='store_true', help="Roll up every hour, even when its rollup is up to date")
+    args = parser.parse_args()
+
+    return args
+
+
+def _lower_keys(row) -> dict:
+    return {k.lower(): v for k, v in row.items()}
+
+
+def _read_lines(data):
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    return [line for line in data.splitlines() if line.strip()]
+
+
+def read_partition_rows(store, objects, recipe, columns=None):
+    """
+    Yields the rows of the 'partitioned' table found in the objects of an hour partition,
+    with lower case column names, like in the AWS Glue Data Catalog. Nested events are run
+    through 'recipe' first.
+
+    Parameters
+    ----------
+    store : LocalStore or S3Store
+        The store that contains the objects
+    objects : list
+        The ObjectInfo of the objects of the partition
+    recipe : Recipe
+        The recipe applied to nested events
+    columns : tuple
+        Lower case names of the columns to read from Parquet objects, all of them if None
+    """
+    if pq is None:
+        raise ImportError("'pyarrow' is required to roll up events: pip3 install pyarrow")
+    for obj in objects:
+        data = store.get(obj.key)
+        if data[:4] == b"PAR1":
+            table = pq.read_table(pa.BufferReader(data))
+            if columns is not None:
+                table = table.select([n for n in table.column_names if n.lower() in columns])
+            for row in table.to_pylist():
+                yield _lower_keys(row)
+            continue
+
+        events = (json.loads(line) for line in _read_lines(data))
+        nested = []
+        for event in events:
+            if isinstance(event.get("destination"), list):
+                nested.append(event)
+            else:
+                yield _lower_keys(event)
+        if nested:
+            for row in recipe.apply(iter(nested)):
+                yield _lower_keys(row)
+
+
+class HourlyRollup:
+    """
+    Event counts of one hour by eventType, sender, templateName and recipient domain.
+    Rollups are merged by adding their counts.
+
+    Parameters
+    ----------
+    hour : datetime
+        The start of the hour
+    """
+
+    def __init__(self, hour):
+        self.hour = hour
+        self.counts = {}
+
+    def add(self, row):
+        key = tuple(row.get(d) for d in DIMENSIONS)
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def merge(self, other):
+        for key, events in other.counts.items():
+            self.counts[key] = self.counts.get(key, 0) + events
+        return self
+
+    @property
+    def events(self) -> int:
+        return sum(self.counts.values())
+
+    def to_table(self):
+        """
+        Returns the rollup as an Arrow table, sorted by its dimensions.
+        """
+        keys = sorted(self.counts, key=lambda k: tuple("" if v is None else str(v) for v in k))
+        columns = {"hour_start": pa.array([self.hour] * len(keys), type=pa.timestamp("ms", tz="UTC"))}
+        for i, dimension in enumerate(DIMENSIONS):
+            columns[dimension] = pa.array([None if k[i] is None else str(k[i]) for k in keys], type=pa.string())
+        columns["events"] = pa.array([self.counts[k] for k in keys], type=pa.int64())
+        return pa.table(columns)
+
+    @classmethod
+    def from_table(cls, hour, table):
+        rollup = cls(hour)
+        for row in table.to_pylist():
+            rollup.counts[tuple(row[d] for d in DIMENSIONS)] = row["events"]
+        return rollup
+
+
+def rollup_key(hour) -> str:
+    return (f"{ROLLUP_PREFIX}year={hour.year}/month={hour.month}/day={hour.day}/hour={hour.hour}/"
+            f"{ROLLUP_OBJECT}")
+
+
+def load_rollups(store, start, end):
+    """
+    Returns the rollup of the hours from 'start' included to 'end' excluded, merged.
+    """
+    merged = HourlyRollup(start)
+    hour = start
+    while hour < end:
+        key = rollup_key(hour)
+        if store.exists(key):
+            merged.merge(HourlyRollup.from_table(hour, pq.read_table(pa.BufferReader(store.get(key)))))
+        hour += timedelta(hours=1)
+    return merged
+
+
+class RollupBuilder:
+    """
+    Rolls up the hour partitions of a store whose rollup is missing or out of date.
+
+    Parameters
+    ----------
+    store : LocalStore or S3Store
+        The store that contains the events
+    output : LocalStore or S3Store
+        The store where the rollups are written
+    recipe : Recipe
+        The recipe applied to nested events
+    force : bool
+        If True, every hour is rolled up again
+    """
+
+    def __init__(self, store, output=None, recipe=None, force=False):
+        self.store = store
+        self.output = output or store
+        self.recipe = recipe or Recipe.from_file(RECIPE_FILE)
+        self.force = force
+
+    def partitions(self, prefix) -> dict:
+        """
+        Returns the hour partitions under 'prefix', mapped to the data objects the table reads
+        for them, compacted or not.
+        """
+        return {partition: objects for partition, objects in live_partitions(self.store, prefix).items()
+                if not partition.startswith(ROLLUP_PREFIX)}
+
+    def run(self, prefixes) -> list:
+        """
+        Rolls up the partitions under 'prefixes' and returns the keys of the rollups written.
+        The partitions of the same hour under different prefixes are rolled up together.
+        """
+        hours = {}
+        for prefix in prefixes:
+            for partition, objects in self.partitions(prefix).items():
+                hours.setdefault(partition_hour(partition), []).extend(objects)
+
+        existing = {o.key: o for o in self.output.list(ROLLUP_PREFIX)}
+        written = []
+        for hour, objects in sorted(hours.items()):
+            key = rollup_key(hour)
+            current = existing.get(key)
+            if not self.force and current is not None and \
+                    all(o.last_modified <= current.last_modified for o in objects):
+                continue
+            rollup = self.build(hour, objects)
+            self.write(key, rollup)
+            written.append(key)
+            logging.info(f"{rollup.events} rows of {hour:%Y-%m-%d %H}:00 rolled up into {len(rollup.counts)} rows")
+        return written
+
+    def build(self, hour, objects):
+        rollup = HourlyRollup(hour)
+        for row in read_partition_rows(self.store, objects, self.recipe, columns=DIMENSIONS):
+            rollup.add(row)
+        return rollup
+
+    def write(self, key, rollup):
+        fd, path = tempfile.mkstemp(suffix=".parquet")
+        os.close(fd)
+        try:
+            pq.write_table(rollup.to_table(), path, compression="gzip")
+            self.output.put_file(key, path)
+        finally:
+            os.remove(path)
+
+
+def main(args):
+    session = None
+    if args.profile:
+        import boto3
+        session = boto3.Session(profile_name=args.profile)
+
+    store = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+    output = open_store(args.output, session=session, endpoint_url=args.endpoint_url) if args.output else store
+    builder = RollupBuilder(store, output, recipe=Recipe.from_file(args.recipe), force=args.force)
+    written = builder.run(args.prefix or ["partitioned/"])
+    logging.info(f"{len(written)} hourly rollups written to {output.location}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,403 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+This script computes HyperLogLog sketches of the distinct recipients, openers and clickers of
+the SES events stored in the destination buckets, in the context of the AWS blog:
+https://aws.amazon.com/blogs/messaging-and-targeting/tracking-email-engagement-with-aws-analytics-services/.
+
+Counting unique recipients with COUNT(DISTINCT recipientmail) scans every row of the selected
+time range, and distinct counts can't be added across hours like the counts of
+'ses_blog_rollup.py'. A HyperLogLog sketch estimates the number of distinct values it has seen
+in a few kilobytes, and the sketch of the union of two sets is obtained by merging theirs.
+For each hour partition, this script stores under '<partition>/_sketches/hll.parquet' one
+sketch per sender, templateName, recipient domain and metric:
+    - recipients: the recipientmail of all the rows;
+    - openers: the recipientmail of the Open rows;
+    - clickers: the recipientmail of the Click rows.
+The '_sketches' folder is ignored by Amazon Athena, the AWS Glue crawler and the other tools,
+as its name starts with an underscore.
+
+'SketchSet' loads the sketches of any range of hours and answers distinct count queries
+filtered on sender, templateName and domain, by merging the matching sketches. The relative
+standard error of an estimate is 1.04 / sqrt(2 ** precision), 1.6% with the default precision.
+
+The 'check' command compares the estimates to the exact counts on generated events.
+
+This script requires 'pyarrow' and 'boto3' for S3 locations.
+"""
+
+import argparse
+import hashlib
+import logging
+import math
+import os
+import sys
+import tempfile
+import zlib
+from datetime import datetime, timezone
+
+from ses_blog_compaction import partition_hour
+from ses_blog_recipe import Recipe
+from ses_blog_rollup import RECIPE_FILE, RollupBuilder, read_partition_rows
+from ses_blog_storage import open_store
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+logging.basicConfig(level=logging.INFO)
+
+SKETCH_FOLDER = "_sketches"
+SKETCH_OBJECT = "hll.parquet"
+DEFAULT_PRECISION = 12
+
+RECIPIENTS = "recipients"
+OPENERS = "openers"
+CLICKERS = "clickers"
+# metric -> eventtype of the rows it counts, None for all the rows
+METRICS = {
+    RECIPIENTS: None,
+    OPENERS: "Open",
+    CLICKERS: "Click",
+}
+DIMENSIONS = ("sender", "templatename", "mailrecipientdomain")
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+                    prog='ses-blog-sketches',
+                    description='Computes and queries HyperLogLog sketches of distinct recipients, openers and clickers',
+                    epilog='Check the README for more information')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build = subparsers.add_parser('build', help="Compute the sketches of the hour partitions")
+    build.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory of the events")
+    build.add_argument('--prefix', action='append', metavar='', help="Prefix of the events (default: partitioned/)")
+    build.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    build.add_argument('--endpoint-url', metavar='', help="Endpoint of a local S3 stand-in")
+    build.add_argument('--recipe', default=RECIPE_FILE, metavar='', help="AWS Glue DataBrew recipe applied to nested events")
+    build.add_argument('--precision', type=int, default=DEFAULT_PRECISION, metavar='', help="HyperLogLog precision, 4 to 16")
+    build.add_argument('--force', action='store_true', help="Compute every sketch, even when it is up to date")
+
+    query = subparsers.add_parser('query', help="Estimate distinct counts over a time range")
+    query.add_argument('-l', '--location', required=True, metavar='', help="s3://<bucket> or local directory of the events")
+    query.add_argument('--prefix', default='partitioned/', metavar='', help="Prefix of the events")
+    query.add_argument('-p', '--profile', metavar='', help="AWS credentials Profile")
+    query.add_argument('--endpoint-url', metavar='', help="Endpoint of a local S3 stand-in")
+    query.add_argument('--start', required=True, metavar='', help="First hour, YYYY-MM-DDTHH")
+    query.add_argument('--end', required=True, metavar='', help="Hour after the last one, YYYY-MM-DDTHH")
+    query.add_argument('--metric', choices=list(METRICS), default=RECIPIENTS, help="Distinct count to estimate")
+    query.add_argument('--sender', metavar='', help="Only the events of this sender")
+    query.add_argument('--template', metavar='', help="Only the events of this templateName")
+    query.add_argument('--domain', metavar='', help="Only the events of this recipient domain")
+
+    check = subparsers.add_parser('check', help="Compare the estimates to exact counts on generated events")
+    check.add_argument('-n', '--count', type=int, default=100000, metavar='', help="Number of events")
+    check.add_argument('--recipients', type=int, default=50000, metavar='', help="Number of distinct recipient addresses")
+    check.add_argument('--fanout', type=int, default=3, metavar='', help="Maximum number of recipients per message")
+    check.add_argument('--seed', type=int, default=0, metavar='', help="Random seed")
+    check.add_argument('--precision', type=int, default=DEFAULT_PRECISION, metavar='', help="HyperLogLog precision, 4 to 16")
+    args = parser.parse_args()
+
+    return args
+
+
+def _hash(value) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    A HyperLogLog sketch with 2 ** precision registers, over 64-bit hashes of the values.
+
+    Parameters
+    ----------
+    precision : int
+        Number of bits of the hash used to select a register, from 4 to 16
+    registers : bytearray
+        The registers of an existing sketch
+    """
+
+    def __init__(self, precision=DEFAULT_PRECISION, registers=None):
+        if not 4 <= precision <= 16:
+            raise ValueError("The precision must be between 4 and 16")
+        self.precision = precision
+        self.registers = bytearray(1 << precision) if registers is None else bytearray(registers)
+        if len(self.registers) != 1 << precision:
+            raise ValueError(f"Expected {1 << precision} registers, got {len(self.registers)}")
+
+    def add(self, value):
+        h = _hash(value)
+        bits = 64 - self.precision
+        index = h >> bits
+        rank = bits - (h & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """
+        Merges 'other' into this sketch, which then estimates the union of both sets.
+        """
+        if other.precision != self.precision:
+            raise ValueError(f"Can't merge sketches of precision {self.precision} and {other.precision}")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213 / (1 + 1.079 / m))
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            return m * math.log(m / zeros)
+        return estimate
+
+    def __len__(self):
+        return round(self.estimate())
+
+    def to_bytes(self) -> bytes:
+        return bytes([self.precision]) + zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data[0], zlib.decompress(data[1:]))
+
+
+class HourSketches:
+    """
+    The sketches of one hour, by sender, templateName, recipient domain and metric.
+
+    Parameters
+    ----------
+    hour : datetime
+        The start of the hour
+    precision : int
+        Precision of the sketches
+    """
+
+    def __init__(self, hour, precision=DEFAULT_PRECISION):
+        self.hour = hour
+        self.precision = precision
+        self.sketches = {}
+
+    def _sketch(self, key):
+        sketch = self.sketches.get(key)
+        if sketch is None:
+            sketch = self.sketches[key] = HyperLogLog(self.precision)
+        return sketch
+
+    def add(self, row):
+        recipient = row.get("recipientmail")
+        if not recipient:
+            return
+        dimensions = tuple(row.get(d) for d in DIMENSIONS)
+        event_type = row.get("eventtype")
+        for metric, metric_event_type in METRICS.items():
+            if metric_event_type is None or metric_event_type == event_type:
+                self._sketch(dimensions + (metric,)).add(recipient)
+
+    def to_table(self):
+        keys = sorted(self.sketches, key=lambda k: tuple("" if v is None else str(v) for v in k))
+        columns = {"hour_start": pa.array([self.hour] * len(keys), type=pa.timestamp("ms", tz="UTC"))}
+        for i, dimension in enumerate(DIMENSIONS):
+            columns[dimension] = pa.array([None if k[i] is None else str(k[i]) for k in keys], type=pa.string())
+        columns["metric"] = pa.array([k[-1] for k in keys], type=pa.string())
+        columns["sketch"] = pa.array([self.sketches[k].to_bytes() for k in keys], type=pa.binary())
+        return pa.table(columns)
+
+    @classmethod
+    def from_table(cls, hour, table):
+        sketches = cls(hour)
+        for row in table.to_pylist():
+            sketch = HyperLogLog.from_bytes(row["sketch"])
+            sketches.precision = sketch.precision
+            sketches.sketches[tuple(row[d] for d in DIMENSIONS) + (row["metric"],)] = sketch
+        return sketches
+
+
+def sketch_key(partition) -> str:
+    return f"{partition}/{SKETCH_FOLDER}/{SKETCH_OBJECT}"
+
+
+class SketchBuilder(RollupBuilder):
+    """
+    Computes the sketches of the hour partitions of a store whose sketches are missing or
+    out of date, and writes them next to the partitions.
+
+    Parameters
+    ----------
+    store : LocalStore or S3Store
+        The store that contains the events
+    recipe : Recipe
+        The recipe applied to nested events
+    precision : int
+        Precision of the sketches
+    force : bool
+        If True, the sketches of every partition are computed again
+    """
+
+    def __init__(self, store, recipe=None, precision=DEFAULT_PRECISION, force=False):
+        super().__init__(store, recipe=recipe, force=force)
+        self.precision = precision
+
+    def run(self, prefixes) -> list:
+        """
+        Computes the sketches of the partitions under 'prefixes' and returns the keys of the
+        sketch objects written.
+        """
+        written = []
+        for prefix in prefixes:
+            existing = {o.key: o for o in self.store.list(prefix) if f"/{SKETCH_FOLDER}/" in o.key}
+            for partition, objects in sorted(self.partitions(prefix).items()):
+                key = sketch_key(partition)
+                current = existing.get(key)
+                if not self.force and current is not None and \
+                        all(o.last_modified <= current.last_modified for o in objects):
+                    continue
+                sketches = self.build_sketches(partition_hour(partition), objects)
+                self.write_table(key, sketches.to_table())
+                written.append(key)
+                logging.info(f"{len(sketches.sketches)} sketches written for {partition}")
+        return written
+
+    def build_sketches(self, hour, objects):
+        sketches = HourSketches(hour, self.precision)
+        for row in read_partition_rows(self.store, objects, self.recipe,
+                                       columns=DIMENSIONS + ("eventtype", "recipientmail")):
+            sketches.add(row)
+        return sketches
+
+    def write_table(self, key, table):
+        fd, path = tempfile.mkstemp(suffix=".parquet")
+        os.close(fd)
+        try:
+            pq.write_table(table, path, compression="gzip")
+            self.store.put_file(key, path)
+        finally:
+            os.remove(path)
+
+
+class SketchSet:
+    """
+    Sketches of several hours, queried by merging the ones that match a filter.
+    """
+
+    def __init__(self):
+        self.hours = []
+
+    def add(self, hour_sketches):
+        self.hours.append(hour_sketches)
+
+    @classmethod
+    def load(cls, store, prefix, start, end):
+        """
+        Loads the sketches of the hour partitions under 'prefix' from 'start' included to
+        'end' excluded.
+        """
+        sketch_set = cls()
+        for obj in store.list(prefix):
+            partition, _, name = obj.key.rpartition(f"/{SKETCH_FOLDER}/")
+            if name != SKETCH_OBJECT:
+                continue
+            hour = partition_hour(partition)
+            if hour is not None and start <= hour < end:
+                table = pq.read_table(pa.BufferReader(store.get(obj.key)))
+                sketch_set.add(HourSketches.from_table(hour, table))
+        return sketch_set
+
+    def merged(self, metric=RECIPIENTS, sender=None, templatename=None, domain=None):
+        """
+        Returns the union of the sketches of 'metric' that match the given dimensions, all
+        the values of a dimension being included when it is None.
+        """
+        wanted = (sender, templatename, domain)
+        result = None
+        for hour_sketches in self.hours:
+            for key, sketch in hour_sketches.sketches.items():
+                if key[-1] != metric:
+                    continue
+                if any(w is not None and w != v for w, v in zip(wanted, key)):
+                    continue
+                result = HyperLogLog(sketch.precision).merge(sketch) if result is None else result.merge(sketch)
+        return result
+
+    def distinct(self, metric=RECIPIENTS, sender=None, templatename=None, domain=None) -> int:
+        """
+        Returns the estimated number of distinct recipients matching the filter for 'metric'.
+        """
+        sketch = self.merged(metric, sender, templatename, domain)
+        return 0 if sketch is None else len(sketch)
+
+
+def check_accuracy(count, recipients, fanout, seed, precision) -> list:
+    """
+    Generates events, computes their sketches and exact distinct counts, and returns the
+    (metric, filter, exact, estimate) of the overall and per sender counts.
+    """
+    from ses_blog_benchmark import load_handler
+    from ses_blog_events import SESEventGenerator
+
+    index = load_handler()
+    generator = SESEventGenerator(fanout=fanout, recipients=recipients, seed=seed)
+    sketches = HourSketches(None, precision)
+    exact = {}
+    for event in generator.events(count):
+        for row in index.flatten_record(index.process_record(event)):
+            row = {k.lower(): v for k, v in row.items()}
+            sketches.add(row)
+            if not row.get("recipientmail"):
+                continue
+            for metric, event_type in METRICS.items():
+                if event_type is None or event_type == row.get("eventtype"):
+                    exact.setdefault((metric, None), set()).add(row["recipientmail"])
+                    exact.setdefault((metric, row.get("sender")), set()).add(row["recipientmail"])
+
+    sketch_set = SketchSet()
+    sketch_set.add(sketches)
+    results = []
+    for (metric, sender), values in sorted(exact.items(), key=lambda i: (i[0][0], i[0][1] or "")):
+        results.append((metric, sender, len(values), sketch_set.distinct(metric, sender=sender)))
+    return results
+
+
+def _parse_hour(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc)
+
+
+def main(args):
+    if args.command == "check":
+        results = check_accuracy(args.count, args.recipients, args.fanout, args.seed, args.precision)
+        tolerance = 3 * 1.04 / math.sqrt(1 << args.precision)
+        failed = False
+        for metric, sender, exact, estimate in results:
+            error = (estimate - exact) / exact if exact else 0.0
+            logging.info(f"{metric} {sender or 'all senders'}: exact {exact}, estimate {estimate} ({error:+.2%})")
+            failed = failed or abs(error) > tolerance
+        if failed:
+            logging.error(f"Estimates off by more than {tolerance:.2%}, three standard errors")
+            sys.exit(1)
+        return
+
+    session = None
+    if args.profile:
+        import boto3
+        session = boto3.Session(profile_name=args.profile)
+    store = open_store(args.location, session=session, endpoint_url=args.endpoint_url)
+
+    if args.command == "build":
+        builder = SketchBuilder(store, recipe=Recipe.from_file(args.recipe), precision=args.precision, force=args.force)
+        written = builder.run(args.prefix or ["partitioned/"])
+        logging.info(f"{len(written)} sketch objects written to {store.location}")
+    else:
+        sketch_set = SketchSet.load(store, args.prefix, _parse_hour(args.start), _parse_hour(args.end))
+        estimate = sketch_set.distinct(args.metric, sender=args.sender, templatename=args.template, domain=args.domain)
+        logging.info(f"{len(sketch_set.hours)} hours, {args.metric}: {estimate}")
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    main(args)
@@ -0,0 +1,184 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+
+"""
+Object storage used by the local tools of the solution: a local directory tree laid out like
+the S3 buckets, or an S3 bucket, including a local S3 stand-in (moto server, MinIO, ...)
+reached through a custom endpoint URL.
+
+Locations are given either as a directory path or as 's3://<bucket>'.
+"""
+
+import os
+import tempfile
+from collections import namedtuple
+from datetime import datetime, timezone
+
+ObjectInfo = namedtuple("ObjectInfo", ["key", "size", "last_modified", "etag"])
+
+
+class LocalStore:
+    """
+    Objects stored as files under 'root', keys being their '/' separated relative paths.
+    Writes go through a temporary file renamed over the target, so readers never see a
+    partially written object.
+
+    Parameters
+    ----------
+    root : str
+        The directory that plays the role of the bucket
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.location = self.root
+
+    def _path(self, key) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def list(self, prefix="", start_after=None):
+        base = self._path(prefix.rsplit("/", 1)[0]) if "/" in prefix else self.root
+        if not os.path.isdir(base):
+            return
+        for root, dirs, files in os.walk(base):
+            if start_after:
+                # directories entirely before 'start_after' are not walked
+                relative = os.path.relpath(root, self.root).replace(os.sep, "/")
+                relative = "" if relative == "." else relative + "/"
+                dirs[:] = [d for d in dirs if relative + d + "/" > start_after or
+                           start_after.startswith(relative + d + "/")]
+            dirs.sort()
+            for name in sorted(files):
+                if name.startswith(".") and name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and (not start_after or key > start_after):
+                    stat = os.stat(path)
+                    yield ObjectInfo(key, stat.st_size,
+                                     datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+                                     f"{stat.st_size}-{stat.st_mtime_ns}")
+
+    def exists(self, key) -> bool:
+        return os.path.isfile(self._path(key))
+
+    def open(self, key):
+        return open(self._path(key), "rb")
+
+    def get(self, key) -> bytes:
+        with self.open(key) as f:
+            return f.read()
+
+    def _replace(self, key, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    def put(self, key, data):
+        self._replace(key, lambda f: f.write(data))
+
+    def put_file(self, key, filename):
+        def copy(f):
+            with open(filename, "rb") as src:
+                while True:
+                    chunk = src.read(1 << 20)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+        self._replace(key, copy)
+
+    def copy(self, source_key, key):
+        self.put_file(key, self._path(source_key))
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+
+class S3Store:
+    """
+    Objects stored in an S3 bucket.
+
+    Parameters
+    ----------
+    client : botocore.client.S3
+        The boto3 client for Amazon S3
+    bucket : str
+        The bucket name
+    """
+
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+        self.location = f"s3://{bucket}"
+
+    def list(self, prefix="", start_after=None):
+        paginator = self.client.get_paginator("list_objects_v2")
+        options = {"StartAfter": start_after} if start_after else {}
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, **options):
+            for obj in page.get("Contents", []):
+                yield ObjectInfo(obj["Key"], obj["Size"], obj["LastModified"], obj["ETag"].strip('"'))
+
+    def exists(self, key) -> bool:
+        from botocore.exceptions import ClientError
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def get(self, key) -> bytes:
+        return self.open(key).read()
+
+    def put(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def put_file(self, key, filename):
+        # upload_file switches to multipart uploads for large files
+        self.client.upload_file(Filename=filename, Bucket=self.bucket, Key=key)
+
+    def copy(self, source_key, key):
+        self.client.copy({"Bucket": self.bucket, "Key": source_key}, self.bucket, key)
+
+    def delete(self, keys):
+        keys = list(keys)
+        for i in range(0, len(keys), 1000):
+            self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i:i + 1000]], "Quiet": True})
+
+
+def open_store(location, session=None, endpoint_url=None):
+    """
+    Returns the store for 'location', an 's3://<bucket>' URL or a local directory.
+
+    Parameters
+    ----------
+    location : str
+        's3://<bucket>' or a directory path
+    session : boto3.Session
+        Session used to create the S3 client, the default session if not given
+    endpoint_url : str
+        Endpoint of a local S3 stand-in, if any
+    """
+    if location.startswith("s3://"):
+        import boto3
+        bucket = location[len("s3://"):].strip("/")
+        client = (session or boto3.Session()).client("s3", endpoint_url=endpoint_url)
+        return S3Store(client, bucket)
+    return LocalStore(location)
@@ -0,0 +1,10 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESOURCES_DIR = os.path.join(ROOT, "resources", "ses-blog-resources")
+LAMBDA_DIR = os.path.join(ROOT, "resources", "TransformationLambdaCode")
+
+for path in (RESOURCES_DIR, LAMBDA_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
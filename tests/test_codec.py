@@ -0,0 +1,107 @@
+import base64
+import json
+import math
+from datetime import datetime, timezone
+
+import pytest
+from codec import BACKENDS, get_codec
+from ses_blog_events import EVENT_TYPES, SESEventGenerator
+
+MOMENT = datetime(2023, 1, 5, 10, 15, tzinfo=timezone.utc)
+
+
+def _codec(backend):
+    if backend == "orjson":
+        pytest.importorskip("orjson")
+    return get_codec(backend)
+
+
+@pytest.fixture(params=["stdlib", "orjson"])
+def codec(request):
+    return _codec(request.param)
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode("ascii")
+
+
+def _raw(data):
+    return base64.b64decode(data)
+
+
+def _events():
+    generator = SESEventGenerator(fanout=3, seed=21)
+    events = [generator.event(event_type, MOMENT) for event_type in EVENT_TYPES]
+    events[0]["mail"]["commonHeaders"]["subject"] = "Bienvenue à bord   \"quoted\" \\ tab\t \U0001F600"
+    return events
+
+
+def test_auto_picks_the_fastest_backend():
+    assert get_codec().name == next(iter(BACKENDS))
+    with pytest.raises(ValueError, match="JSON backend 'simdjson' is not available"):
+        get_codec("simdjson")
+
+
+def test_events_round_trip(codec):
+    for event in _events():
+        data = codec.encode(event)
+        raw = _raw(data)
+        # compact UTF-8 JSON in insertion order, one document per line
+        assert raw == json.dumps(event, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+        assert codec.decode(data) == event
+        assert codec.decode(_b64(json.dumps(event, indent=2).encode())) == event
+
+
+def test_lines_are_encoded_in_one_record(codec):
+    events = _events()
+    raw = _raw(codec.encode_lines(events))
+    assert raw == b"".join(_raw(codec.encode(e)) for e in events)
+    assert [json.loads(line) for line in raw.splitlines()] == events
+    assert codec.encode_lines([]) == ""
+
+
+def test_backends_write_the_same_bytes():
+    stdlib, orjson = get_codec("stdlib"), _codec("orjson")
+    values = _events() + [{"a": "\x00\x1f\x7f/"}, [0.1, 1.0, 1e15, -0.0, 2 ** 63 - 1, -2 ** 63, 2 ** 64 - 1],
+                          {"n": None, "t": True, "f": False, "e": {}, "l": []}]
+    for value in values:
+        assert stdlib.encode(value) == orjson.encode(value)
+        assert stdlib.encode_lines([value, value]) == orjson.encode_lines([value, value])
+
+
+def test_floats_with_an_exponent():
+    values = [1e16, 1.5e-7]
+    assert _raw(get_codec("stdlib").encode(values)) == b"[1e+16,1.5e-07]\n"
+    assert _raw(_codec("orjson").encode(values)) == b"[1e16,1.5e-7]\n"
+    for backend in ("stdlib", "orjson"):
+        assert _codec(backend).decode(_b64(b"[1e16,1.5e-7]")) == values
+
+
+def test_nan_and_infinity():
+    data = _b64(b'{"a": NaN, "b": Infinity}')
+    decoded = get_codec("stdlib").decode(data)
+    assert math.isnan(decoded["a"]) and decoded["b"] == math.inf
+    with pytest.raises(ValueError):
+        get_codec("stdlib").encode(decoded)
+    with pytest.raises(ValueError):
+        _codec("orjson").decode(data)
+
+
+def test_lone_surrogates():
+    data = _b64(b'{"a": "\\ud800"}')
+    decoded = get_codec("stdlib").decode(data)
+    assert decoded == {"a": "\ud800"}
+    with pytest.raises(UnicodeEncodeError):
+        get_codec("stdlib").encode(decoded)
+    with pytest.raises(ValueError):
+        _codec("orjson").decode(data)
+
+
+def test_integers_outside_64_bits():
+    data = _b64(b"[18446744073709551617, -9223372036854775809]")
+    assert get_codec("stdlib").decode(data) == [2 ** 64 + 1, -2 ** 63 - 1]
+    assert _raw(get_codec("stdlib").encode([2 ** 64 + 1])) == b"[18446744073709551617]\n"
+    orjson = _codec("orjson")
+    assert orjson.decode(data) == [float(2 ** 64 + 1), float(-2 ** 63 - 1)]
+    with pytest.raises(TypeError):
+        orjson.encode([2 ** 64 + 1])
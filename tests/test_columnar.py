@@ -0,0 +1,83 @@
+import base64
+import json
+
+import index
+import pytest
+from columnar import ColumnarBatch
+from flatten import FLAT
+from ses_blog_events import EVENT_TYPES, SESEventGenerator, firehose_batches
+
+EVENT = {"eventType": "Delivery", "mail": {"messageId": "m1", "timestamp": "2023-01-05T10:00:00.000Z",
+                                           "source": "news@example.com", "destination": ["a@example.org"]},
+         "delivery": {"timestamp": "2023-01-05T10:00:01.000Z", "recipients": ["a@example.org"]}}
+VALID = base64.b64encode(json.dumps(EVENT).encode()).decode()
+# not base64: the padding is missing
+INVALID = "eyJldmVudFR5cGUiOiJTZW5kIn0"
+
+
+def _batch(data):
+    return {"records": [{"recordId": str(i), "approximateArrivalTimestamp": 1672916400000, "data": d}
+                        for i, d in enumerate(data)]}
+
+
+def test_invalid_base64_fails_only_its_record():
+    batch = ColumnarBatch.decode(index.PROJECTION, index.CODEC, [VALID, INVALID, VALID])
+    assert list(batch.failed) == [1]
+    assert batch.column("eventType") == ["Delivery", None, "Delivery"]
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_handler_returns_invalid_base64_records_as_failed(monkeypatch, columnar):
+    monkeypatch.setattr(index, "COLUMNAR", columnar)
+    response = index.lambda_handler(_batch([VALID, INVALID, VALID]), None)
+
+    records = response["records"]
+    assert [r["result"] for r in records] == ["Ok", "ProcessingFailed", "Ok"]
+    assert records[1]["data"] == INVALID
+    assert records[0]["data"] == records[2]["data"]
+
+
+# '[1' and '2]' form one array when joined, and the second record holds two
+# documents: the counts add up, but none of them is a single event
+@pytest.mark.parametrize("data", [["[1", "2]", "{},{}"], ["{}", "[1", "2]"], ['{"a":"', '"}']])
+def test_records_that_are_not_one_document_fail_on_their_own(data):
+    encoded = [VALID] + [base64.b64encode(d.encode()).decode() for d in data]
+    batch = ColumnarBatch.decode(index.PROJECTION, index.CODEC, encoded)
+    valid = [i + 1 for i, d in enumerate(data) if d == "{}"]
+    assert sorted(batch.failed) == [i for i in range(1, len(encoded)) if i not in valid]
+    assert batch.column("eventType")[0] == "Delivery"
+    assert batch.payloads[0] == EVENT
+
+
+@pytest.mark.parametrize("columnar", [False, True])
+def test_handler_fails_records_that_are_not_one_document(monkeypatch, columnar):
+    monkeypatch.setattr(index, "COLUMNAR", columnar)
+    data = [VALID] + [base64.b64encode(d.encode()).decode() for d in ("[1", "2]", "{},{}")]
+    response = index.lambda_handler(_batch(data), None)
+
+    records = response["records"]
+    assert [r["result"] for r in records] == ["Ok", "ProcessingFailed", "ProcessingFailed", "ProcessingFailed"]
+    assert [r["data"] for r in records[1:]] == data[1:]
+
+
+def test_recipient_domains_are_extracted_once_per_address():
+    events = [dict(EVENT, mail=dict(EVENT["mail"], destination=d))
+              for d in (["a@example.org", "b@mail.example.net"], ["a@example.org", "nodomain", 7], "c@example.com")]
+    data = [base64.b64encode(json.dumps(e).encode()).decode() for e in events]
+    batch = ColumnarBatch.decode(index.PROJECTION, index.CODEC, data)
+    assert batch.recipient_domains() == {"a@example.org": "example.org", "b@mail.example.net": "mail.example.net",
+                                         "nodomain": None, "c@example.com": "example.com"}
+
+
+def test_flat_rows_match_the_per_record_path(monkeypatch):
+    generator = SESEventGenerator(mix=dict.fromkeys(EVENT_TYPES, 1), fanout=3, seed=7)
+    (batch,) = firehose_batches(generator.events(200))
+    monkeypatch.setattr(index, "OUTPUT_FORMAT", FLAT)
+    responses = []
+    for columnar in (False, True):
+        monkeypatch.setattr(index, "COLUMNAR", columnar)
+        responses.append(index.lambda_handler(batch, None)["records"])
+    assert responses[0] == responses[1]
+    rows = [json.loads(line) for r in responses[1] for line in base64.b64decode(r["data"]).splitlines()]
+    assert {row["mailRecipientDomain"] for row in rows} <= {"example.com", "example.org", "mail.example.net",
+                                                             "example.co.uk", "corp.example.io"}
@@ -0,0 +1,181 @@
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from ses_blog_compaction import COLLECTED, COMMITTED, Compactor, live_partitions
+from ses_blog_dedup import Deduplicator
+from ses_blog_partitions import PartitionManager
+from ses_blog_storage import LocalStore, S3Store
+
+BUCKET = "123456789012-us-east-1-ses-events-destination-aggregated"
+DATABASE = "ses_event_data_database"
+PARTITION = "partitioned/year=2023/month=1/day=5/hour=10"
+NOW = datetime(2023, 1, 5, 12, tzinfo=timezone.utc)
+
+
+def _object(events):
+    return gzip.compress("".join(json.dumps(e) + "\n" for e in events).encode("utf-8"))
+
+
+def _events(store, objects):
+    events = []
+    for obj in objects:
+        events.extend(json.loads(line) for line in gzip.decompress(store.get(obj.key)).splitlines())
+    return events
+
+
+@pytest.fixture
+def aws():
+    with mock_aws():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket=BUCKET)
+        glue = boto3.client("glue", region_name="us-east-1")
+        glue.create_database(DatabaseInput={"Name": DATABASE})
+        glue.create_table(DatabaseName=DATABASE, TableInput={
+            "Name": "partitioned",
+            "StorageDescriptor": {"Location": f"s3://{BUCKET}/partitioned/", "Columns": []},
+            "PartitionKeys": [{"Name": k, "Type": "string"} for k in ("year", "month", "day", "hour")],
+        })
+        catalog = PartitionManager(glue, DATABASE, "partitioned")
+        catalog.register([("2023", "1", "5", "10")])
+        store = S3Store(s3, BUCKET)
+        for i in range(3):
+            store.put(f"{PARTITION}/firehose-{i}.gz", _object([{"messageId": f"m{i}"}, {"messageId": "dup"}]))
+        yield store, catalog
+
+
+def _location(catalog):
+    return catalog.client.get_partition(DatabaseName=DATABASE, TableName="partitioned",
+                                        PartitionValues=["2023", "1", "5", "10"])["Partition"]["StorageDescriptor"]["Location"]
+
+
+def test_compaction_swaps_the_partition_location(aws):
+    store, catalog = aws
+    manifests = Compactor(store, catalog, now=NOW).run()
+
+    assert len(manifests) == 1
+    manifest = manifests[0]
+    assert manifest["state"] == COMMITTED
+    assert _location(catalog) == f"s3://{BUCKET}/{manifest['location']}"
+    # nothing is written into the partition prefix, the inputs are kept until the retention ends
+    assert sorted(o.key for o in store.list(f"{PARTITION}/")) == [f"{PARTITION}/firehose-{i}.gz" for i in range(3)]
+    assert [o.key for o in store.list(manifest["location"])] == [o["key"] for o in manifest["outputs"]]
+
+    objects = live_partitions(store, "partitioned/")[PARTITION]
+    assert [o.key for o in objects] == [o["key"] for o in manifest["outputs"]]
+    assert len(_events(store, objects)) == 6
+
+
+def test_late_objects_are_compacted_into_the_next_generation(aws):
+    store, catalog = aws
+    first = Compactor(store, catalog, now=NOW).run()[0]
+    store.put(f"{PARTITION}/firehose-late.gz", _object([{"messageId": "late"}]))
+
+    assert len(_events(store, live_partitions(store, "partitioned/")[PARTITION])) == 7
+    second = Compactor(store, catalog, min_files=10, now=NOW).run()
+    assert len(second) == 1
+    assert _location(catalog).endswith(second[0]["location"])
+    objects = live_partitions(store, "partitioned/")[PARTITION]
+    assert all(o.key.startswith(second[0]["location"]) for o in objects)
+    assert len(_events(store, objects)) == 7
+    assert {i["key"] for i in second[0]["inputs"]} >= {o["key"] for o in first["outputs"]}
+
+
+def test_retired_objects_are_deleted_after_the_retention(aws):
+    store, catalog = aws
+    manifest = Compactor(store, catalog, now=NOW).run()[0]
+    Compactor(store, catalog, retention=timedelta(hours=1), now=NOW + timedelta(minutes=30)).run()
+    assert store.exists(f"{PARTITION}/firehose-0.gz")
+
+    later = datetime.fromisoformat(manifest["committed_at"]) + timedelta(hours=1)
+    Compactor(store, catalog, retention=timedelta(hours=1), now=later).run()
+    assert list(store.list(f"{PARTITION}/")) == []
+    saved = json.loads(store.get(f"_compaction/manifests/{PARTITION}/{manifest['run_id']}.json"))
+    assert saved["state"] == COLLECTED
+    assert len(_events(store, live_partitions(store, "partitioned/")[PARTITION])) == 6
+
+
+def test_interrupted_staging_is_rolled_back(aws):
+    store, catalog = aws
+    compactor = Compactor(store, catalog, now=NOW)
+    compactor.split = lambda objects: (_ for _ in ()).throw(RuntimeError("interrupted"))
+    with pytest.raises(RuntimeError):
+        compactor.compact(PARTITION, live_partitions(store, "partitioned/")[PARTITION])
+    assert _location(catalog) == f"s3://{BUCKET}/{PARTITION}/"
+    assert len(_events(store, live_partitions(store, "partitioned/")[PARTITION])) == 6
+
+    manifest = Compactor(store, catalog, now=NOW).run()[0]
+    assert [o.key for o in store.list("_compaction/manifests/")] == \
+        [f"_compaction/manifests/{PARTITION}/{manifest['run_id']}.json"]
+    assert len(_events(store, live_partitions(store, "partitioned/")[PARTITION])) == 6
+
+
+def test_interrupted_publication_is_completed(aws):
+    store, catalog = aws
+    compactor = Compactor(store, catalog, now=NOW)
+    compactor._publish = lambda manifest: (_ for _ in ()).throw(RuntimeError("interrupted"))
+    with pytest.raises(RuntimeError):
+        compactor.compact(PARTITION, live_partitions(store, "partitioned/")[PARTITION])
+    assert _location(catalog) == f"s3://{BUCKET}/{PARTITION}/"
+
+    assert Compactor(store, catalog, now=NOW).run() == []
+    assert "/_compacted/" in _location(catalog)
+    assert len(_events(store, live_partitions(store, "partitioned/")[PARTITION])) == 6
+
+
+def test_tables_of_other_buckets_are_refused(aws):
+    store, catalog = aws
+    store.client.create_bucket(Bucket="123456789012-us-east-1-ses-events-destination")
+    destination = S3Store(store.client, "123456789012-us-east-1-ses-events-destination")
+    with pytest.raises(ValueError, match="only the bucket read by the table"):
+        Compactor(destination, catalog, now=NOW).run()
+
+
+def test_scheduled_crawler_tables_are_refused(aws):
+    store, catalog = aws
+    glue = catalog.client
+    glue.create_crawler(Name="SESEventDataCrawler", Role="role", DatabaseName=DATABASE,
+                        Targets={"S3Targets": [{"Path": f"s3://{BUCKET}/partitioned/"}]},
+                        Schedule="cron(30 0/1 * * ? *)")
+    table = glue.get_table(DatabaseName=DATABASE, Name="partitioned")["Table"]
+    glue.update_table(DatabaseName=DATABASE, TableInput={
+        "Name": "partitioned", "StorageDescriptor": table["StorageDescriptor"],
+        "PartitionKeys": table["PartitionKeys"], "Parameters": {"UPDATED_BY_CRAWLER": "SESEventDataCrawler"}})
+    with pytest.raises(ValueError, match="scheduled crawler"):
+        Compactor(store, PartitionManager(glue, DATABASE, "partitioned"), now=NOW).run()
+
+
+def test_deduplication_publishes_a_new_generation(aws):
+    store, catalog = aws
+    deduplicator = Deduplicator(store, catalog, now=NOW)
+    manifests = deduplicator.run()
+
+    assert deduplicator.duplicates == {PARTITION: 2}
+    assert _location(catalog).endswith(manifests[0]["location"])
+    events = _events(store, live_partitions(store, "partitioned/")[PARTITION])
+    assert sorted(e["messageId"] for e in events) == ["dup", "m0", "m1", "m2"]
+
+
+def test_local_directory_is_compacted_without_a_catalog(tmp_path):
+    store = LocalStore(str(tmp_path))
+    for i in range(3):
+        store.put(f"{PARTITION}/firehose-{i}.gz", _object([{"messageId": f"m{i}"}]))
+    # not closed yet
+    store.put("partitioned/year=2023/month=1/day=5/hour=11/firehose-0.gz", _object([{"messageId": "late"}]))
+    store.put("partitioned/year=2023/month=1/day=5/hour=11/firehose-1.gz", _object([{"messageId": "late"}]))
+
+    manifests = Compactor(store, None, now=NOW).run()
+    assert [m["partition"] for m in manifests] == [PARTITION]
+    assert manifests[0]["state"] == COMMITTED
+    objects = live_partitions(store, "partitioned/")[PARTITION]
+    assert [o.key for o in objects] == [manifests[0]["outputs"][0]["key"]]
+    assert sorted(e["messageId"] for e in _events(store, objects)) == ["m0", "m1", "m2"]
+
+    later = datetime.fromisoformat(manifests[0]["committed_at"]) + timedelta(hours=1)
+    Compactor(store, None, now=later).run()
+    assert not store.exists(f"{PARTITION}/firehose-0.gz")
+    assert len(live_partitions(store, "partitioned/")["partitioned/year=2023/month=1/day=5/hour=11"]) == 1
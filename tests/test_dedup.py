@@ -0,0 +1,75 @@
+import base64
+import json
+
+import index
+import pytest
+from dedup import RotatingBloomFilter, event_key
+from ses_blog_dedup import event_key as offline_event_key
+
+MAIL = {"messageId": "m1", "destination": ["a@example.com", "b@example.com"], "timestamp": "2023-01-05T10:00:00.000Z"}
+
+
+def _bounce(recipient):
+    return {"eventType": "Bounce", "mail": MAIL,
+            "bounce": {"bounceType": "Permanent", "timestamp": "2023-01-05T10:00:01.000Z",
+                       "bouncedRecipients": [{"emailAddress": recipient}]}}
+
+
+def _batch(events, first_id=0):
+    return {"records": [{"recordId": str(first_id + i), "approximateArrivalTimestamp": 1672916400000,
+                         "data": base64.b64encode(json.dumps(e).encode()).decode()}
+                        for i, e in enumerate(events)]}
+
+
+def _results(response):
+    return [r["result"] for r in response["records"]]
+
+
+@pytest.fixture
+def dedup(monkeypatch):
+    monkeypatch.setattr(index, "DEDUP", RotatingBloomFilter(1000, 0.0001))
+    return index.DEDUP
+
+
+def test_key_uses_the_recipients_of_the_event():
+    base = {"messageId": "m1", "eventType": "Bounce", "timestamp": "t", "destination": MAIL["destination"]}
+    first = event_key({**base, "bouncedRecipients": [{"emailAddress": "a@example.com"}]})
+    second = event_key({**base, "bouncedRecipients": [{"emailAddress": "b@example.com"}]})
+    assert first != second
+    delivery = {**base, "eventType": "Delivery", "recipients": ["a@example.com"]}
+    assert event_key(delivery).endswith(b"a@example.com")
+    opened = {**base, "eventType": "Open", "bouncedRecipients": [{"emailAddress": ""}], "recipients": []}
+    assert event_key(opened).endswith(b"a@example.com,b@example.com")
+    assert offline_event_key(delivery) == event_key(delivery).decode()
+
+
+def test_per_recipient_events_are_not_duplicates(dedup):
+    response = index.lambda_handler(_batch([_bounce("a@example.com"), _bounce("b@example.com")]), None)
+    assert _results(response) == ["Ok", "Ok"]
+
+
+def test_keys_are_remembered_once_the_response_is_accepted(dedup):
+    assert _results(index.lambda_handler(_batch([_bounce("a@example.com")]), None)) == ["Ok"]
+    assert dedup.pending and not any(key in dedup for key in dedup.pending)
+    # a new batch: the previous response was accepted
+    response = index.lambda_handler(_batch([_bounce("a@example.com"), _bounce("b@example.com")], first_id=10), None)
+    assert _results(response) == ["Dropped", "Ok"]
+
+
+def test_retried_batch_is_not_dropped(dedup):
+    batch = _batch([_bounce("a@example.com"), _bounce("b@example.com")])
+    assert _results(index.lambda_handler(json.loads(json.dumps(batch)), None)) == ["Ok", "Ok"]
+    # Firehose sends the same records again when it rejected the response
+    assert _results(index.lambda_handler(json.loads(json.dumps(batch)), None)) == ["Ok", "Ok"]
+    assert _results(index.lambda_handler(_batch([_bounce("a@example.com")], first_id=10), None)) == ["Dropped"]
+
+
+def test_stage_and_commit():
+    keys = RotatingBloomFilter(100, 0.001)
+    keys.stage({b"k"}, ["1", "2"])
+    assert b"k" not in keys
+    assert not keys.commit(["2", "3"])
+    assert b"k" not in keys and keys.pending is None
+    keys.stage({b"k"}, ["1", "2"])
+    assert keys.commit(["3"])
+    assert b"k" in keys
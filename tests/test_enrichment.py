@@ -0,0 +1,59 @@
+import base64
+import json
+
+import index
+import pytest
+from executor import BatchExecutor
+from useragent import UserAgentEnricher
+
+GMAIL_PROXY = "Mozilla/5.0 (Windows NT 5.1; rv:11.0) Gecko Firefox/11.0 (via ggpht.com GoogleImageProxy)"
+OUTLOOK = "Microsoft Office/16.0 (Windows NT 10.0; Microsoft Outlook 16.0.5413; Pro)"
+
+
+def _open(user_agent):
+    event = {"eventType": "Open", "mail": {"messageId": "m1", "timestamp": "2023-01-05T10:00:00.000Z",
+                                           "source": "news@example.com", "destination": ["a@example.org"]},
+             "open": {"timestamp": "2023-01-05T10:00:01.000Z", "userAgent": user_agent, "ipAddress": "192.0.2.1"}}
+    return base64.b64encode(json.dumps(event).encode()).decode()
+
+
+def _batch(data):
+    return {"records": [{"recordId": str(i), "approximateArrivalTimestamp": 1672916400000, "data": d}
+                        for i, d in enumerate(data)]}
+
+
+def _emitted(capsys):
+    return json.loads(capsys.readouterr().out.splitlines()[-1])
+
+
+def test_user_agent_counts_are_returned_per_event():
+    enricher = UserAgentEnricher(cache_size=1)
+    projected = {"eventType": "Open", "userAgent": OUTLOOK}
+    assert enricher.enrich(projected) == (0, 1)
+    assert projected["userAgentClient"] == "Outlook"
+    assert enricher.enrich({"eventType": "Open", "userAgent": OUTLOOK}) == (1, 0)
+    # the least recently used user agent is evicted
+    assert enricher.enrich({"eventType": "Click", "userAgent": GMAIL_PROXY}) == (0, 1)
+    assert enricher.enrich({"eventType": "Open", "userAgent": OUTLOOK}) == (0, 1)
+    assert enricher.enrich({"eventType": "Delivery", "userAgent": OUTLOOK}) == (0, 0)
+
+
+@pytest.mark.parametrize("mode, columnar", [("serial", False), ("thread", False), ("serial", True)])
+def test_user_agent_cache_metrics_in_every_mode(monkeypatch, capsys, mode, columnar):
+    monkeypatch.setattr(index, "EXECUTOR", BatchExecutor(mode=mode, workers=4, min_batch_size=1))
+    monkeypatch.setattr(index, "COLUMNAR", columnar)
+    monkeypatch.setattr(index, "METRICS_ENABLED", True)
+    monkeypatch.setattr(index, "USER_AGENTS", UserAgentEnricher())
+    user_agents = [OUTLOOK, GMAIL_PROXY] * 8
+
+    response = index.lambda_handler(_batch([_open(u) for u in user_agents]), None)
+    assert [r["result"] for r in response["records"]] == ["Ok"] * 16
+    emitted = _emitted(capsys)
+    # threads may parse the same user agent before either has cached it
+    assert emitted["UserAgentCacheHits"] + emitted["UserAgentCacheMisses"] == 16
+    assert emitted["UserAgentCacheMisses"] >= 2
+    assert "GeoIpLookups" not in emitted
+
+    index.lambda_handler(_batch([_open(u) for u in user_agents]), None)
+    emitted = _emitted(capsys)
+    assert (emitted["UserAgentCacheHits"], emitted["UserAgentCacheMisses"]) == (16, 0)
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from codec import PAYLOAD_SIZE_LIMIT
+from ses_blog_events import FIREHOSE_RECORD_OVERHEAD, SESEventGenerator, firehose_batches
+
+START = datetime(2023, 1, 5, tzinfo=timezone.utc)
+
+
+def _batches(seed, **options):
+    return list(firehose_batches(SESEventGenerator(start=START, seed=seed).events(300), seed=seed, **options))
+
+
+def test_same_seed_gives_the_same_batches():
+    assert _batches(7, max_records=50) == _batches(7, max_records=50)
+    assert _batches(7, max_records=50)[0]["invocationId"] != _batches(8, max_records=50)[0]["invocationId"]
+
+
+def test_batches_fit_the_lambda_payload_limit():
+    batches = _batches(0, max_payload=20000)
+    assert len(batches) > 1
+    for batch in batches:
+        assert sum(len(r["data"]) + FIREHOSE_RECORD_OVERHEAD for r in batch["records"]) <= 20000
+    assert len({b["invocationId"] for b in batches}) == len(batches)
+    assert firehose_batches.__defaults__[0] == PAYLOAD_SIZE_LIMIT
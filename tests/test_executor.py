@@ -0,0 +1,82 @@
+import os
+import signal
+
+import pytest
+from executor import PROCESS, SERIAL, THREAD, BatchExecutor
+
+
+def _square(n):
+    return n * n
+
+
+def _fail_on_13(n):
+    if n == 13:
+        raise ValueError("unlucky")
+    return n
+
+
+def _exit_worker(n):
+    if n == 0:
+        os.kill(os.getpid(), signal.SIGKILL)
+    return n
+
+
+@pytest.fixture
+def executors():
+    created = []
+
+    def make(mode, **options):
+        executor = BatchExecutor(mode=mode, workers=3, **options)
+        created.append(executor)
+        return executor
+
+    yield make
+    for executor in created:
+        executor.shutdown()
+
+
+@pytest.mark.parametrize("mode", [SERIAL, THREAD, PROCESS])
+def test_results_keep_the_input_order(executors, mode):
+    executor = executors(mode, min_batch_size=1, chunk_size=7)
+    assert executor.map(_square, range(250)) == [n * n for n in range(250)]
+    # the pool is kept for the next batch
+    assert executor.map(_square, range(5)) == [0, 1, 4, 9, 16]
+
+
+def test_small_batches_are_processed_serially(executors):
+    executor = executors(PROCESS, min_batch_size=100)
+    assert executor.effective_mode(99) == SERIAL
+    assert executor.effective_mode(100) == PROCESS
+    assert executor.map(_square, range(99)) == [n * n for n in range(99)]
+    assert executor._processes is None
+    assert BatchExecutor(mode=THREAD, workers=1, min_batch_size=1).effective_mode(1000) == SERIAL
+
+
+def test_unknown_mode_is_refused():
+    with pytest.raises(ValueError, match="Unknown processing mode 'fork'"):
+        BatchExecutor.from_environment({"PROCESSING_MODE": "FORK"})
+
+
+@pytest.mark.parametrize("mode", [THREAD, PROCESS])
+def test_exceptions_of_the_function_are_raised(executors, mode):
+    executor = executors(mode, min_batch_size=1, chunk_size=5)
+    with pytest.raises(ValueError, match="unlucky"):
+        executor.map(_fail_on_13, range(50))
+    # the workers are still in sync with the parent
+    assert executor.map(_square, range(50)) == [n * n for n in range(50)]
+
+
+def test_a_dead_worker_fails_only_its_batch(executors):
+    executor = executors(PROCESS, min_batch_size=1, chunk_size=10)
+    assert executor.map(_square, range(30)) == [n * n for n in range(30)]
+    process, _ = executor._processes._workers[1]
+    process.kill()
+    process.join()
+
+    with pytest.raises(RuntimeError, match="exited unexpectedly"):
+        executor.map(_square, range(30))
+    assert executor.map(_square, range(30)) == [n * n for n in range(30)]
+
+    with pytest.raises(RuntimeError, match="exited unexpectedly"):
+        executor.map(_exit_worker, range(30))
+    assert executor.map(_square, range(30)) == [n * n for n in range(30)]
@@ -0,0 +1,125 @@
+import base64
+import json
+import random
+from datetime import datetime, timezone
+
+import index
+import pytest
+from executor import BatchExecutor
+from ses_blog_events import SESEventGenerator, firehose_record
+
+MOMENT = datetime(2023, 1, 5, 10, 15, tzinfo=timezone.utc)
+ARRIVAL_MS = 1672913700000
+MODES = [("serial", False), ("thread", False), ("process", False), ("serial", True)]
+
+
+def _events(n, seed=3):
+    generator = SESEventGenerator(fanout=2, seed=seed)
+    return list(generator.events(n))
+
+
+def _batch(events, ids=None):
+    ids = ids or [f"{i:020d}" for i in range(len(events))]
+    return {"invocationId": "test", "records": [firehose_record(e, r, ARRIVAL_MS) for r, e in zip(ids, events)]}
+
+
+def _results(response):
+    return [r["result"] for r in response["records"]]
+
+
+@pytest.fixture(params=MODES, ids=[f"{m}{'-columnar' if c else ''}" for m, c in MODES])
+def handler(request, monkeypatch):
+    mode, columnar = request.param
+    executor = BatchExecutor(mode=mode, workers=3, min_batch_size=1, chunk_size=4)
+    monkeypatch.setattr(index, "EXECUTOR", executor)
+    monkeypatch.setattr(index, "COLUMNAR", columnar)
+    monkeypatch.setattr(index, "COLUMNAR_CHUNK_SIZE", 4)
+    monkeypatch.setattr(index, "METRICS_ENABLED", False)
+    yield lambda event: index.lambda_handler(event, None)
+    executor.shutdown()
+
+
+def _padded(event, size):
+    event["mail"].setdefault("commonHeaders", {})["subject"] = "x" * size
+    return event
+
+
+def _expected_overflow(event, limit):
+    # replays the response in input order with its serialized size: every
+    # record is first counted as failed with no data, then each one is returned
+    # Ok if its data still fits
+    alone = [index.lambda_handler({"records": [r]}, None)["records"][0] for r in event["records"]]
+    failed = [{"recordId": r["recordId"], "result": "ProcessingFailed", "data": ""} for r in alone]
+    size = len(json.dumps({"records": failed}))
+    results = []
+    for ok, empty in zip(alone, failed):
+        extra = len(json.dumps(ok)) - len(json.dumps(empty))
+        if size + extra <= limit:
+            size += extra
+            results.append("Ok")
+        else:
+            results.append("ProcessingFailed")
+    return results
+
+
+def test_records_past_the_response_limit_are_retried(handler):
+    rnd = random.Random(5)
+    # about 9 MiB of output: large records among small ones, so that small
+    # records still fit after the first large one has overflowed
+    events = [_padded(e, rnd.choice([1000, 300_000, 600_000])) for e in _events(30)]
+    event = _batch(events)
+    response = handler(event)
+
+    results = _results(response)
+    assert results == _expected_overflow(event, index.MAX_RESPONSE_BYTES)
+    assert "Ok" in results[results.index("ProcessingFailed"):]
+    assert len(json.dumps(response)) <= index.MAX_RESPONSE_BYTES < index.RESPONSE_SIZE_LIMIT
+    for record in response["records"]:
+        if record["result"] == "ProcessingFailed":
+            assert record["data"] == ""
+        else:
+            assert json.loads(base64.b64decode(record["data"]))["subject"].startswith("x")
+
+
+def test_records_past_a_smaller_limit_are_retried(handler, monkeypatch):
+    monkeypatch.setattr(index, "MAX_RESPONSE_BYTES", 20_000)
+    event = _batch(_events(60))
+    results = _results(handler(event))
+    assert results == _expected_overflow(event, 20_000)
+    assert 0 < results.count("Ok") < 60
+
+
+def test_a_bad_record_fails_on_its_own(handler):
+    events = _events(12)
+    event = _batch(events)
+    bad = {
+        2: "not base64!",
+        5: base64.b64encode(b'{"eventType": "Send", "mail": ').decode(),
+        7: base64.b64encode(b'["a", "list"]').decode(),
+        9: base64.b64encode(b"\xff\xfe").decode(),
+    }
+    for i, data in bad.items():
+        event["records"][i]["data"] = data
+    response = handler(event)
+
+    expected = handler(_batch(events))["records"]
+    for i, record in enumerate(response["records"]):
+        assert record["recordId"] == event["records"][i]["recordId"]
+        if i in bad:
+            assert record == {"recordId": record["recordId"], "result": "ProcessingFailed", "data": bad[i]}
+        else:
+            assert record == expected[i]
+
+
+def test_record_ids_keep_their_order(handler):
+    events = _events(40)
+    ids = [f"{random.Random(i).getrandbits(64):020d}" for i in range(40)]
+    event = _batch(events, ids)
+    # a Firehose test event, returned Dropped after the processed records
+    event["records"][3]["data"] = ""
+    response = handler(event)
+
+    assert [r["recordId"] for r in response["records"]] == ids[:3] + ids[4:] + [ids[3]]
+    assert _results(response) == ["Ok"] * 39 + ["Dropped"]
+    for record, original in zip(response["records"], events[:3] + events[4:]):
+        assert json.loads(base64.b64decode(record["data"]))["messageId"] == original["mail"]["messageId"]
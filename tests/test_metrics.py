@@ -0,0 +1,42 @@
+import base64
+import json
+
+import index
+from metrics import BatchMetrics
+
+
+def _sample(event_type):
+    return (event_type, 10, 10, 0, 0, 0)
+
+
+def test_event_types_outside_ses_are_counted_as_other():
+    metrics = BatchMetrics(function_name="test")
+    for event_type in ("Open", "Open", "Rendering Failure", 5, "Custom", ["Open"], {"a": 1}, None):
+        metrics.add_sample("Ok", _sample(event_type))
+    document = metrics.document()
+    assert document["EventsOpen"] == 2
+    assert document["EventsRenderingFailure"] == 1
+    assert document["EventsOther"] == 4
+    assert document["RecordsOk"] == 8
+    names = [m["Name"] for m in document["_aws"]["CloudWatchMetrics"][0]["Metrics"]]
+    assert not [n for n in names if n.startswith("Events") and n not in ("EventsOpen", "EventsRenderingFailure",
+                                                                          "EventsOther")]
+
+
+def test_emit_never_raises(capsys):
+    metrics = BatchMetrics(function_name="test", properties={"invocation": object()})
+    metrics.add_sample("Ok", _sample("Open"))
+    metrics.emit()
+    assert capsys.readouterr().out == ""
+
+
+def test_handler_emits_metrics_for_malformed_event_types(capsys):
+    records = [{"recordId": str(i), "approximateArrivalTimestamp": 1672916400000,
+                "data": base64.b64encode(json.dumps(event).encode()).decode()}
+               for i, event in enumerate(({"eventType": 5, "mail": {}}, {"eventType": "Open", "mail": {}}))]
+    response = index.lambda_handler({"records": records}, None)
+    assert len(response["records"]) == 2
+    lines = [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith("{")]
+    document = [line for line in lines if "_aws" in line][-1]
+    assert document["EventsOther"] == 1
+    assert document["EventsOpen"] == 1
@@ -0,0 +1,163 @@
+import os
+
+import boto3
+import pytest
+import yaml
+from moto import mock_aws
+
+import ses_blog_partitions
+from partitioning import PARTITION_TEMPLATE, partition_path
+from ses_blog_partitions import PartitionManager, partition_values, projection_table_input
+
+BUCKET = "123456789012-us-east-1-ses-events-destination"
+DATABASE = "ses_event_data_database"
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+class CountingGlue:
+    # records the BatchCreatePartition calls made through a real client
+
+    def __init__(self, client):
+        self.client = client
+        self.batches = []
+
+    def batch_create_partition(self, **kwargs):
+        self.batches.append([p["Values"] for p in kwargs["PartitionInputList"]])
+        return self.client.batch_create_partition(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+@pytest.fixture
+def glue():
+    with mock_aws():
+        client = boto3.client("glue", region_name="us-east-1")
+        client.create_database(DatabaseInput={"Name": DATABASE})
+        client.create_table(DatabaseName=DATABASE, TableInput={
+            "Name": "partitioned",
+            "StorageDescriptor": {"Location": f"s3://{BUCKET}/partitioned/", "Columns": []},
+            "PartitionKeys": [{"Name": k, "Type": "string"} for k in ("year", "month", "day", "hour")],
+        })
+        yield CountingGlue(client)
+
+
+def _hours(count):
+    return [("2023", str(1 + i // (31 * 24) % 12), str(1 + i // 24 % 31), str(i % 24)) for i in range(count)]
+
+
+def _locations(glue):
+    partitions = glue.get_partitions(DatabaseName=DATABASE, TableName="partitioned")["Partitions"]
+    return {tuple(p["Values"]): p["StorageDescriptor"]["Location"] for p in partitions}
+
+
+def test_partition_values_follow_the_producer_layout():
+    assert partition_values("partitioned/year=2023/month=1/day=5/hour=0/firehose-1.gz") == ("2023", "1", "5", "0")
+    assert partition_path(("2023", "1", "5", "0")) == "year=2023/month=1/day=5/hour=0"
+    # a key with leading zeros is in another prefix than the location registered for it
+    assert partition_values("partitioned/year=2023/month=01/day=05/hour=00/firehose-1.gz") is None
+    assert partition_values("raw/2023/01/05/00/firehose-1.gz") is None
+
+
+def test_partitions_are_created_in_batches_of_100(glue):
+    manager = PartitionManager(glue, DATABASE, "partitioned", batch_size=500)
+    created = manager.register(_hours(250))
+
+    assert [len(batch) for batch in glue.batches] == [100, 100, 50]
+    assert len(created) == 250
+    assert len(_locations(glue)) == 250
+    assert manager.register(_hours(250)) == []
+    assert len(glue.batches) == 3
+
+
+def test_partition_locations_match_the_producer_layout(glue):
+    manager = PartitionManager(glue, DATABASE, "partitioned")
+    manager.register_keys(["partitioned/year=2023/month=1/day=5/hour=9/firehose-1.gz",
+                           "partitioned/year=2023/month=01/day=05/hour=10/firehose-2.gz"])
+
+    assert _locations(glue) == {("2023", "1", "5", "9"): f"s3://{BUCKET}/partitioned/year=2023/month=1/day=5/hour=9/"}
+
+
+def test_existing_partitions_are_remembered(glue):
+    manager = PartitionManager(glue, DATABASE, "partitioned")
+    assert manager.known == set()
+    # created by the crawler or another invocation after the catalog was read
+    glue.create_partition(DatabaseName=DATABASE, TableName="partitioned",
+                          PartitionInput=manager.partition_input(("2023", "1", "5", "10")))
+
+    created = manager.register([("2023", "1", "5", "10"), ("2023", "1", "5", "11")])
+    assert created == [("2023", "1", "5", "11")]
+    assert manager.known == {("2023", "1", "5", "10"), ("2023", "1", "5", "11")}
+    assert manager.register([("2023", "1", "5", "10")]) == []
+    assert len(glue.batches) == 1
+
+
+def _managers(glue, partitioned="partitioned", rollups="hourly_rollups"):
+    return {"partitioned/": PartitionManager(glue, DATABASE, partitioned),
+            "hourly_rollups/": PartitionManager(glue, DATABASE, rollups)}
+
+
+def test_lambda_handler_registers_the_partitions_of_the_notified_objects(glue, monkeypatch):
+    glue.create_table(DatabaseName=DATABASE, TableInput={
+        "Name": "hourly_rollups",
+        "StorageDescriptor": {"Location": f"s3://{BUCKET}/hourly_rollups/", "Columns": []},
+        "PartitionKeys": [{"Name": k, "Type": "string"} for k in ("year", "month", "day", "hour")],
+    })
+    monkeypatch.setattr(ses_blog_partitions, "MANAGERS", _managers(glue))
+    event = {"Records": [{"s3": {"object": {"key": "partitioned/year%3D2023/month%3D1/day%3D5/hour%3D9/f.gz"}}},
+                         {"s3": {"object": {"key": "partitioned/year=2023/month=1/day=5/hour=9/g.gz"}}},
+                         {"s3": {"object": {"key": "hourly_rollups/year=2023/month=1/day=5/hour=8/rollup.parquet"}}}]}
+
+    assert ses_blog_partitions.lambda_handler(event, None) == {"created": [
+        "partitioned/year=2023/month=1/day=5/hour=9", "hourly_rollups/year=2023/month=1/day=5/hour=8"]}
+    assert ses_blog_partitions.lambda_handler(event, None) == {"created": []}
+    rollups = glue.get_partitions(DatabaseName=DATABASE, TableName="hourly_rollups")["Partitions"]
+    assert [p["StorageDescriptor"]["Location"] for p in rollups] == \
+        [f"s3://{BUCKET}/hourly_rollups/year=2023/month=1/day=5/hour=8/"]
+
+
+def test_lambda_handler_waits_for_the_table(glue, monkeypatch):
+    monkeypatch.setattr(ses_blog_partitions, "MANAGERS", _managers(glue))
+    event = {"Records": [{"s3": {"object": {"key": "partitioned/year=2023/month=1/day=5/hour=9/f.gz"}}},
+                         {"s3": {"object": {"key": "hourly_rollups/year=2023/month=1/day=5/hour=8/rollup.parquet"}}}]}
+
+    # hourly_rollups is not crawled yet
+    assert ses_blog_partitions.lambda_handler(event, None) == {"created": [
+        "partitioned/year=2023/month=1/day=5/hour=9"]}
+
+
+def test_projection_template_matches_the_producer_layout():
+    table = projection_table_input("partitioned_projection", f"s3://{BUCKET}/partitioned")
+    template = table["Parameters"]["storage.location.template"]
+
+    assert template == f"s3://{BUCKET}/partitioned/year=${{year}}/month=${{month}}/day=${{day}}/hour=${{hour}}"
+
+
+def _cfn_resources():
+    class Loader(yaml.SafeLoader):
+        pass
+    Loader.add_multi_constructor("!", lambda loader, suffix, node: None)
+    with open(os.path.join(ROOT, "resources", "ses-blog-resources", "cfn.yaml")) as f:
+        return yaml.load(f, Loader=Loader)["Resources"]
+
+
+def _firehose_prefix(properties):
+    return properties["ExtendedS3DestinationConfiguration"]["Prefix"]
+
+
+def test_firehose_prefix_matches_the_partition_template():
+    resources = _cfn_resources()
+    prefix = _firehose_prefix(resources["KinesisFirehoseStream6F9ED265"]["Properties"])["Fn::If"][1]
+    expected = PARTITION_TEMPLATE.replace("{", "!{partitionKeyFromLambda:")
+    assert prefix.startswith(f"partitioned/{expected}/")
+
+    with open(os.path.join(ROOT, "cdk", "lib", "ses-blog-solution-stack.ts")) as f:
+        assert f"'partitioned/{expected}/" in f.read()
+
+
+def test_the_crawler_is_not_scheduled():
+    resources = _cfn_resources()
+    assert "Schedule" not in resources["SESEventDataCrawler"]["Properties"]
+
+    with open(os.path.join(ROOT, "cdk", "lib", "ses-blog-solution-stack.ts")) as f:
+        assert "scheduleExpression" not in f.read()
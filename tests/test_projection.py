@@ -0,0 +1,71 @@
+import copy
+import json
+from datetime import datetime, timezone
+
+import index
+import pytest
+from columnar import ColumnarBatch
+from ses_blog_events import EVENT_TYPES, SESEventGenerator
+
+MOMENT = datetime(2023, 1, 5, 10, 15, tzinfo=timezone.utc)
+
+
+def _without(event, *path):
+    event = copy.deepcopy(event)
+    node = event
+    for key in path[:-1]:
+        node = node[key]
+    node.pop(path[-1], None)
+    return event
+
+
+def _variants(event_type):
+    event = SESEventGenerator(fanout=3, seed=11).event(event_type, MOMENT)
+    detail = next(k for k in event if k not in ("eventType", "mail"))
+    extra = copy.deepcopy(event)
+    # unknown fields, and a projected field deeper in an unknown object, which overrides the
+    # one found earlier
+    extra["unknown"] = {"subject": "Overridden", "nested": {"reason": "deep", "other": [1, 2]}}
+    extra["mail"]["unknownList"] = [{"subject": "in a list, ignored"}]
+    extra["eventTypeVersion"] = 2
+    return {
+        "complete": event,
+        "missing_details": _without(event, detail),
+        "missing_common_headers": _without(event, "mail", "commonHeaders"),
+        "missing_tags": _without(event, "mail", "tags"),
+        "missing_mail": _without(event, "mail"),
+        "extra_fields": extra,
+        "empty": {},
+    }
+
+
+CASES = [(event_type, name, event) for event_type in EVENT_TYPES
+         for name, event in _variants(event_type).items()]
+
+
+def _reference(event):
+    with open(index.SCHEMA_FILE) as f:
+        template = json.load(f)
+    index.rec_update(template, copy.deepcopy(event))
+    return template
+
+
+@pytest.mark.parametrize("event_type, name, event", CASES, ids=[f"{t}-{n}" for t, n, _ in CASES])
+def test_projection_matches_rec_update(event_type, name, event):
+    expected = _reference(event)
+    assert index.PROJECTION(copy.deepcopy(event)) == expected
+    assert index.process_record(copy.deepcopy(event)) == expected
+
+
+def test_columnar_rows_match_rec_update():
+    events = [event for _, _, event in CASES]
+    data = [index.CODEC.encode(event) for event in events]
+    batch = ColumnarBatch.decode(index.PROJECTION, index.CODEC, data)
+    assert batch.rows() == [_reference(event) for event in events]
+
+
+def test_default_lists_are_not_shared():
+    first = index.PROJECTION({})
+    first["bouncedRecipients"][0]["emailAddress"] = "a@example.org"
+    first["destination"].append("a@example.org")
+    assert index.PROJECTION({}) == _reference({})
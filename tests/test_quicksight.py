@@ -0,0 +1,224 @@
+import importlib.util
+import os
+import threading
+from argparse import Namespace
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from conftest import RESOURCES_DIR
+from ses_blog_quicksight import ProvisioningError, QuickSightProvisioner, Step, run_steps, wait_until
+
+ACCOUNT = "123456789012"
+REGION = "us-east-1"
+USER = f"arn:aws:quicksight:{REGION}:{ACCOUNT}:user/default/admin"
+PERMISSIONS = [{"Principal": USER, "Actions": ["quicksight:DescribeDataSource"]}]
+PARAMETERS = {"AthenaParameters": {"WorkGroup": "SesAthenaWorkgroup"}}
+DATA_SOURCE_ARN = f"arn:aws:quicksight:{REGION}:{ACCOUNT}:datasource/AthenaDataSource"
+DASHBOARD_ARN = f"arn:aws:quicksight:{REGION}:{ACCOUNT}:dashboard/MySESLogDashboard"
+
+
+class FakeClock:
+    # a monotonic clock advanced by the sleeps
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def stubbed():
+    client = boto3.client("quicksight", region_name=REGION, aws_access_key_id="testing",
+                          aws_secret_access_key="testing")
+    with Stubber(client) as stubber:
+        yield QuickSightProvisioner(client, ACCOUNT, REGION, sleep=lambda seconds: None), stubber
+        stubber.assert_no_pending_responses()
+
+
+def _data_source(status, name="Athena Data Source"):
+    return {"DataSource": {"Arn": DATA_SOURCE_ARN, "DataSourceId": "AthenaDataSource", "Name": name,
+                           "Type": "ATHENA", "Status": status, "DataSourceParameters": PARAMETERS}}
+
+
+def _upsert_data_source(provisioner, name="Athena Data Source"):
+    return provisioner.upsert_data_source("AthenaDataSource", name, "ATHENA", PARAMETERS, PERMISSIONS)
+
+
+def test_wait_until_backs_off_up_to_the_deadline():
+    clock = FakeClock()
+    polls = []
+
+    def poll():
+        polls.append(clock.now)
+        return None
+
+    with pytest.raises(TimeoutError, match="data source"):
+        wait_until(poll, "data source", timeout=60, initial_delay=1, max_delay=20,
+                   sleep=clock.sleep, clock=clock, jitter=lambda: 1.0)
+    # the delay doubles up to max_delay, and the last sleep stops at the deadline
+    assert clock.sleeps == [1, 2, 4, 8, 16, 20, 9]
+    assert clock.now == 60
+    assert len(polls) == 8
+
+
+def test_wait_until_returns_the_first_result():
+    clock = FakeClock()
+    statuses = iter([None, None, "CREATION_SUCCESSFUL"])
+    result = wait_until(lambda: next(statuses), "dashboard", sleep=clock.sleep, clock=clock, jitter=lambda: 0.0)
+    assert result == "CREATION_SUCCESSFUL"
+    # a random half of each delay is dropped
+    assert clock.sleeps == [0.5, 1.0]
+
+
+def test_data_source_is_created_then_awaited(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DataSourceId": "AthenaDataSource"}
+    stubber.add_client_error("describe_data_source", "ResourceNotFoundException", expected_params=key)
+    stubber.add_response("create_data_source", {"Arn": DATA_SOURCE_ARN, "CreationStatus": "CREATION_IN_PROGRESS"},
+                         dict(key, Name="Athena Data Source", Type="ATHENA", DataSourceParameters=PARAMETERS,
+                              Permissions=PERMISSIONS))
+    stubber.add_response("describe_data_source", _data_source("CREATION_IN_PROGRESS"), key)
+    stubber.add_response("describe_data_source", _data_source("CREATION_SUCCESSFUL"), key)
+
+    assert _upsert_data_source(provisioner) == DATA_SOURCE_ARN
+
+
+def test_unchanged_data_source_is_not_updated(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DataSourceId": "AthenaDataSource"}
+    stubber.add_response("describe_data_source", _data_source("CREATION_SUCCESSFUL"), key)
+    stubber.add_response("update_data_source_permissions", {}, dict(key, GrantPermissions=PERMISSIONS))
+
+    assert _upsert_data_source(provisioner) == DATA_SOURCE_ARN
+
+
+def test_changed_data_source_is_updated(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DataSourceId": "AthenaDataSource"}
+    stubber.add_response("describe_data_source", _data_source("CREATION_SUCCESSFUL", name="Old name"), key)
+    stubber.add_response("update_data_source_permissions", {}, dict(key, GrantPermissions=PERMISSIONS))
+    stubber.add_response("update_data_source", {"UpdateStatus": "UPDATE_IN_PROGRESS"},
+                         dict(key, Name="Athena Data Source", DataSourceParameters=PARAMETERS))
+    stubber.add_response("describe_data_source", _data_source("UPDATE_SUCCESSFUL"), key)
+
+    assert _upsert_data_source(provisioner) == DATA_SOURCE_ARN
+
+
+def test_failed_data_source_raises(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DataSourceId": "AthenaDataSource"}
+    stubber.add_client_error("describe_data_source", "ResourceNotFoundException", expected_params=key)
+    stubber.add_response("create_data_source", {"Arn": DATA_SOURCE_ARN}, None)
+    stubber.add_response("describe_data_source", _data_source("CREATION_FAILED"), key)
+
+    with pytest.raises(ProvisioningError, match="CREATION_FAILED"):
+        _upsert_data_source(provisioner)
+
+
+def test_data_source_wait_times_out(stubbed):
+    provisioner, stubber = stubbed
+    provisioner.timeout = 0
+    stubber.add_client_error("describe_data_source", "ResourceNotFoundException")
+    stubber.add_response("create_data_source", {"Arn": DATA_SOURCE_ARN}, None)
+    stubber.add_response("describe_data_source", _data_source("CREATION_IN_PROGRESS"))
+
+    with pytest.raises(TimeoutError, match="data source AthenaDataSource"):
+        _upsert_data_source(provisioner)
+
+
+def test_existing_dashboard_gets_a_published_version(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DashboardId": "MySESLogDashboard"}
+    definition = {"DataSetIdentifierDeclarations": []}
+    stubber.add_response("describe_dashboard", {"Dashboard": {"Arn": DASHBOARD_ARN}}, key)
+    stubber.add_response("update_dashboard_permissions", {}, dict(key, GrantPermissions=PERMISSIONS))
+    stubber.add_response("update_dashboard", {"VersionArn": f"{DASHBOARD_ARN}/version/3"},
+                         dict(key, Name="MySESLogDashboard", Definition=definition, VersionDescription="1",
+                              DashboardPublishOptions={}))
+    stubber.add_response("describe_dashboard",
+                         {"Dashboard": {"Arn": DASHBOARD_ARN, "Version": {"Status": "CREATION_SUCCESSFUL"}}},
+                         dict(key, VersionNumber=3))
+    stubber.add_response("update_dashboard_published_version", {}, dict(key, VersionNumber=3))
+
+    arn = provisioner.upsert_dashboard("MySESLogDashboard", "MySESLogDashboard", definition, PERMISSIONS, {})
+    assert arn == DASHBOARD_ARN
+
+
+def test_new_dashboard_is_published_on_creation(stubbed):
+    provisioner, stubber = stubbed
+    key = {"AwsAccountId": ACCOUNT, "DashboardId": "MySESLogDashboard"}
+    stubber.add_client_error("describe_dashboard", "ResourceNotFoundException", expected_params=key)
+    stubber.add_response("create_dashboard", {"VersionArn": f"{DASHBOARD_ARN}/version/1"}, None)
+    stubber.add_response("describe_dashboard",
+                         {"Dashboard": {"Arn": DASHBOARD_ARN, "Version": {"Status": "CREATION_SUCCESSFUL"}}},
+                         dict(key, VersionNumber=1))
+
+    definition = {"DataSetIdentifierDeclarations": []}
+    arn = provisioner.upsert_dashboard("MySESLogDashboard", "MySESLogDashboard", definition, PERMISSIONS, {})
+    assert arn == DASHBOARD_ARN
+
+
+def test_steps_run_after_their_requirements():
+    started = []
+    lock = threading.Lock()
+
+    def action(name):
+        def run(inputs):
+            with lock:
+                started.append(name)
+            return (name, sorted(inputs))
+        return run
+
+    steps = [Step("dashboard", action("dashboard"), requires=["dataset"]),
+             Step("dataset", action("dataset"), requires=["data_source"]),
+             Step("rollup_dataset", action("rollup_dataset"), requires=["data_source"]),
+             Step("data_source", action("data_source"))]
+    results = run_steps(steps, max_workers=4)
+
+    assert started.index("data_source") < started.index("dataset") < started.index("dashboard")
+    assert started.index("data_source") < started.index("rollup_dataset")
+    assert results["dashboard"] == ("dashboard", ["dataset"])
+    assert run_steps(steps, max_workers=1) == results
+    # one at a time, the steps made ready by a step start in the order of 'steps'
+    assert started[4:] == ["data_source", "dataset", "rollup_dataset", "dashboard"]
+
+
+def test_failed_step_skips_its_dependents():
+    ran = []
+
+    def fail(inputs):
+        raise ProvisioningError("CREATION_FAILED")
+
+    steps = [Step("data_source", lambda r: "arn"), Step("dataset", fail, requires=["data_source"]),
+             Step("dashboard", lambda r: ran.append("dashboard"), requires=["dataset"]),
+             Step("rollup_dataset", lambda r: ran.append("rollup_dataset"), requires=["data_source"])]
+    with pytest.raises(ProvisioningError, match=r"dataset: CREATION_FAILED \(skipped: dashboard\)"):
+        run_steps(steps)
+    assert ran == ["rollup_dataset"]
+
+
+def test_invalid_graphs_are_refused():
+    with pytest.raises(ValueError, match="Cycle"):
+        run_steps([Step("a", lambda r: 1, requires=["b"]), Step("b", lambda r: 2, requires=["a"])])
+    with pytest.raises(ValueError, match="unknown"):
+        run_steps([Step("a", lambda r: 1, requires=["c"])])
+
+
+def test_provisioning_graph_order():
+    spec = importlib.util.spec_from_file_location("ses_blog_utils", os.path.join(RESOURCES_DIR, "ses-blog-utils.py"))
+    utils = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(utils)
+
+    args = Namespace(user=None, typed_columns=False, user_agent_columns=False, geoip_columns=False,
+                     tenants=None, rollups=True)
+    steps = {step.name: step.requires for step in utils.provisioning_steps(None, args)}
+    assert steps == {"user": (), "data_source": ("user",), "dataset": ("user", "data_source"),
+                     "dashboard": ("user", "dataset"), "rollup_dataset": ("user", "data_source")}
@@ -0,0 +1,185 @@
+import copy
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from conftest import RESOURCES_DIR
+from flatten import flatten_record
+from index import PROJECTION
+from ses_blog_events import EVENT_TYPES, SESEventGenerator
+from ses_blog_recipe import PartitionedParquetWriter, Recipe, partition_values
+
+RECIPE_FILE = os.path.join(RESOURCES_DIR, "recipe.json")
+
+# Events as projected by the transformation Lambda function, written under raw/
+BOUNCE = {
+    "eventType": "Bounce", "timestamp": "2023-01-05T10:15:00.000Z", "source": "news@example.com",
+    "messageId": "m-1", "destination": ["a@example.org", "b@mail.example.net"],
+    "ses:source-ip": ["192.0.2.1"], "ses:outgoing-ip": ["198.51.100.7"],
+    "processingTimeMillis": "", "recipients": [], "bounceType": "Permanent",
+    "bouncedRecipients": [
+        {"emailAddress": "a@example.org", "action": "failed", "status": "5.1.1", "diagnosticCode": "smtp; 550"},
+    ],
+    "complainedRecipients": [{"emailAddress": ""}],
+    "delayedRecipients": [{"emailAddress": "", "status": "", "diagnosticCode": ""}],
+    "contactList": "", "templateName": "welcome",
+}
+DELIVERY = {
+    "eventType": "Delivery", "timestamp": "2023-01-05T10:16:00.000Z", "source": "news@example.com",
+    "messageId": "m-2", "destination": ["c@example.org"], "ses:source-ip": ["192.0.2.1"],
+    "ses:outgoing-ip": ["198.51.100.7"], "processingTimeMillis": 1234,
+    "recipients": ["c@example.org"], "bouncedRecipients": [], "complainedRecipients": [],
+    "delayedRecipients": [], "contactList": "",
+}
+
+
+@pytest.fixture(scope="module")
+def recipe():
+    return Recipe.from_file(RECIPE_FILE)
+
+
+def _rows(recipe, event):
+    return list(recipe.apply([json.loads(json.dumps(event))]))
+
+
+def test_unnest_one_row_per_destination(recipe):
+    rows = _rows(recipe, BOUNCE)
+    assert [r["recipientMail"] for r in rows] == ["a@example.org", "b@mail.example.net"]
+    assert all(r["sesSourceIp"] == "192.0.2.1" and r["sesOutgoingIp"] == "198.51.100.7" for r in rows)
+    for dropped in ("destination", "bouncedRecipients", "ses:source-ip", "contactList", "source",
+                    "bouncedRecipients_unnested_action", "delayedRecipients_unnested_status"):
+        assert all(dropped not in r for r in rows)
+
+
+def test_merge_and_extract_pattern(recipe):
+    rows = _rows(recipe, BOUNCE)
+    # MERGE concatenates the non-null recipients, '' counts
+    assert [r["recipientEvent"] for r in rows] == ["a@example.org", "a@example.org"]
+    # EXTRACT_PATTERN keeps what follows the @, from a domain with at least one dot
+    assert [r["mailRecipientDomain"] for r in rows] == ["example.org", "mail.example.net"]
+    assert rows[0]["sender"] == "news@example.com"
+    assert all("bouncedRecipients_unnested_emailAddress" not in r and "recipients_unnested" not in r for r in rows)
+
+
+def test_processing_time_millis(recipe):
+    rows = _rows(recipe, DELIVERY)
+    assert len(rows) == 1
+    assert rows[0]["processingTimeMillis"] == 1234
+    assert rows[0]["recipientEvent"] == "c@example.org"
+    assert rows[0]["mailRecipientDomain"] == "example.org"
+
+
+def test_flat_output_format_matches_recipe(recipe):
+    for event in (BOUNCE, DELIVERY):
+        expected = _rows(recipe, event)
+        actual = flatten_record(json.loads(json.dumps(event)))
+        for row in expected:
+            if row.get("processingTimeMillis") == "":
+                row["processingTimeMillis"] = None
+        assert actual == expected
+
+
+@pytest.mark.parametrize("event_type", EVENT_TYPES)
+@pytest.mark.parametrize("fanout", [1, 3])
+def test_flat_rows_match_recipe_per_event_type(recipe, event_type, fanout):
+    generator = SESEventGenerator(fanout=fanout, seed=17)
+    moment = datetime(2023, 1, 5, 10, 15, tzinfo=timezone.utc)
+    for _ in range(5):
+        projected = PROJECTION(generator.event(event_type, moment))
+        expected = _rows(recipe, projected)
+        for row in expected:
+            if row.get("processingTimeMillis") == "":
+                row["processingTimeMillis"] = None
+        actual = flatten_record(copy.deepcopy(projected))
+        assert actual == expected
+        assert {r["eventType"] for r in actual} == {event_type}
+        # one row per recipient at least
+        assert {r["recipientMail"] for r in actual} == set(projected["destination"])
+
+
+def test_partition_values():
+    assert partition_values("raw/2023/01/05/10/obj.gz", {}) == {"year": 2023, "month": 1, "day": 5, "hour": 10}
+    assert partition_values("other/obj.gz", {"timestamp": "2023-02-03T04:05:06Z"}) == \
+        {"year": 2023, "month": 2, "day": 3, "hour": 4}
+
+
+def test_typed_parquet_columns(recipe, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = _rows(recipe, BOUNCE) + _rows(recipe, DELIVERY)
+    for row in rows:
+        row.update(year=2023, month=1, day=5, hour=10)
+    with PartitionedParquetWriter(str(tmp_path)) as writer:
+        writer.write_all(rows)
+    table = pq.read_table(writer.files_written[0])
+    assert str(table.schema.field("processingTimeMillis").type) == "int64"
+    assert str(table.schema.field("timestamp").type) == "timestamp[ms, tz=UTC]"
+    assert table.column("processingTimeMillis").to_pylist() == [None, None, 1234]
+
+
+def _partition_rows(count, start=0, **columns):
+    return [dict(year=2023, month=1, day=5, hour=10, messageId=f"m-{i}",
+                 timestamp=f"2023-01-05T10:{59 - i % 60:02d}:00.000Z", **columns)
+            for i in range(start, start + count)]
+
+
+def test_late_columns_are_kept_across_spills(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = _partition_rows(30) + _partition_rows(30, 30, userAgentClient="Firefox", ipAsn="64496")
+    with PartitionedParquetWriter(str(tmp_path), max_buffered_rows=20) as writer:
+        writer.write_all(rows)
+
+    assert len(writer.files_written) == 1
+    table = pq.read_table(writer.files_written[0])
+    assert table.num_rows == writer.rows_written == 60
+    assert str(table.schema.field("ipAsn").type) == "int64"
+    clients = dict(zip(table.column("messageId").to_pylist(), table.column("userAgentClient").to_pylist()))
+    assert clients["m-0"] is None and clients["m-59"] == "Firefox"
+
+
+def test_partition_files_are_sorted_by_timestamp(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    with PartitionedParquetWriter(str(tmp_path), max_buffered_rows=7, row_group_size=10) as writer:
+        writer.write_all(_partition_rows(60) + [dict(year=2023, month=1, day=5, hour=10, messageId="no-time")])
+
+    parquet_file = pq.ParquetFile(writer.files_written[0])
+    assert parquet_file.metadata.num_row_groups == 7
+    table = parquet_file.read()
+    timestamps = table.column("timestamp").to_pylist()
+    assert timestamps[:-1] == sorted(timestamps[:-1]) and timestamps[-1] is None
+    assert table.column("messageId").to_pylist()[-1] == "no-time"
+
+
+def test_spilled_runs_stay_in_their_partition(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = []
+    for i, hour in enumerate((1, 1, 2, 2, 1, 1, 2, 2)):
+        rows.append(dict(year=2023, month=1, day=5, hour=hour, messageId=f"h{hour}-{i}",
+                         timestamp=f"2023-01-05T{hour:02d}:00:{i:02d}.000Z"))
+    with PartitionedParquetWriter(str(tmp_path), max_buffered_rows=2) as writer:
+        writer.write_all(rows)
+
+    assert len(writer.files_written) == 2
+    for hour in (1, 2):
+        path = writer.partition_path((2023, 1, 5, hour))
+        (name,) = os.listdir(path)
+        message_ids = pq.read_table(os.path.join(path, name)).column("messageId").to_pylist()
+        assert message_ids == [r["messageId"] for r in rows if r["messageId"].startswith(f"h{hour}-")]
+
+
+def test_malformed_values_are_stored_as_null(tmp_path, caplog):
+    pq = pytest.importorskip("pyarrow.parquet")
+    rows = _partition_rows(3)
+    rows[0]["processingTimeMillis"] = "12a"
+    rows[1]["processingTimeMillis"] = "340"
+    rows[2]["timestamp"] = "yesterday"
+    with PartitionedParquetWriter(str(tmp_path)) as writer:
+        writer.write_all(rows)
+
+    table = pq.read_table(writer.files_written[0])
+    assert table.num_rows == 3
+    values = dict(zip(table.column("messageId").to_pylist(), table.column("processingTimeMillis").to_pylist()))
+    assert values == {"m-0": None, "m-1": 340, "m-2": None}
+    assert "Storing invalid integer '12a' as null" in caplog.text
+    assert "Storing invalid timestamp 'yesterday' as null" in caplog.text
@@ -0,0 +1,113 @@
+import boto3
+import pytest
+from moto import mock_aws
+
+from reputation import (BOUNCES, SENDS, ReputationMonitor, ReputationState, event_seconds,
+                        reputation_signal)
+
+BUCKET = "reputation-state"
+URI = f"s3://{BUCKET}/reputation/state.bin"
+# 2023-01-05T10:00:00Z
+NOW = 1672912800
+
+
+def _send(seconds, recipients=1, sender="news@example.com"):
+    return (SENDS, sender, "default", ("example.org",) * recipients, seconds)
+
+
+def _totals(monitor, sender="news@example.com"):
+    return monitor.windows[("sender", sender)].totals
+
+
+def test_event_seconds():
+    assert event_seconds("2023-01-05T10:00:00.000Z") == NOW
+    assert event_seconds("2023-01-05T09:59:59Z") == NOW - 1
+    assert event_seconds("2023-01-05") is None
+    assert event_seconds("2023-13-05T10:00:00Z") is None
+    assert event_seconds(None) is None
+
+
+def test_signal_carries_the_event_time():
+    projected = {"eventType": "Bounce", "bounceType": "Permanent", "source": "news@example.com",
+                 "timestamp": "2023-01-05T09:30:00.000Z", "bouncedRecipients": [{"emailAddress": "a@example.org"}]}
+    assert reputation_signal({}, projected) == (BOUNCES, "news@example.com", "unknown", ("example.org",), NOW - 1800)
+
+
+def test_events_are_counted_in_the_bucket_of_their_timestamp():
+    monitor = ReputationMonitor(window_seconds=600, bucket_seconds=60)
+    now = NOW + 30
+    monitor.add(_send(NOW - 540), now)
+    monitor.add(_send(NOW - 30, recipients=2), now)
+    # older than the window, or without a timestamp
+    monitor.add(_send(NOW - 600, recipients=4), now)
+    monitor.add(_send(None, recipients=8), now)
+    assert _totals(monitor)[SENDS] == 11
+
+    # the event of NOW - 540 leaves the window with its bucket, whenever it was delivered
+    monitor.breaches(NOW + 60)
+    assert _totals(monitor)[SENDS] == 10
+
+
+def test_future_events_count_now():
+    monitor = ReputationMonitor(window_seconds=600, bucket_seconds=60)
+    monitor.add(_send(NOW + 3600), NOW)
+    window = monitor.windows[("sender", "news@example.com")]
+    assert window.head == NOW // 60
+    assert window.totals[SENDS] == 1
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+def _environment(s3):
+    monitor = ReputationMonitor(window_seconds=600, bucket_seconds=60)
+    state = ReputationState(URI, interval=0)
+    state._client = s3
+    state.load(monitor)
+    return monitor, state
+
+
+def test_concurrent_environments_merge_their_counts(s3):
+    first, first_state = _environment(s3)
+    second, second_state = _environment(s3)
+    first.add(_send(NOW - 60, recipients=3), NOW)
+    second.add(_send(NOW - 120, recipients=5), NOW)
+
+    assert first_state.maybe_save(first, NOW)
+    assert second_state.maybe_save(second, NOW + 1)
+    # saving again adds nothing: only the counts added since the last save are merged
+    assert first_state.maybe_save(first, NOW + 2)
+    assert second_state.maybe_save(second, NOW + 3)
+    assert _totals(second)[SENDS] == 8
+
+    third, _ = _environment(s3)
+    assert _totals(third)[SENDS] == 8
+
+
+def test_lost_conditional_write_is_retried(s3):
+    monitor, state = _environment(s3)
+    other, other_state = _environment(s3)
+    monitor.add(_send(NOW - 60, recipients=3), NOW)
+    other.add(_send(NOW - 60, recipients=5), NOW)
+
+    put_object = s3.put_object
+    calls = []
+
+    def interleaved_put(**kwargs):
+        # the other environment writes between the read and the write of the first attempt
+        if not calls:
+            calls.append(kwargs)
+            assert other_state.maybe_save(other, NOW)
+        return put_object(**kwargs)
+
+    state._client = type("Client", (), {"get_object": s3.get_object, "put_object": staticmethod(interleaved_put),
+                                         "exceptions": s3.exceptions})()
+    assert state.maybe_save(monitor, NOW)
+    assert _totals(monitor)[SENDS] == 8
+    fresh, _ = _environment(s3)
+    assert _totals(fresh)[SENDS] == 8
@@ -0,0 +1,75 @@
+import math
+from datetime import datetime, timezone
+
+import pytest
+from ses_blog_sketches import HourSketches, HyperLogLog, OPENERS, RECIPIENTS
+
+
+def _sketch(values, precision=12):
+    sketch = HyperLogLog(precision)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+def _values(start, stop):
+    return [f"recipient{i}@example.com" for i in range(start, stop)]
+
+
+@pytest.mark.parametrize("precision", [10, 12, 14])
+@pytest.mark.parametrize("cardinality", [10, 100, 1000, 10000, 100000])
+def test_estimate_within_error_bound(precision, cardinality):
+    # relative standard error of 1.04 / sqrt(m), checked at 4 standard errors
+    bound = 4 * 1.04 / math.sqrt(1 << precision)
+    sketch = _sketch(_values(0, cardinality), precision)
+    assert abs(sketch.estimate() - cardinality) <= max(bound * cardinality, 1)
+
+
+def test_repeated_values_are_counted_once():
+    sketch = _sketch(_values(0, 500) * 5)
+    assert sketch.registers == _sketch(_values(0, 500)).registers
+
+
+def test_merge_is_a_union():
+    a, b = _values(0, 6000), _values(4000, 9000)
+    merged = _sketch(a).merge(_sketch(b))
+    assert merged.registers == _sketch(a + b).registers
+    assert abs(merged.estimate() - 9000) <= 4 * 1.04 / 64 * 9000
+
+
+def test_merge_is_associative_and_commutative():
+    a, b, c = _values(0, 3000), _values(2000, 5000), _values(4500, 8000)
+    left = _sketch(a).merge(_sketch(b)).merge(_sketch(c))
+    right = _sketch(a).merge(_sketch(b).merge(_sketch(c)))
+    swapped = _sketch(c).merge(_sketch(a)).merge(_sketch(b))
+    assert left.registers == right.registers == swapped.registers
+
+
+def test_merge_of_different_precisions_is_refused():
+    with pytest.raises(ValueError):
+        HyperLogLog(12).merge(HyperLogLog(10))
+
+
+@pytest.mark.parametrize("precision", [4, 12, 16])
+def test_serialization_round_trip(precision):
+    sketch = _sketch(_values(0, 2000), precision)
+    restored = HyperLogLog.from_bytes(sketch.to_bytes())
+    assert restored.precision == precision
+    assert restored.registers == sketch.registers
+    assert restored.estimate() == sketch.estimate()
+
+
+def test_hour_sketches_table_round_trip():
+    hour = datetime(2023, 1, 5, 10, tzinfo=timezone.utc)
+    sketches = HourSketches(hour, precision=10)
+    for i in range(300):
+        sketches.add({"recipientmail": f"r{i}@example.com", "sender": "s@example.com", "templatename": None,
+                      "mailrecipientdomain": "example.com", "eventtype": "Open" if i % 3 else "Delivery"})
+    restored = HourSketches.from_table(hour, sketches.to_table())
+    assert restored.precision == 10
+    assert set(restored.sketches) == set(sketches.sketches)
+    for key, sketch in sketches.sketches.items():
+        assert restored.sketches[key].registers == sketch.registers
+    dimensions = ("s@example.com", None, "example.com")
+    assert len(restored.sketches[dimensions + (RECIPIENTS,)]) == pytest.approx(300, abs=12)
+    assert len(restored.sketches[dimensions + (OPENERS,)]) == pytest.approx(200, abs=8)